@@ -1,104 +1,255 @@
 import asyncio, signal
+import hashlib
+import random
 import base64
+import codecs
 import json
 import os
 import platform
 import socket
 import subprocess
+import sys
 import time
-import shutil
+import uuid
+from collections import deque
+from datetime import datetime, timezone
 
-import psutil
-import requests
+import httpx
 import websockets
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+
+from transport import Transport
+from spool import Spool
+from collector import Collector
+from selfstats import SelfStats
+from images import ImagePipeline, ImageHandler
+from uploader import Uploader
 
 # ---------------- CONFIG ----------------
 API_URL = os.getenv("API_URL", "http://localhost:8000")
 WS_URL = os.getenv("WS_URL", "ws://localhost:8000")
 TOKEN_FILE = os.getenv("TOKEN_FILE", "./agent_token.txt")
-AGENT_VERSION = "0.1.0"
+AGENT_VERSION = "0.2.1"
+MAX_CONCURRENT_COMMANDS = int(os.getenv("MAX_CONCURRENT_COMMANDS", "4"))
+COMMAND_TIMEOUT = 600
+OUTPUT_CHUNK = 4096      # bytes per streamed output message
+OUTPUT_TAIL = 65536      # output kept after a failed send, for the status POST
+UPLOAD_INTERVAL = float(os.getenv("UPLOAD_INTERVAL", "30"))   # seconds between spool uploads
+UPLOAD_BATCH = 500                                           # server accepts up to 1000 per batch
+WS_HEARTBEAT = 30         # for servers run with WS_IDLE_TIMEOUT (e.g. 90 s)
+BACKOFF_BASE = 5
+BACKOFF_MAX = 600
 
 WATCH_FOLDERS = ["C:/Users/Imixadmin/Pictures/Smart Shooter 4", "D:/Photos/Incoming"]
 DEST_FOLDER = "C:/Users/Imixadmin/Pictures/Static"  # Optional copy destination
 ALLOWED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp"}
+UPLOAD_IMAGES = os.getenv("UPLOAD_IMAGES", "1") == "1"  # send picked-up images to the server's file store
 # ----------------------------------------
 
 # ---------------- TOKEN -----------------
-def read_token() -> str:
-    """Read the stored token, strip device_id if present."""
-    if os.path.exists(TOKEN_FILE):
-        tok = open(TOKEN_FILE, "r").read().strip()
-        if ":" in tok:
-            tok, _ = tok.split(":", 1)
-        return tok
-    # if file missing: register fresh
-    payload = {
-        "hostname": socket.gethostname(),
-        "os": f"{platform.system()} {platform.release()}",
-        "arch": platform.machine(),
-        "agent_version": AGENT_VERSION
-    }
-    r = requests.post(f"{API_URL}/register", json=payload, timeout=10)
-    r.raise_for_status()
-    tok = r.json()["token"]
-    open(TOKEN_FILE, "w").write(tok)
-    return tok
-
-
-def ensure_device_id(token: str) -> int:
-    if os.path.exists(TOKEN_FILE) and ":" in open(TOKEN_FILE).read():
-        t, did = open(TOKEN_FILE).read().split(":", 1)
-        if t == token:
-            return int(did)
+# TOKEN_FILE holds "<token>:<device_id>". A file with only a token (agents
+# before 0.2) is completed by presenting that token to /register. Otherwise
+# the agent enrolls with its fingerprint; the server returns the same device
+# for the same machine every time, so a lost file or a retried request never
+# creates a duplicate. Retries use full jitter so a lab of PCs booting
+# together does not hit the server in lockstep.
+def machine_fingerprint() -> str:
+    ids = []
+    try:
+        if platform.system() == "Windows":
+            import winreg
+            with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\Microsoft\Cryptography") as key:
+                ids.append(winreg.QueryValueEx(key, "MachineGuid")[0])
+        elif platform.system() == "Darwin":
+            out = subprocess.run(["ioreg", "-rd1", "-c", "IOPlatformExpertDevice"], capture_output=True, text=True).stdout
+            ids += [line.split('"')[-2] for line in out.splitlines() if "IOPlatformUUID" in line]
+        else:
+            for path in ("/etc/machine-id", "/var/lib/dbus/machine-id"):
+                if os.path.exists(path):
+                    ids.append(open(path).read().strip())
+                    break
+    except Exception as e:
+        print(f"machine id unavailable: {e}")
+    node = uuid.getnode()
+    if not (node >> 40) & 1:  # a real MAC (getnode() falls back to a random one); cloned images share the machine id
+        ids.append(f"{node:012x}")
+    return hashlib.sha256("|".join(ids or [socket.gethostname()]).encode()).hexdigest()
+
+
+async def enroll() -> tuple[str, int]:
+    saved = open(TOKEN_FILE).read().strip() if os.path.exists(TOKEN_FILE) else ""
+    token, _, device_id = saved.partition(":")
+    if token and device_id:
+        return token, int(device_id)
     payload = {
         "hostname": socket.gethostname(),
         "os": f"{platform.system()} {platform.release()}",
         "arch": platform.machine(),
-        "agent_version": AGENT_VERSION
+        "agent_version": AGENT_VERSION,
+        "fingerprint": machine_fingerprint(),
     }
-    r = requests.post(f"{API_URL}/register", json=payload, timeout=10)
-    r.raise_for_status()
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    delay = BACKOFF_BASE
+    async with httpx.AsyncClient(base_url=API_URL, timeout=10) as client:
+        while True:
+            try:
+                r = await client.post("/register", json=payload, headers=headers)
+                if r.status_code == 401 and headers:  # server does not know the old token; enroll afresh
+                    headers = {}
+                    continue
+                r.raise_for_status()
+                break
+            except httpx.HTTPError as e:
+                print(f"registration failed: {e!r}")
+            await asyncio.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, BACKOFF_MAX)
     data = r.json()
-    open(TOKEN_FILE, "w").write(f"{data['token']}:{data['device_id']}")
-    return int(data["device_id"])
+    with open(TOKEN_FILE + ".tmp", "w") as f:
+        f.write(f"{data['token']}:{data['id']}")
+    os.replace(TOKEN_FILE + ".tmp", TOKEN_FILE)
+    return data["token"], int(data["id"])
 
 # -------------- METRICS ----------------
-def collect_metrics():
-    cpu = psutil.cpu_percent(interval=0.5)
-    mem = psutil.virtual_memory().percent
-    disk = psutil.disk_usage("/").percent
-    uptime = time.time() - psutil.boot_time()
-    battery_pct = None
-    try:
-        if psutil.sensors_battery():
-            battery_pct = psutil.sensors_battery().percent
-    except Exception:
-        pass
-
-    details = {
-        "load_avg": getattr(os, "getloadavg", lambda: (0, 0, 0))(),
-        "disks": {p.mountpoint: psutil.disk_usage(p.mountpoint).percent for p in psutil.disk_partitions() if p.fstype},
-    }
-    return dict(cpu=cpu, mem=mem, disk=disk, uptime_sec=uptime, battery_pct=battery_pct, details=details)
-
-async def metrics_loop(token: str):
+async def metrics_loop(spool: Spool, collector: Collector, stats: SelfStats):
+    # sampling never waits on the network; upload_loop ships the spool.
+    # A sample is taken whenever the most frequent metric is due.
     while True:
         try:
-            m = collect_metrics()
-            requests.post(f"{API_URL}/metrics", headers={"Authorization": f"Bearer {token}"}, json=m, timeout=10)
-        except Exception:
-            pass
-        await asyncio.sleep(15)
+            t0 = time.perf_counter()
+            m = await asyncio.to_thread(collector.collect)
+            stats.collected(time.perf_counter() - t0)
+            m["details"]["agent"] = stats.snapshot()
+            m["ts"] = datetime.now(timezone.utc).isoformat()
+            await asyncio.to_thread(spool.append, m)
+        except Exception as e:
+            print(f"metrics sample failed: {e}")
+        await asyncio.sleep(max(1.0, collector.next_due() - time.time()))
+
+async def upload_loop(spool: Spool, transport: Transport):
+    """Ship the spool oldest-first in gzip batches; after failures back off with full jitter
+    so a fleet that lost the API doesn't all come back in the same second."""
+    failures = 0
+    await asyncio.sleep(random.uniform(0, UPLOAD_INTERVAL))  # spread agents that start together
+    while True:
+        while True:
+            last_id, batch = await asyncio.to_thread(spool.peek, UPLOAD_BATCH)
+            if not batch:
+                failures = 0
+                break
+            r = await transport.metrics_batch(batch)
+            if r is not None and (r.is_success or r.status_code in (400, 413, 422)):
+                if not r.is_success:  # the server will never take this batch; don't retry it forever
+                    print(f"metrics batch rejected ({r.status_code}), dropping {len(batch)} samples")
+                await asyncio.to_thread(spool.ack, last_id)
+                continue
+            failures += 1
+            break
+        if failures:
+            await asyncio.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** failures)))
+        else:
+            await asyncio.sleep(UPLOAD_INTERVAL)
 
 # ------------- SHELL / RESTART / SHUTDOWN --------------
-def run_shell(cmd: str):
+class Channel:
+    """The current WS connection; commands outlive reconnects and keep sending through it."""
+    def __init__(self):
+        self.ws = None
+
+    async def send(self, obj) -> bool:
+        ws = self.ws
+        if ws is None:
+            return False
+        try:
+            await ws.send(json.dumps(obj))
+            return True
+        except Exception:
+            return False
+
+
+async def run_shell(cmd: str, cmd_id: int, chan: Channel):
+    """Run without blocking the loop, streaming stdout/stderr as they come. Returns (rc, rest, offset).
+
+    Each streamed piece carries its byte offset in the command's output, so the server stores it in
+    place whichever worker it lands on. After the first failed send nothing more is streamed; `rest`
+    is the output from `offset` on (None if everything went out), for the status POST to deliver."""
+    proc = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    unsent = deque()
+    state = {"offset": 0, "failed_at": None, "unsent": 0, "lost": 0}
+    lock = asyncio.Lock()  # offset and send together, so everything before failed_at went out and nothing after
+
+    def keep(text: str, at: int) -> None:
+        if state["failed_at"] is None:
+            state["failed_at"] = at
+        unsent.append(text); state["unsent"] += len(text)
+        while state["unsent"] > OUTPUT_TAIL and len(unsent) > 1:
+            n = len(unsent.popleft())
+            state["unsent"] -= n; state["lost"] += n
+
+    async def pump(stream, name):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")  # characters split across reads
+        while True:
+            data = await stream.read(OUTPUT_CHUNK)
+            text = decoder.decode(data, final=not data)
+            if not text:
+                if not data:
+                    return
+                continue
+            async with lock:
+                offset = state["offset"]
+                state["offset"] += len(text.encode("utf-8"))
+                if state["failed_at"] is not None or not await chan.send(
+                        {"type": "output", "cmd_id": cmd_id, "stream": name, "data": text, "offset": offset}):
+                    keep(text, offset)  # streaming on after a gap would leave a hole in the stored output
+
     try:
-        out = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=600)
-        return out.returncode, (out.stdout + "\n" + out.stderr).strip()
-    except Exception as e:
-        return 1, f"error: {e}"
+        await asyncio.wait_for(asyncio.gather(pump(proc.stdout, "stdout"), pump(proc.stderr, "stderr"), proc.wait()),
+                               COMMAND_TIMEOUT)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        keep(f"\ntimed out after {COMMAND_TIMEOUT}s", state["offset"])
+    if state["failed_at"] is None:
+        return proc.returncode, None, state["offset"]
+    rest = "".join(unsent)
+    if state["lost"]:
+        rest = f"\n[output incomplete; {state['lost']} characters lost, last {len(rest)} follow]\n{rest}"
+    return proc.returncode, rest, state["failed_at"]
+
+
+async def run_command(transport: Transport, uploader: Uploader, data: dict, chan: Channel, slots: asyncio.Semaphore,
+                      stats: SelfStats):
+    cmd_id = data["cmd_id"]
+    kind = data["kind"]
+    payload = data.get("payload") or ""
+    body = {"status": "done"}
+    async with slots:
+        try:
+            if kind in ("shell", "script"):
+                if kind == "script":
+                    script = base64.b64decode(payload).decode("utf-8", errors="ignore")
+                    if platform.system() == "Windows":
+                        payload = f'powershell -NoProfile -Command "{script}"'
+                    else:
+                        payload = f"/bin/bash -lc '{script}'"
+                t0 = time.perf_counter()
+                rc, rest, offset = await run_shell(payload, cmd_id, chan)
+                stats.shell(time.perf_counter() - t0)
+                body["exit_code"] = rc
+                if rest is not None:  # the socket dropped mid-command; the rest goes with the status
+                    body["result"], body["output_offset"] = rest, offset
+            elif kind == "upload":  # payload is a path on this machine
+                res = await uploader.upload(os.path.expanduser(payload), kind="file", command_id=cmd_id)
+                body["result"] = json.dumps(res)
+            elif kind == "restart":
+                body["result"] = "restarting"; do_restart()
+            elif kind == "shutdown":
+                body["result"] = "shutting down"; do_shutdown()
+            else:
+                body = {"status": "error", "result": f"unknown kind: {kind}"}
+        except Exception as e:
+            body = {"status": "error", "result": f"exception: {e}"}
+
+    await transport.command_status(cmd_id, body)
 
 def do_restart():
     if platform.system() == "Windows":
@@ -113,117 +264,47 @@ def do_shutdown():
         subprocess.Popen("shutdown -h now", shell=True)
 
 # ---------------- WEBSOCKET ----------------
-async def ws_loop(token: str, device_id: int):
+async def ws_loop(token: str, device_id: int, transport: Transport, uploader: Uploader, stats: SelfStats):
     url = f"{WS_URL}/ws/agent/{device_id}"
     headers = [("Authorization", f"Bearer {token}")]
+    seen = deque(maxlen=500)  # server redelivers unacked commands; run each one once
+    chan = Channel()
+    slots = asyncio.Semaphore(MAX_CONCURRENT_COMMANDS)
+    running = set()
     while True:
         try:
-            async with websockets.connect(url, extra_headers=headers, ping_interval=20, ping_timeout=20) as ws:
+            async with websockets.connect(url, extra_headers=headers, ping_interval=20, ping_timeout=20,
+                                          compression=None) as ws:
+                chan.ws = ws
                 await ws.send("hello")
-                while True:
-                    msg = await ws.recv()
-                    data = json.loads(msg)
-                    cmd_id = data["cmd_id"]
-                    kind = data["kind"]
-                    payload = data.get("payload") or ""
-                    status = "done"
-                    result = ""
-                    try:
-                        if kind == "shell":
-                            rc, out = run_shell(payload)
-                            result = f"rc={rc}\n{out}"
-                        elif kind == "restart":
-                            result = "restarting"; do_restart()
-                        elif kind == "shutdown":
-                            result = "shutting down"; do_shutdown()
-                        elif kind == "script":
-                            script = base64.b64decode(payload).decode("utf-8", errors="ignore")
-                            if platform.system() == "Windows":
-                                rc, out = run_shell(f'powershell -NoProfile -Command "{script}"')
-                            else:
-                                rc, out = run_shell(f"/bin/bash -lc '{script}'")
-                            result = f"rc={rc}\n{out}"
-                        else:
-                            status = "error"; result = f"unknown kind: {kind}"
-                    except Exception as e:
-                        status = "error"; result = f"exception: {e}"
-
-                    try:
-                        requests.post(f"{API_URL}/commands/{cmd_id}/status",
-                                      headers={"Authorization": f"Bearer {token}"},
-                                      json={"status": status, "result": result}, timeout=10)
-                    except Exception:
-                        pass
-        except Exception:
-            await asyncio.sleep(5)
-
-# ---------------- FOLDER MONITORING ----------------
-class ImageHandler(FileSystemEventHandler):
-    def __init__(self, token: str):
-        self.token = token
-
-    def on_created(self, event):
-        if not event.is_directory and os.path.splitext(event.src_path)[1].lower() in ALLOWED_EXTENSIONS:
-            file_path = event.src_path
-            file_name = os.path.basename(file_path)
-
-            # Wait until file is fully available
-            for _ in range(10):  # try 10 times
+                beat = asyncio.create_task(heartbeat(ws))
                 try:
-                    size = os.path.getsize(file_path)
-                    with open(file_path, "rb") as f:
-                        f.read(1)
-                    break  # file is ready
-                except (PermissionError, OSError):
-                    time.sleep(0.5)
-            else:
-                print(f"Failed to access file {file_name}")
-                return
-
-            created = os.path.getctime(file_path)
-            print(f"New image detected: {file_name}, Size: {size}, Created: {created}")
-
-            if DEST_FOLDER:
-                os.makedirs(DEST_FOLDER, exist_ok=True)
-
-                dest_path = os.path.join(DEST_FOLDER, file_name)
-                for _ in range(10):
-                    try:
-                        shutil.copy2(file_path, dest_path)
-                        break  # success
-                    except (PermissionError, OSError):
-                        time.sleep(0.5)
-            else:
-                print(f"Failed to copy file {file_name} to destination")
-
-
-            try:
-                requests.post(f"{API_URL}/new_image",
-                              headers={"Authorization": f"Bearer {self.token}"},
-                              json={"filename": file_name, "size": size, "created": created},
-                              timeout=10)
-            except Exception:
-                pass
+                    while True:
+                        msg = await ws.recv()
+                        data = json.loads(msg)
+                        cmd_id = data.get("cmd_id")
+                        if cmd_id is None:
+                            continue
+                        await ws.send(json.dumps({"type": "ack", "cmd_id": cmd_id}))
+                        if cmd_id in seen:
+                            continue
+                        seen.append(cmd_id)
+                        # run in the background so the socket keeps reading (and answering pings)
+                        task = asyncio.create_task(run_command(transport, uploader, data, chan, slots, stats))
+                        running.add(task)
+                        task.add_done_callback(running.discard)
+                finally:
+                    beat.cancel()
+        except Exception:
+            chan.ws = None
+            await asyncio.sleep(random.uniform(2, 8))  # spread out reconnects after a server restart
 
 
-def start_monitoring(token: str):
-    observer = Observer()
-    handler = ImageHandler(token)
-    for folder in WATCH_FOLDERS:
-        if os.path.exists(folder):
-            observer.schedule(handler, folder, recursive=False)
-        else:
-            print(f"Warning: folder {folder} does not exist")
-    observer.start()
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        observer.stop()
-    observer.join()
-
-async def monitor_loop(token: str):
-    await asyncio.to_thread(start_monitoring, token)
+async def heartbeat(ws):
+    """The server closes sockets it has not heard from in a while; keep ours alive when idle."""
+    while True:
+        await asyncio.sleep(WS_HEARTBEAT)
+        await ws.send("ping")
 
 # ---------------- MAIN ----------------
 
@@ -231,12 +312,18 @@ async def async_main():
     global observer
 
     # initialize token/device
-    token = read_token()
-    device_id = ensure_device_id(token)
-
-    # start folder monitoring
+    token, device_id = await enroll()
+    transport = Transport(API_URL, token)
+    spool = Spool()
+    uploader = Uploader(transport)
+    await transport.heartbeat()
+
+    # start folder monitoring; the observer thread only feeds the pipeline
+    images = ImagePipeline(transport, asyncio.get_running_loop(), DEST_FOLDER, ALLOWED_EXTENSIONS,
+                           uploader if UPLOAD_IMAGES else None)
+    image_tasks = images.tasks()
     observer = Observer()
-    handler = ImageHandler(token)
+    handler = ImageHandler(images)
     for folder in WATCH_FOLDERS:
         if os.path.exists(folder):
             observer.schedule(handler, folder, recursive=False)
@@ -245,8 +332,11 @@ async def async_main():
     observer.start()
 
     # create async tasks
-    metrics_task = asyncio.create_task(metrics_loop(token))
-    ws_task = asyncio.create_task(ws_loop(token, device_id))
+    stats = SelfStats()
+    lag_task = asyncio.create_task(stats.watch_loop())
+    metrics_task = asyncio.create_task(metrics_loop(spool, Collector(), stats))
+    upload_task = asyncio.create_task(upload_loop(spool, transport))
+    ws_task = asyncio.create_task(ws_loop(token, device_id, transport, uploader, stats))
 
     try:
         # wait forever, handle Ctrl+C
@@ -260,11 +350,20 @@ async def async_main():
     observer.join()
 
     # cancel async tasks
+    lag_task.cancel()
     metrics_task.cancel()
+    upload_task.cancel()
     ws_task.cancel()
-    await asyncio.gather(metrics_task, ws_task, return_exceptions=True)
+    for t in image_tasks:
+        t.cancel()
+    await asyncio.gather(lag_task, metrics_task, upload_task, ws_task, *image_tasks, return_exceptions=True)
+    await transport.aclose()
+    spool.close()
     print("Agent stopped cleanly.")
 
 
 if __name__ == "__main__":
-    asyncio.run(async_main())
+    if "--fingerprint" in sys.argv:  # for collecting fingerprints to pre-enroll (POST /admin/enroll)
+        print(socket.gethostname(), machine_fingerprint())
+    else:
+        asyncio.run(async_main())
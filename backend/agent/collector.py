@@ -0,0 +1,86 @@
+import os
+import time
+import psutil
+
+# ---------------- METRICS COLLECTOR ----------------
+# Each metric is read on its own interval and the latest value is reused in
+# between, so a sample only pays for what is actually due. CPU is the
+# non-blocking delta since the previous read (an average over the whole
+# interval rather than a 0.5 s snapshot). Facts that barely change (boot time,
+# the partition list, whether there is a battery at all) are looked up on a
+# slow STATIC_REFRESH schedule.
+DEFAULT_INTERVALS = {"cpu": 15, "mem": 15, "load": 15, "battery": 60, "disk": 300}
+STATIC_REFRESH = 600
+
+
+def parse_intervals(spec: str | None) -> dict:
+    """'cpu=5,disk=300' -> DEFAULT_INTERVALS with those overridden."""
+    intervals = dict(DEFAULT_INTERVALS)
+    for part in (spec or "").split(","):
+        if "=" in part:
+            name, secs = part.split("=", 1)
+            if name.strip() in intervals:
+                intervals[name.strip()] = float(secs)
+    return intervals
+
+
+class Collector:
+    def __init__(self, intervals: dict | None = None, static_refresh: float = STATIC_REFRESH):
+        self.intervals = intervals or parse_intervals(os.getenv("METRIC_INTERVALS"))
+        self.static_refresh = static_refresh
+        self.static_at = 0.0
+        self.boot_time = 0.0
+        self.mounts: list[str] = []
+        self.has_battery = False
+        self.due = {name: 0.0 for name in self.intervals}
+        self.values = {"cpu": 0.0, "mem": 0.0, "load_avg": (0, 0, 0), "battery_pct": None, "disk": 0.0, "disks": {}}
+        psutil.cpu_percent(interval=None)  # prime the delta; the first real read covers the time since here
+
+    def refresh_static(self) -> None:
+        self.boot_time = psutil.boot_time()
+        self.mounts = [p.mountpoint for p in psutil.disk_partitions() if p.fstype]
+        try:
+            self.has_battery = psutil.sensors_battery() is not None
+        except Exception:
+            self.has_battery = False
+
+    def _read(self, name: str) -> None:
+        v = self.values
+        if name == "cpu":
+            v["cpu"] = psutil.cpu_percent(interval=None)
+        elif name == "mem":
+            v["mem"] = psutil.virtual_memory().percent
+        elif name == "load":
+            v["load_avg"] = getattr(os, "getloadavg", lambda: (0, 0, 0))()
+        elif name == "battery":
+            battery = psutil.sensors_battery() if self.has_battery else None
+            v["battery_pct"] = battery.percent if battery else None
+        elif name == "disk":
+            disks = {}
+            for mount in self.mounts:
+                try:
+                    disks[mount] = psutil.disk_usage(mount).percent
+                except OSError:  # ejected media, empty card readers
+                    pass
+            v["disks"] = disks
+            v["disk"] = disks.get("/", next(iter(disks.values()), 0.0))
+
+    def next_due(self) -> float:
+        return min(self.due.values())
+
+    def collect(self, now: float | None = None) -> dict:
+        """Read whatever is due and return a full sample (cached values for the rest)."""
+        now = now or time.time()
+        if now - self.static_at >= self.static_refresh:
+            self.refresh_static()
+            self.static_at = now
+        for name, interval in self.intervals.items():
+            if self.due[name] <= now:
+                try:
+                    self._read(name)
+                except Exception as e:
+                    print(f"collector: reading {name} failed: {e}")
+                self.due[name] = now + interval
+        v = self.values
+        return dict(cpu=v["cpu"], mem=v["mem"], disk=v["disk"], uptime_sec=now - self.boot_time,
+                    battery_pct=v["battery_pct"], details={"load_avg": v["load_avg"], "disks": v["disks"]})
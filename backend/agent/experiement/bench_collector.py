@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+import argparse
+import psutil
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from collector import Collector
+
+# Agent overhead per metrics tick: process CPU time and wall time of the old
+# collect_metrics() against the Collector. The old function is copied here
+# as it was (0.5 s blocking cpu_percent, battery read twice, boot_time and
+# every partition's disk_usage on each call). --no-sleep drops the 0.5 s so
+# only its CPU cost is compared. The Collector is driven with a fake clock
+# stepping --step seconds per tick, so its per-metric intervals behave as
+# they would in the agent.
+
+def legacy_collect(cpu_interval: float = 0.5):
+    cpu = psutil.cpu_percent(interval=cpu_interval)
+    mem = psutil.virtual_memory().percent
+    disk = psutil.disk_usage("/").percent
+    uptime = time.time() - psutil.boot_time()
+    battery_pct = None
+    try:
+        if psutil.sensors_battery():
+            battery_pct = psutil.sensors_battery().percent
+    except Exception:
+        pass
+    details = {
+        "load_avg": getattr(os, "getloadavg", lambda: (0, 0, 0))(),
+        "disks": {p.mountpoint: psutil.disk_usage(p.mountpoint).percent for p in psutil.disk_partitions() if p.fstype},
+    }
+    return dict(cpu=cpu, mem=mem, disk=disk, uptime_sec=uptime, battery_pct=battery_pct, details=details)
+
+
+def measure(fn, ticks: int) -> tuple[float, float]:
+    cpu0, wall0 = time.process_time(), time.perf_counter()
+    for i in range(ticks):
+        fn(i)
+    return (time.process_time() - cpu0) / ticks * 1000, (time.perf_counter() - wall0) / ticks * 1000
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--ticks", type=int, default=200)
+    ap.add_argument("--step", type=float, default=15, help="simulated seconds between collector ticks")
+    ap.add_argument("--no-sleep", action="store_true", help="run the legacy collector without its 0.5 s sample")
+    args = ap.parse_args()
+
+    legacy_ticks = args.ticks if args.no_sleep else min(args.ticks, 20)  # 0.5 s each
+    cpu_interval = None if args.no_sleep else 0.5
+    cpu_ms, wall_ms = measure(lambda i: legacy_collect(cpu_interval), legacy_ticks)
+    print(f"legacy     cpu {cpu_ms:7.3f} ms/tick  wall {wall_ms:8.3f} ms/tick  ({legacy_ticks} ticks)")
+
+    c = Collector()
+    start = time.time()
+    cpu_ms, wall_ms = measure(lambda i: c.collect(start + i * args.step), args.ticks)
+    print(f"collector  cpu {cpu_ms:7.3f} ms/tick  wall {wall_ms:8.3f} ms/tick  ({args.ticks} ticks, "
+          f"{args.step:g}s apart, intervals {c.intervals})")
@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from selfstats import SelfStats
+import wire
+
+# What the agent's self telemetry costs: CPU per snapshot() (the psutil
+# reads behind details["agent"]), CPU per second of the loop-lag watcher,
+# and the extra bytes per sample in a gzipped msgpack upload batch, where
+# details["agent"] changes every sample and is always sent.
+
+def batch(n: int, stats: SelfStats | None) -> list[dict]:
+    out = []
+    for i in range(n):
+        details = {"load_avg": [0.5, 0.4, 0.3], "disks": {"/": 41.0}}
+        if stats:
+            stats.collected(0.0004)
+            details["agent"] = stats.snapshot()
+        out.append({"cpu": 12.5, "mem": 40.1, "disk": 41.0, "uptime_sec": 86400 + i * 15, "battery_pct": None,
+                    "details": details, "ts": 1_760_000_000 + i * 15})
+    return out
+
+
+async def watcher_cpu(seconds: float, interval: float) -> float:
+    stats = SelfStats()
+    cpu0 = time.process_time()
+    task = asyncio.create_task(stats.watch_loop(interval))
+    await asyncio.sleep(seconds)
+    task.cancel()
+    return (time.process_time() - cpu0) / seconds
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--snapshots", type=int, default=2000)
+    ap.add_argument("--seconds", type=float, default=10)
+    args = ap.parse_args()
+
+    s = SelfStats()
+    cpu0 = time.process_time()
+    for _ in range(args.snapshots):
+        s.snapshot()
+    print(f"snapshot()        {(time.process_time() - cpu0) / args.snapshots * 1e6:8.1f} us cpu each")
+
+    idle = asyncio.run(watcher_cpu(args.seconds, 3600))
+    watched = asyncio.run(watcher_cpu(args.seconds, 1))
+    print(f"loop-lag watcher  {(watched - idle) * 1e6:8.1f} us cpu per second (1 s interval)")
+
+    if wire.msgpack:
+        import gzip
+        plain = len(gzip.compress(wire.encode_batch(batch(500, None))))
+        agent = len(gzip.compress(wire.encode_batch(batch(500, SelfStats()))))
+        print(f"upload batch      {plain / 500:8.1f} -> {agent / 500:.1f} bytes per sample gzipped (500 samples)")
@@ -0,0 +1,109 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import argparse
+import requests
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from transport import Transport
+
+# Per-sample cost of the agent's HTTP posts: the old module-level
+# requests.post (new TCP connection per call, run right on the event loop)
+# against the pooled keep-alive Transport. A tiny local HTTP/1.1 server
+# stands in for the API so connection churn can be counted exactly;
+# --latency adds server think time. Also reports the longest stall of the
+# event loop while posting, which is what delays WS pings and commands.
+# The server runs on its own thread/loop so the blocking client can't starve it.
+
+class CountingServer:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.connections = 0
+        self.requests = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":", 1)[1])
+                await reader.readexactly(length)
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                self.requests += 1
+                writer.write(b"HTTP/1.1 200 OK\r\ncontent-type: application/json\r\ncontent-length: 11\r\n\r\n"
+                             b'{"ok":true}')
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def sample() -> dict:
+    return {"cpu": 12.5, "mem": 48.1, "disk": 71.5, "uptime_sec": 12345.0, "battery_pct": None,
+            "details": {"load_avg": [0.5, 0.4, 0.3], "disks": {"/": 71.5, "/boot": 22.0}}}
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else 0.0
+
+
+async def watch_loop(stop: asyncio.Event, stalls: list[float], tick: float = 0.005):
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(tick)
+        stalls.append(time.perf_counter() - t0 - tick)
+
+
+async def run_mode(mode: str, url: str, n: int, server: CountingServer | None) -> dict:
+    conns0 = server.connections if server else 0
+    stop, stalls, walls = asyncio.Event(), [], []
+    watcher = asyncio.create_task(watch_loop(stop, stalls))
+    transport = Transport(url, "bench-token") if mode == "transport" else None
+    for _ in range(n):
+        t0 = time.perf_counter()
+        if transport:
+            await transport.metrics(sample())
+        else:  # what metrics_loop used to do
+            requests.post(f"{url}/metrics", headers={"Authorization": "Bearer bench-token"}, json=sample(), timeout=10)
+        walls.append(time.perf_counter() - t0)
+        await asyncio.sleep(0)
+    if transport:
+        await transport.aclose()
+    stop.set()
+    await watcher
+    return {"mode": mode, "p50_ms": percentile(walls, 50) * 1000, "p99_ms": percentile(walls, 99) * 1000,
+            "max_stall_ms": max(stalls, default=0) * 1000,
+            "connections": (server.connections - conns0) if server else None}
+
+
+def start_server(server: CountingServer) -> str:
+    loop = asyncio.new_event_loop()
+    srv = loop.run_until_complete(asyncio.start_server(server.handle, "127.0.0.1", 0))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return f"http://127.0.0.1:{srv.sockets[0].getsockname()[1]}"
+
+
+async def main(url: str, samples: int, server: CountingServer | None):
+    for mode in ("requests", "transport"):
+        r = await run_mode(mode, url, samples, server)
+        conns = "n/a" if r["connections"] is None else r["connections"]
+        print(f"{mode:10s} p50 {r['p50_ms']:7.2f} ms  p99 {r['p99_ms']:7.2f} ms  "
+              f"max loop stall {r['max_stall_ms']:7.2f} ms  connections {conns}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--samples", type=int, default=500)
+    ap.add_argument("--latency", type=float, default=0.0, help="seconds the local server waits per request")
+    ap.add_argument("--api", default=None, help="post to a real server instead (connections are not counted)")
+    args = ap.parse_args()
+    server = None if args.api else CountingServer(args.latency)
+    asyncio.run(main(args.api or start_server(server), args.samples, server))
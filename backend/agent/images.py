@@ -0,0 +1,150 @@
+import os
+import time
+import shutil
+import asyncio
+from watchdog.events import FileSystemEventHandler
+
+# ---------------- IMAGE PIPELINE ----------------
+# watchdog thread -> pending (path -> last size/mtime) -> settle loop -> copy
+# queue -> COPY_WORKERS -> notify buffer -> one POST /images/batch per
+# NOTIFY_INTERVAL. The watchdog thread only hands the path to the loop, so a
+# burst of hundreds of photos never backs up the observer. A file is ready
+# once its size and mtime have stayed the same for SETTLE_TIME, instead of
+# sleeping a fixed amount per file. The copy queue is bounded: when the
+# workers fall behind, files wait in `pending` (just paths) rather than
+# piling up work. With an uploader, each copied file is also queued for
+# upload to the server's file store; a single worker sends them one at a
+# time under the uploader's bandwidth limit.
+SETTLE_TIME = 1.0
+SETTLE_POLL = 0.25
+COPY_WORKERS = int(os.getenv("IMAGE_COPY_WORKERS", "4"))
+COPY_QUEUE_MAX = 256
+COPY_RETRIES = 6
+NOTIFY_INTERVAL = 2.0
+NOTIFY_BATCH = 200          # server takes up to 1000 per batch
+NOTIFY_BACKLOG_MAX = 10000  # records kept while the API is unreachable
+UPLOAD_BACKLOG_MAX = 10000  # paths waiting for upload; beyond this new images are only recorded
+
+
+class ImagePipeline:
+    def __init__(self, transport, loop: asyncio.AbstractEventLoop, dest: str | None, extensions: set[str],
+                 uploader=None):
+        self.transport = transport
+        self.uploader = uploader
+        self.loop = loop
+        self.dest = dest
+        self.extensions = extensions
+        self.pending: dict[str, tuple[int, float, float]] = {}   # path -> (size, mtime, unchanged since)
+        self.copy_queue: asyncio.Queue = asyncio.Queue(maxsize=COPY_QUEUE_MAX)
+        self.records: list[dict] = []
+        self.upload_queue: asyncio.Queue = asyncio.Queue(maxsize=UPLOAD_BACKLOG_MAX)
+        self.copied = self.failed = self.notified = self.upload_failed = 0
+
+    # --- watchdog thread ---
+    def submit(self, path: str) -> None:
+        if os.path.splitext(path)[1].lower() in self.extensions:
+            self.loop.call_soon_threadsafe(self._track, path)
+
+    # --- event loop ---
+    def _track(self, path: str) -> None:
+        self.pending.setdefault(path, (-1, 0.0, 0.0))
+
+    def _stat_all(self, paths: list[str]) -> dict[str, tuple[int, float] | None]:
+        out = {}
+        for p in paths:
+            try:
+                st = os.stat(p)
+                out[p] = (st.st_size, st.st_mtime)
+            except OSError:
+                out[p] = None
+        return out
+
+    async def settle(self):
+        while True:
+            await asyncio.sleep(SETTLE_POLL)
+            if not self.pending:
+                continue
+            now = time.monotonic()
+            for path, st in (await asyncio.to_thread(self._stat_all, list(self.pending))).items():
+                if st is None:  # deleted or renamed before it settled
+                    self.pending.pop(path, None)
+                    continue
+                size, mtime, since = self.pending[path]
+                if (size, mtime) != st:
+                    self.pending[path] = (*st, now)
+                elif size > 0 and now - since >= SETTLE_TIME:
+                    del self.pending[path]
+                    await self.copy_queue.put((path, size))
+
+    def _copy(self, path: str, size: int) -> dict:
+        name = os.path.basename(path)
+        if self.dest:
+            os.makedirs(self.dest, exist_ok=True)
+            delay = 0.25
+            for attempt in range(COPY_RETRIES):
+                try:
+                    shutil.copy2(path, os.path.join(self.dest, name))
+                    break
+                except PermissionError:  # camera software still holds it (Windows)
+                    if attempt == COPY_RETRIES - 1:
+                        raise
+                    time.sleep(delay)
+                    delay *= 2
+        return {"filename": name, "size": size, "created": os.path.getctime(path)}
+
+    async def copy_worker(self):
+        while True:
+            path, size = await self.copy_queue.get()
+            try:
+                record = await asyncio.to_thread(self._copy, path, size)
+                self.copied += 1
+                if len(self.records) < NOTIFY_BACKLOG_MAX:
+                    self.records.append(record)
+                if self.uploader and not self.upload_queue.full():
+                    self.upload_queue.put_nowait(path)
+            except Exception as e:
+                self.failed += 1
+                print(f"image copy failed for {path}: {e}")
+
+    async def notify(self):
+        while True:
+            await asyncio.sleep(NOTIFY_INTERVAL)
+            while self.records:
+                batch = self.records[:NOTIFY_BATCH]
+                r = await self.transport.images_batch(batch)
+                if r is None or r.status_code >= 500:
+                    break  # keep them for the next round
+                if not r.is_success:
+                    print(f"image batch rejected ({r.status_code}), dropping {len(batch)} records")
+                else:
+                    self.notified += len(batch)
+                del self.records[:len(batch)]
+
+    async def upload_worker(self):
+        while True:
+            path = await self.upload_queue.get()
+            try:
+                await self.uploader.upload(path, kind="image")
+            except Exception as e:
+                self.upload_failed += 1
+                print(f"image upload failed for {path}: {e}")
+
+    def tasks(self) -> list[asyncio.Task]:
+        tasks = ([asyncio.create_task(self.settle()), asyncio.create_task(self.notify())]
+                 + [asyncio.create_task(self.copy_worker()) for _ in range(COPY_WORKERS)])
+        if self.uploader:
+            tasks.append(asyncio.create_task(self.upload_worker()))
+        return tasks
+
+
+class ImageHandler(FileSystemEventHandler):
+    def __init__(self, pipeline: ImagePipeline):
+        self.pipeline = pipeline
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.pipeline.submit(event.src_path)
+
+    def on_moved(self, event):  # apps that write to a temp name and rename when done
+        if not event.is_directory:
+            self.pipeline.submit(event.dest_path)
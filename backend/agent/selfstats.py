@@ -0,0 +1,53 @@
+import os
+import time
+import asyncio
+import psutil
+
+# ---------------- SELF TELEMETRY ----------------
+# What the agent itself costs the machine, sent as details["agent"] with
+# every metrics sample: process CPU % since the previous sample (the same
+# non-blocking delta the Collector uses), RSS, how late the event loop woke
+# a sleeping task (a blocked loop delays sockets, heartbeats and uploads),
+# and how long sampling and shell commands took. Maxima and counts cover the
+# window since the previous sample, so a spike is reported once. Recording
+# is a few additions; the psutil reads happen once per sample.
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "1"))
+
+
+class SelfStats:
+    def __init__(self):
+        self.proc = psutil.Process()
+        self.proc.cpu_percent(interval=None)  # prime the delta
+        self.cpus = psutil.cpu_count() or 1
+        self._reset()
+
+    def _reset(self) -> None:
+        self.lag_max = 0.0
+        self.collect_ms = 0.0
+        self.shell_count = 0
+        self.shell_max = 0.0
+
+    def collected(self, secs: float) -> None:
+        self.collect_ms = secs * 1000
+
+    def shell(self, secs: float) -> None:
+        self.shell_count += 1
+        self.shell_max = max(self.shell_max, secs)
+
+    async def watch_loop(self, interval: float = LOOP_LAG_INTERVAL):
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.lag_max = max(self.lag_max, time.perf_counter() - t0 - interval)
+
+    def snapshot(self) -> dict:
+        """details["agent"] for the next sample; starts a new window."""
+        with self.proc.oneshot():
+            # psutil reports % of one core; divide so it compares with the machine's cpu
+            cpu = self.proc.cpu_percent(interval=None) / self.cpus
+            rss = self.proc.memory_info().rss
+        out = {"cpu_pct": round(cpu, 2), "rss_mb": round(rss / 1048576, 1),
+               "loop_lag_ms": round(self.lag_max * 1000, 1), "collect_ms": round(self.collect_ms, 2),
+               "shells": self.shell_count, "shell_max_s": round(self.shell_max, 2)}
+        self._reset()
+        return out
@@ -0,0 +1,77 @@
+import os
+import json
+import sqlite3
+import threading
+
+# ---------------- METRICS SPOOL ----------------
+# Samples are appended to a small SQLite file first and uploaded from there,
+# so an unreachable API only delays telemetry instead of dropping it. The
+# spool is capped at SPOOL_MAX_MB of sample data; past that the oldest samples
+# are evicted first (recent data matters more once the server is back).
+SPOOL_FILE = os.getenv("SPOOL_FILE", "./metrics_spool.db")
+SPOOL_MAX_MB = float(os.getenv("SPOOL_MAX_MB", "50"))
+EVICT_BATCH = 500
+
+
+class Spool:
+    def __init__(self, path: str = SPOOL_FILE, max_bytes: int = int(SPOOL_MAX_MB * 1024 * 1024)):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")  # only takes effect on a new file
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS samples (id INTEGER PRIMARY KEY, body TEXT NOT NULL)")
+        self.size = self.db.execute("SELECT coalesce(sum(length(body)), 0) FROM samples").fetchone()[0]
+        self.evicted = 0
+
+    def append(self, sample: dict) -> None:
+        body = json.dumps(sample, separators=(",", ":"))
+        with self.lock:
+            self.db.execute("INSERT INTO samples (body) VALUES (?)", (body,))
+            self.size += len(body)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes:
+            rows = self.db.execute("SELECT id, length(body) FROM samples ORDER BY id LIMIT ?",
+                                   (EVICT_BATCH,)).fetchall()
+            if not rows:
+                self.size = 0
+                return
+            # just enough of the oldest rows to get back under the cap
+            drop, last_id, count = 0, None, 0
+            for row_id, n in rows:
+                drop += n
+                last_id = row_id
+                count += 1
+                if self.size - drop <= self.max_bytes:
+                    break
+            self.db.execute("DELETE FROM samples WHERE id <= ?", (last_id,))
+            self.size -= drop
+            self.evicted += count
+        self.db.execute("PRAGMA incremental_vacuum")
+
+    def peek(self, limit: int) -> tuple[int | None, list[dict]]:
+        """Oldest `limit` samples and the id to pass to ack() once they are uploaded."""
+        with self.lock:
+            rows = self.db.execute("SELECT id, body FROM samples ORDER BY id LIMIT ?", (limit,)).fetchall()
+        if not rows:
+            return None, []
+        return rows[-1][0], [json.loads(body) for _, body in rows]
+
+    def ack(self, last_id: int) -> None:
+        with self.lock:
+            n = self.db.execute("SELECT coalesce(sum(length(body)), 0) FROM samples WHERE id <= ?",
+                                (last_id,)).fetchone()[0]
+            self.db.execute("DELETE FROM samples WHERE id <= ?", (last_id,))
+            self.size -= n
+
+    def pending(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT count(*) FROM samples").fetchone()[0]
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,81 @@
+import gzip
+import json
+import httpx
+
+import wire
+
+# ---------------- HTTP TRANSPORT ----------------
+# One pooled keep-alive client for everything the agent posts after it has
+# registered: metrics, heartbeat, command status, image records and file
+# uploads.
+# Connections are reused across calls (no handshake per sample) and the pool
+# size bounds how many requests are in flight at once; extra callers wait up
+# to POOL_TIMEOUT for a free connection instead of opening more.
+MAX_CONNECTIONS = 4
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 10.0
+POOL_TIMEOUT = 10.0
+KEEPALIVE_EXPIRY = 60.0   # a bit longer than the metrics interval so the socket survives between samples
+
+
+class Transport:
+    def __init__(self, base_url: str, token: str, max_connections: int = MAX_CONNECTIONS):
+        self.compact = wire.msgpack is not None  # dropped for good if the server turns it down
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            headers={"Authorization": f"Bearer {token}"},
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                                keepalive_expiry=KEEPALIVE_EXPIRY),
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT, pool=POOL_TIMEOUT),
+        )
+
+    async def post(self, path: str, **kwargs) -> httpx.Response | None:
+        """POST and return the response, or None if the server could not be reached."""
+        try:
+            return await self.client.post(path, **kwargs)
+        except httpx.HTTPError as e:
+            print(f"POST {path} failed: {e!r}")
+            return None
+
+    async def metrics(self, sample: dict):
+        return await self.post("/metrics", json=sample)
+
+    async def metrics_batch(self, samples: list[dict]):
+        if self.compact:
+            r = await self.post("/metrics/batch", content=gzip.compress(wire.encode_batch(samples), compresslevel=6),
+                                headers={"Content-Type": wire.CONTENT_TYPE, "Content-Encoding": "gzip"})
+            # 415, or 422 from a server that predates the format and parsed it as JSON
+            if r is None or r.status_code not in (415, 422):
+                return r
+        body = gzip.compress(json.dumps(samples, separators=(",", ":")).encode(), compresslevel=6)
+        r = await self.post("/metrics/batch", content=body,
+                            headers={"Content-Type": "application/json", "Content-Encoding": "gzip"})
+        if self.compact and r is not None and r.is_success:
+            print("server does not take compact metric batches, using JSON")
+            self.compact = False
+        return r
+
+    async def heartbeat(self):
+        return await self.post("/heartbeat")
+
+    async def command_status(self, cmd_id: int, body: dict):
+        return await self.post(f"/commands/{cmd_id}/status", json=body)
+
+    async def images_batch(self, records: list[dict]):
+        return await self.post("/images/batch", json=records)
+
+    async def upload_start(self, body: dict):
+        return await self.post("/uploads", json=body)
+
+    async def upload_chunk(self, upload_id: str, offset: int, content, length: int):
+        """PUT `length` bytes from the async iterator `content` at `offset`; None if the server was unreachable."""
+        try:
+            return await self.client.put(f"/uploads/{upload_id}", content=content, headers={
+                "Upload-Offset": str(offset), "Content-Length": str(length),
+                "Content-Type": "application/octet-stream"})
+        except httpx.HTTPError as e:
+            print(f"PUT /uploads/{upload_id} failed at {offset}: {e!r}")
+            return None
+
+    async def aclose(self):
+        await self.client.aclose()
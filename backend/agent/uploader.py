@@ -0,0 +1,117 @@
+import os
+import time
+import random
+import asyncio
+import hashlib
+
+# ---------------- FILE UPLOADS ----------------
+# POST /uploads with the file's sha256 and size: the server answers "exists"
+# (same content already stored, nothing to send) or the offset to continue
+# from. Chunks of the size it suggests are then PUT at that offset, each one
+# streamed from disk READ_SIZE bytes at a time, so memory use does not depend
+# on the file size. After a network error or a restart of either side the
+# upload starts again from the last chunk the server acknowledged, not from
+# byte 0. All uploads share one token bucket (UPLOAD_BANDWIDTH_KBPS, 0 = no
+# limit) so pictures going up do not saturate a shop's uplink.
+READ_SIZE = 64 * 1024
+UPLOAD_BANDWIDTH_KBPS = float(os.getenv("UPLOAD_BANDWIDTH_KBPS", "0"))
+UPLOAD_RETRIES = 8          # consecutive failures without progress before giving up
+BACKOFF_BASE = 2
+BACKOFF_MAX = 300
+
+
+class UploadFailed(Exception):
+    pass
+
+
+class RateLimiter:
+    """Token bucket in bytes; take() waits until the bytes may be sent."""
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.burst = burst or max(rate / 4, READ_SIZE)   # at most a quarter second ahead of the rate
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    async def take(self, n: int) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= n
+        if self.tokens < 0:  # in debt: sleep it off (concurrent callers queue behind each other)
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+def sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Uploader:
+    def __init__(self, transport, bandwidth_kbps: float = UPLOAD_BANDWIDTH_KBPS):
+        self.transport = transport
+        self.limiter = RateLimiter(bandwidth_kbps * 1024) if bandwidth_kbps > 0 else None
+        self.uploaded = self.deduped = self.resumed = self.bytes_sent = 0
+
+    async def _read(self, path: str, offset: int, length: int):
+        """Stream `length` bytes of the file starting at `offset`, paced by the limiter."""
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while length > 0:
+                data = await asyncio.to_thread(f.read, min(READ_SIZE, length))
+                if not data:
+                    raise UploadFailed(f"{path} shrank while uploading")
+                if self.limiter:
+                    await self.limiter.take(len(data))
+                length -= len(data)
+                self.bytes_sent += len(data)
+                yield data
+
+    async def upload(self, path: str, kind: str = "file", command_id: int | None = None) -> dict:
+        """Upload a file unless the server already has its content. Returns sha256, size and bytes sent."""
+        size = os.path.getsize(path)
+        sha = await asyncio.to_thread(sha256_file, path)
+        start = {"sha256": sha, "size": size, "path": path, "kind": kind, "command_id": command_id}
+        sent, failures, delay = 0, 0, BACKOFF_BASE
+        while failures < UPLOAD_RETRIES:
+            r = await self.transport.upload_start(start)
+            if r is not None and r.status_code < 500 and not r.is_success:
+                raise UploadFailed(f"server refused upload ({r.status_code}): {r.text}")
+            if r is not None and r.is_success:
+                res = r.json()
+                if res["status"] == "exists":
+                    self.deduped += sent == 0
+                    self.uploaded += sent > 0
+                    return {"sha256": sha, "size": size, "sent": sent}
+                upload_id, offset, chunk = res["upload_id"], res["offset"], res["chunk_size"]
+                if offset and not sent:
+                    self.resumed += 1
+                while True:  # the server finishes the upload on the chunk that reaches `size` (even an empty one)
+                    n = min(chunk, size - offset)
+                    r = await self.transport.upload_chunk(upload_id, offset, self._read(path, offset, n), n)
+                    if r is None or r.status_code >= 500 or r.status_code == 404:
+                        break  # ask for the offset again after a pause
+                    body = r.json()
+                    if r.status_code == 409 and body.get("offset") is not None:
+                        offset = body["offset"]  # server has a different amount than we thought
+                        continue
+                    if r.status_code == 409:
+                        break  # busy: an earlier request of ours still holds the upload; retry after a pause
+                    if not r.is_success:
+                        raise UploadFailed(f"chunk rejected ({r.status_code}): {body.get('detail')}")
+                    sent += n
+                    failures, delay = 0, BACKOFF_BASE
+                    if body["status"] == "done":
+                        self.uploaded += 1
+                        return {"sha256": sha, "size": size, "sent": sent}
+                    offset = body["offset"]
+            failures += 1
+            await asyncio.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, BACKOFF_MAX)
+        raise UploadFailed(f"gave up on {path} after {UPLOAD_RETRIES} attempts")
+
+    def stats(self) -> dict:
+        return {"uploaded": self.uploaded, "deduped": self.deduped, "resumed": self.resumed,
+                "bytes_sent": self.bytes_sent}
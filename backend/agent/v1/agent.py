@@ -1,10 +1,15 @@
-import asyncio, json, os, platform, socket, time, base64, subprocess, sys
+import asyncio, json, os, platform, socket, time, base64, subprocess, sys, codecs
 import psutil, requests, websockets
+from collections import deque
 
 API_URL = os.getenv("API_URL", "http://localhost:8000")
 WS_URL  = os.getenv("WS_URL",  "ws://localhost:8000")
 TOKEN_FILE = os.getenv("TOKEN_FILE", "./agent_token.txt")
 AGENT_VERSION = "0.1.0"
+MAX_CONCURRENT_COMMANDS = int(os.getenv("MAX_CONCURRENT_COMMANDS", "4"))
+COMMAND_TIMEOUT = 600
+OUTPUT_CHUNK = 4096      # bytes per streamed output message
+OUTPUT_TAIL = 65536      # unsent output kept for the status POST if the socket drops mid-command
 
 def read_token():
     if os.path.exists(TOKEN_FILE):
@@ -46,12 +51,55 @@ def collect_metrics():
     }
     return dict(cpu=cpu, mem=mem, disk=disk, uptime_sec=uptime, battery_pct=battery_pct, details=details)
 
-def run_shell(cmd: str) -> tuple[int,str]:
+class Channel:
+    """The current WS connection; commands outlive reconnects and keep sending through it."""
+    def __init__(self):
+        self.ws = None
+
+    async def send(self, obj) -> bool:
+        ws = self.ws
+        if ws is None: return False
+        try:
+            await ws.send(json.dumps(obj)); return True
+        except Exception:
+            return False
+
+async def run_shell(cmd: str, cmd_id: int, chan: Channel) -> tuple[int,str|None]:
+    """Run without blocking the loop, streaming stdout/stderr as they come. Returns (rc, rest).
+
+    The server appends whatever arrives, so after the first failed send nothing more is streamed:
+    `rest` is the output from that point on (None if everything went out), which the status POST
+    appends after what was streamed."""
+    proc = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    unsent = deque(); state = {"size": 0, "failed": False}
+    lock = asyncio.Lock()  # one send at a time, so "after the failed send" is the same for both streams
+
+    def keep(text):
+        unsent.append(text); state["size"] += len(text)
+        while state["size"] > OUTPUT_TAIL and len(unsent) > 1:
+            state["size"] -= len(unsent.popleft())
+
+    async def pump(stream, name):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")  # characters split across reads
+        while True:
+            data = await stream.read(OUTPUT_CHUNK)
+            text = decoder.decode(data, final=not data)
+            if not text:
+                if not data: return
+                continue
+            async with lock:
+                if not state["failed"] and await chan.send({"type": "output", "cmd_id": cmd_id, "stream": name, "data": text}):
+                    continue
+                state["failed"] = True
+                keep(text)
+
     try:
-        out = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=600)
-        return out.returncode, (out.stdout + "\n" + out.stderr).strip()
-    except Exception as e:
-        return 1, f"error: {e}"
+        await asyncio.wait_for(asyncio.gather(pump(proc.stdout, "stdout"), pump(proc.stderr, "stderr"), proc.wait()),
+                               COMMAND_TIMEOUT)
+    except asyncio.TimeoutError:
+        proc.kill(); await proc.wait()
+        state["failed"] = True; keep(f"\ntimed out after {COMMAND_TIMEOUT}s")  # alone if all output went out
+    return proc.returncode, "".join(unsent) if state["failed"] else None
 
 def do_restart():
     if platform.system() == "Windows":
@@ -65,54 +113,69 @@ def do_shutdown():
     else:
         subprocess.Popen("shutdown -h now", shell=True)
 
+async def run_command(token: str, data: dict, chan: Channel, slots: asyncio.Semaphore):
+    cmd_id = data["cmd_id"]; kind = data["kind"]; payload = data.get("payload") or ""
+    body = {"status": "done"}
+    async with slots:
+        try:
+            if kind in ("shell", "script"):
+                if kind == "script":
+                    # payload can be a base64 script text to run with /bin/bash or powershell
+                    script = base64.b64decode(payload).decode("utf-8", errors="ignore")
+                    if platform.system() == "Windows":
+                        # run via powershell
+                        payload = f'powershell -NoProfile -Command "{script}"'
+                    else:
+                        payload = f"/bin/bash -lc '{script}'"
+                rc, rest = await run_shell(payload, cmd_id, chan)
+                body["exit_code"] = rc
+                if rest is not None:  # output the socket never took, or the timeout notice
+                    body["result"] = rest
+            elif kind == "restart":
+                body["result"] = "restarting"; do_restart()
+            elif kind == "shutdown":
+                body["result"] = "shutting down"; do_shutdown()
+            else:
+                body = {"status": "error", "result": f"unknown kind: {kind}"}
+        except Exception as e:
+            body = {"status": "error", "result": f"exception: {e}"}
+
+    try:
+        await asyncio.to_thread(requests.post, f"{API_URL}/commands/{cmd_id}/status",
+                                headers={"Authorization": f"Bearer {token}"}, json=body, timeout=10)
+    except Exception:
+        pass
+
 async def ws_loop(token: str, device_id: int):
     url = f"{WS_URL}/ws/agent/{device_id}"
     headers = [("Authorization", f"Bearer {token}")]
+    seen = deque(maxlen=500)  # server redelivers unacked commands; run each one once
+    chan = Channel(); slots = asyncio.Semaphore(MAX_CONCURRENT_COMMANDS); running = set()
     while True:
         try:
             async with websockets.connect(url, extra_headers=headers, ping_interval=20, ping_timeout=20) as ws:
+                chan.ws = ws
                 await ws.send("hello")
                 while True:
                     msg = await ws.recv()
                     data = json.loads(msg)
-                    cmd_id = data["cmd_id"]; kind = data["kind"]; payload = data.get("payload") or ""
-                    status = "done"; result = ""
-                    try:
-                        if kind == "shell":
-                            rc, out = run_shell(payload)
-                            result = f"rc={rc}\n{out}"
-                        elif kind == "restart":
-                            result = "restarting"; do_restart()
-                        elif kind == "shutdown":
-                            result = "shutting down"; do_shutdown()
-                        elif kind == "script":
-                            # payload can be a base64 script text to run with /bin/bash or powershell
-                            script = base64.b64decode(payload).decode("utf-8", errors="ignore")
-                            if platform.system() == "Windows":
-                                # run via powershell
-                                rc, out = run_shell(f'powershell -NoProfile -Command "{script}"')
-                            else:
-                                rc, out = run_shell(f"/bin/bash -lc '{script}'")
-                            result = f"rc={rc}\n{out}"
-                        else:
-                            status = "error"; result = f"unknown kind: {kind}"
-                    except Exception as e:
-                        status = "error"; result = f"exception: {e}"
-
-                    try:
-                        requests.post(f"{API_URL}/commands/{cmd_id}/status",
-                                      headers={"Authorization": f"Bearer {token}"},
-                                      json={"status": status, "result": result}, timeout=10)
-                    except Exception:
-                        pass
+                    cmd_id = data["cmd_id"]
+                    await ws.send(json.dumps({"type": "ack", "cmd_id": cmd_id}))
+                    if cmd_id in seen: continue
+                    seen.append(cmd_id)
+                    # run in the background so the socket keeps reading (and answering pings)
+                    task = asyncio.create_task(run_command(token, data, chan, slots))
+                    running.add(task); task.add_done_callback(running.discard)
         except Exception:
+            chan.ws = None
             await asyncio.sleep(5)
 
 async def metrics_loop(token: str):
     while True:
         try:
-            m = collect_metrics()
-            requests.post(f"{API_URL}/metrics", headers={"Authorization": f"Bearer {token}"}, json=m, timeout=10)
+            m = await asyncio.to_thread(collect_metrics)
+            await asyncio.to_thread(requests.post, f"{API_URL}/metrics", headers={"Authorization": f"Bearer {token}"},
+                                    json=m, timeout=10)
         except Exception:
             pass
         await asyncio.sleep(15)
@@ -129,14 +192,14 @@ def ensure_device_id(token: str) -> int:
     if os.path.exists(TOKEN_FILE) and ":" in open(TOKEN_FILE).read():
         t, did = open(TOKEN_FILE).read().split(":",1)
         if t == token: return int(did)
-    # re-register to fetch new device_id if missing
+    # fetch the device_id if missing; the token proves which device we are
     payload = {
         "hostname": socket.gethostname(),
         "os": f"{platform.system()} {platform.release()}",
         "arch": platform.machine(),
         "agent_version": AGENT_VERSION
     }
-    r = requests.post(f"{API_URL}/register", json=payload, timeout=10)
+    r = requests.post(f"{API_URL}/register", json=payload, headers={"Authorization": f"Bearer {token}"}, timeout=10)
     r.raise_for_status()
     data = r.json()
     open(TOKEN_FILE,"w").write(f"{data['token']}:{data['device_id']}")
@@ -0,0 +1,39 @@
+from datetime import datetime
+
+try:
+    import msgpack
+except ImportError:  # older installs: plain JSON batches only
+    msgpack = None
+
+# ---------------- COMPACT BATCH FORMAT ----------------
+# application/x-msgpack body for POST /metrics/batch:
+#   {"v": 1, "s": [[dts_ms, cpu, mem, disk, uptime_sec, battery_pct, set, removed?], ...]}
+# Samples are positional instead of keyed. dts_ms is the timestamp in epoch
+# milliseconds for the first sample and the difference to the previous one
+# after that. `set` holds only the details keys that changed since the
+# previous sample in the same batch (all of them for the first) or None when
+# nothing did; `removed`, if present, lists keys that disappeared. Each
+# batch decodes on its own, so the server keeps no per-agent state.
+CONTENT_TYPE = "application/x-msgpack"
+VERSION = 1
+
+
+def epoch_ms(ts) -> int:
+    if isinstance(ts, str):
+        ts = datetime.fromisoformat(ts.replace("Z", "+00:00")).timestamp()
+    return round(ts * 1000)
+
+
+def encode_batch(samples: list[dict]) -> bytes:
+    rows, prev_ts, prev = [], 0, {}
+    for s in samples:
+        ts = epoch_ms(s["ts"])
+        details = s.get("details") or {}
+        changed = {k: v for k, v in details.items() if k not in prev or prev[k] != v}
+        row = [ts - prev_ts, s["cpu"], s["mem"], s["disk"], s["uptime_sec"], s.get("battery_pct"), changed or None]
+        removed = [k for k in prev if k not in details]
+        if removed:
+            row.append(removed)
+        rows.append(row)
+        prev_ts, prev = ts, details
+    return msgpack.packb({"v": VERSION, "s": rows})
@@ -0,0 +1,116 @@
+import os, json, asyncio
+from typing import NamedTuple
+from .alerts import send_alert
+
+# --- threshold alerts ---
+# Ingest handlers only record each device's latest sample (observe()); run()
+# evaluates them every EVAL_INTERVAL seconds, off the request path. A rule
+# fires when its metric crosses `fire` and resolves only once it is back past
+# `clear`, so a value hovering at the threshold doesn't flap. Firing state
+# lives in Redis (alert:<rule>:<device_id>) so every worker agrees on it and
+# exactly one of them notifies for each transition. After a resolve the rule
+# is held for COOLDOWN seconds before it can fire again for that device.
+EVAL_INTERVAL = float(os.getenv("ALERT_EVAL_INTERVAL", "2"))
+COOLDOWN = int(os.getenv("ALERT_COOLDOWN", "600"))
+FIRING_TTL = int(os.getenv("ALERT_FIRING_TTL", "86400"))  # a still-firing alert is re-sent after this
+
+
+class Rule(NamedTuple):
+    name: str
+    field: str       # MetricIn attribute
+    fire: float
+    clear: float
+    above: bool = True   # fire when >= fire (False: when <= fire)
+    label: str = ""
+
+    def firing(self, v: float) -> bool:
+        return v >= self.fire if self.above else v <= self.fire
+
+    def cleared(self, v: float) -> bool:
+        return v < self.clear if self.above else v > self.clear
+
+
+DEFAULT_RULES = [
+    Rule("cpu_high", "cpu", 95, 85, label="CPU"),
+    Rule("mem_high", "mem", 95, 85, label="MEM"),
+    Rule("disk_high", "disk", 95, 90, label="DISK"),
+    Rule("battery_low", "battery_pct", 10, 20, above=False, label="Battery"),
+]
+
+
+def load_rules() -> list[Rule]:
+    """ALERT_RULES='[{"name": "cpu_high", "field": "cpu", "fire": 90, "clear": 80}, ...]' replaces the defaults."""
+    spec = os.getenv("ALERT_RULES")
+    if not spec:
+        return DEFAULT_RULES
+    return [Rule(**{"label": r.get("field", "").upper(), **r}) for r in json.loads(spec)]
+
+
+# fire unless already firing or cooling down
+_FIRE = """
+if redis.call('EXISTS', KEYS[2]) == 1 then return 0 end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then return 1 end
+return 0
+"""
+# resolve if firing, and start the cooldown
+_CLEAR = """
+if redis.call('DEL', KEYS[1]) == 1 then redis.call('SET', KEYS[2], 1, 'EX', ARGV[1]) return 1 end
+return 0
+"""
+
+
+def firing_key(rule: str, device_id: int) -> str:
+    return f"alert:{rule}:{device_id}"
+
+
+def cooldown_key(rule: str, device_id: int) -> str:
+    return f"alert:cooldown:{rule}:{device_id}"
+
+
+class AlertEngine:
+    def __init__(self, redis, rules: list[Rule] | None = None, notify=send_alert):
+        self.redis = redis   # async client
+        self.rules = rules if rules is not None else load_rules()
+        self.notify = notify
+        self.latest: dict[int, tuple[str, object]] = {}  # device_id -> (hostname, newest sample)
+        self.fired = self.resolved = 0
+
+    def observe(self, device_id: int, hostname: str, m) -> None:
+        self.latest[device_id] = (hostname, m)
+
+    async def evaluate(self) -> None:
+        latest, self.latest = self.latest, {}
+        checks = []
+        pipe = self.redis.pipeline(transaction=False)
+        for device_id, (hostname, m) in latest.items():
+            for rule in self.rules:
+                v = getattr(m, rule.field, None)
+                if v is None:
+                    continue
+                keys = (firing_key(rule.name, device_id), cooldown_key(rule.name, device_id))
+                if rule.firing(v):
+                    pipe.eval(_FIRE, 2, *keys, round(v, 1), FIRING_TTL)
+                elif rule.cleared(v):
+                    pipe.eval(_CLEAR, 2, *keys, COOLDOWN)
+                else:
+                    continue  # between clear and fire: keep whatever state it has
+                checks.append((rule, hostname, v, rule.firing(v)))
+        if not checks:
+            return
+        for (rule, hostname, v, fire), changed in zip(checks, await pipe.execute()):
+            if not changed:
+                continue
+            if fire:
+                self.fired += 1
+                self.notify(f"⚠️ {hostname} threshold", f"{rule.label} {v:.0f}%")
+            else:
+                self.resolved += 1
+                self.notify(f"✅ {hostname} recovered", f"{rule.label} back to {v:.0f}%")
+
+    async def run(self, interval: float = EVAL_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.evaluate()
+            except Exception as e:
+                print(f"alert evaluation error: {e}")
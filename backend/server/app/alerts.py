@@ -1,11 +1,106 @@
-import os, json, requests
+import os, json, time, asyncio, requests
+from email.utils import parsedate_to_datetime
+from .telemetry import alert_lag
+
+# --- alert delivery ---
+# send_alert() only queues; AlertDispatcher.run() drains the queue in the
+# background. Alerts that arrive within BATCH_WINDOW of each other go out as
+# one Slack message, messages are paced to RATE_PER_SEC (Slack webhooks allow
+# about one a second), and failed posts are retried with backoff, honouring
+# Retry-After on 429. Nothing here ever blocks an ingest request.
 SLACK_WEBHOOK = os.getenv("SLACK_WEBHOOK_URL")
+QUEUE_MAX = int(os.getenv("ALERT_QUEUE_MAX", "1000"))
+BATCH_WINDOW = float(os.getenv("ALERT_BATCH_WINDOW", "2"))
+BATCH_MAX = 20                   # alerts per Slack message
+RATE_PER_SEC = float(os.getenv("ALERT_RATE_PER_SEC", "1"))
+MAX_RETRIES = 5
+MAX_DELAY = 60                   # seconds; also caps a server's Retry-After
+POST_TIMEOUT = 5
 
-def send_alert(title: str, text: str):
-    if not SLACK_WEBHOOK:
-        return
-    payload = {"text": f"*{title}*\n{text}"}
+
+def retry_after(value: str | None, default: float) -> float:
+    """Seconds to wait from a Retry-After header: delta-seconds or an HTTP-date, else `default`."""
+    if not value:
+        return default
     try:
-        requests.post(SLACK_WEBHOOK, data=json.dumps(payload), headers={"Content-Type":"application/json"}, timeout=5)
-    except Exception:
-        pass
+        secs = float(value)
+    except ValueError:
+        try:
+            secs = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return default
+    return min(secs, MAX_DELAY) if secs > 0 else 0.0  # also catches nan
+
+
+class AlertDispatcher:
+    def __init__(self, webhook: str | None = SLACK_WEBHOOK, queue_max: int = QUEUE_MAX):
+        self.webhook = webhook
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_max)
+        self.session = requests.Session()
+        self.next_slot = 0.0
+        self.sent = self.dropped = self.failed = 0
+
+    def send(self, title: str, text: str) -> None:
+        """Queue an alert (from the event loop thread). Drops it if the queue is full."""
+        if not self.webhook:
+            return
+        try:
+            self.queue.put_nowait((title, text, time.monotonic()))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def _post(self, payload: dict) -> requests.Response:
+        return self.session.post(self.webhook, data=json.dumps(payload),
+                                 headers={"Content-Type": "application/json"}, timeout=POST_TIMEOUT)
+
+    async def _deliver(self, batch: list[tuple[str, str, float]]) -> None:
+        text = "\n".join(f"*{title}*\n{body}" for title, body, _ in batch)
+        delay = 1.0
+        for attempt in range(MAX_RETRIES):
+            # pace messages; the wait is on this task only
+            wait = self.next_slot - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.next_slot = time.monotonic() + 1 / RATE_PER_SEC
+            try:
+                r = await asyncio.to_thread(self._post, {"text": text})
+                if r.status_code < 300:
+                    self.sent += len(batch)
+                    now = time.monotonic()
+                    for _, _, queued in batch:
+                        alert_lag.observe(now - queued)
+                    return
+                if r.status_code == 429:
+                    delay = retry_after(r.headers.get("Retry-After"), delay)
+                elif r.status_code < 500:  # won't get better by retrying
+                    print(f"alert webhook rejected message: {r.status_code} {r.text[:200]}")
+                    break
+            except requests.RequestException as e:
+                print(f"alert webhook error: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_DELAY)
+        self.failed += len(batch)
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = time.monotonic() + BATCH_WINDOW
+            while len(batch) < BATCH_MAX and (left := deadline - time.monotonic()) > 0:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), left))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._deliver(batch)
+            except Exception as e:
+                print(f"alert delivery error: {e}")
+
+    def stats(self) -> dict:
+        return {"queued": self.queue.qsize(), "sent": self.sent, "dropped": self.dropped, "failed": self.failed}
+
+
+dispatcher = AlertDispatcher()
+
+
+def send_alert(title: str, text: str):
+    dispatcher.send(title, text)
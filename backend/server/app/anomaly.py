@@ -0,0 +1,159 @@
+import os, math, time, asyncio
+from array import array
+from .alerts import send_alert
+from .ingest import utc_naive
+from .presence import to_epoch
+
+# --- streaming anomaly detection ---
+# Every ingested sample updates a few running statistics per device, in O(1)
+# time and memory and without reading history back from Postgres:
+#   * cpu / mem: EWMA mean and variance; a sample far outside the usual band
+#     (more than Z_SCORE deviations and MIN_DELTA points) is a spike.
+#   * disk / mem: an exponentially weighted least-squares line over the last
+#     few hours (time constant DISK_TAU / MEM_TAU). Disk predicts time-to-full,
+#     mem flags a steady climb (a leak) above MEM_CREEP %/h.
+# State is struct-of-arrays: one flat array('d') per statistic, indexed by a
+# per-device slot, so 50k devices are a few MB rather than 50k objects.
+# It lives in the worker process; with several workers each one sees its share
+# of a device's samples, which still gives usable (if noisier) statistics.
+# Findings are queued and sent by run(), which dedupes across workers with a
+# Redis key per (device, kind) held for COOLDOWN seconds.
+ALPHA = float(os.getenv("ANOMALY_ALPHA", "0.02"))            # ~50 samples of memory
+Z_SCORE = float(os.getenv("ANOMALY_Z", "4"))
+MIN_DELTA = float(os.getenv("ANOMALY_MIN_DELTA", "15"))      # percentage points
+WARMUP = 30                                                  # samples before spikes count
+DISK_TAU = float(os.getenv("ANOMALY_DISK_TAU_HOURS", "6"))
+MEM_TAU = float(os.getenv("ANOMALY_MEM_TAU_HOURS", "2"))
+DISK_FULL_HOURS = float(os.getenv("ANOMALY_DISK_FULL_HOURS", "24"))
+MEM_CREEP = float(os.getenv("ANOMALY_MEM_CREEP_PER_HOUR", "3"))
+MIN_SPAN_HOURS = 0.5          # trend needs at least this much (weighted) time spread
+COOLDOWN = int(os.getenv("ANOMALY_COOLDOWN", "3600"))
+EMIT_INTERVAL = 5.0
+
+EWMA = ("cpu", "mem")
+TREND = {"disk": DISK_TAU, "mem": MEM_TAU}
+_SUMS = ("w", "t", "y", "tt", "ty")
+
+
+class AnomalyDetector:
+    def __init__(self, redis=None, notify=send_alert):
+        self.redis = redis   # async client, for cross-worker dedup (None: local only)
+        self.notify = notify
+        self.slots: dict[int, int] = {}
+        self.hostnames: list[str] = []
+        self.n = array("l")
+        self.last_ts = array("d")
+        self.mean = {k: array("d") for k in EWMA}
+        self.var = {k: array("d") for k in EWMA}
+        # regression sums with the origin at the device's latest sample
+        self.sums = {k: {s: array("d") for s in _SUMS} for k in TREND}
+        self.pending: dict[tuple[int, str], str] = {}
+        self.quiet_until: dict[tuple[int, str], float] = {}  # local cooldown when there is no Redis
+        self.emitted = 0
+
+    def _slot(self, device_id: int, hostname: str) -> int:
+        i = self.slots.get(device_id)
+        if i is None:
+            i = self.slots[device_id] = len(self.hostnames)
+            self.hostnames.append(hostname)
+            self.n.append(0)
+            self.last_ts.append(0.0)
+            for k in EWMA:
+                self.mean[k].append(0.0); self.var[k].append(0.0)
+            for sums in self.sums.values():
+                for a in sums.values():
+                    a.append(0.0)
+        return i
+
+    def observe(self, device_id: int, hostname: str, samples: list) -> None:
+        i = self._slot(device_id, hostname)
+        now = time.time()
+        for m in samples:
+            self._update(i, device_id, m, to_epoch(utc_naive(m.ts)) if m.ts else now)
+
+    def _update(self, i: int, device_id: int, m, ts: float) -> None:
+        n = self.n[i] = self.n[i] + 1
+        for k in EWMA:
+            x = getattr(m, k)
+            mean, var = self.mean[k][i], self.var[k][i]
+            if n == 1:
+                self.mean[k][i], self.var[k][i] = x, 0.0
+                continue
+            diff = x - mean
+            if n > WARMUP and abs(diff) > max(MIN_DELTA, Z_SCORE * math.sqrt(var)):
+                self.pending[(device_id, f"{k}_spike")] = (
+                    f"{k.upper()} {x:.0f}% vs usual {mean:.0f}±{math.sqrt(var):.0f}%")
+            incr = ALPHA * diff
+            self.mean[k][i] = mean + incr
+            self.var[k][i] = (1 - ALPHA) * (var + diff * incr)
+
+        dt = (ts - self.last_ts[i]) / 3600 if n > 1 else 0.0
+        if dt < 0:
+            return  # late sample: fine for the averages, but the line only moves forward
+        self.last_ts[i] = ts
+        for k, tau in TREND.items():
+            slope, level = self._fit(i, k, dt, tau, getattr(m, k))
+            if slope is None:
+                continue
+            if k == "disk" and slope > 0:
+                hours = (100 - level) / slope
+                if hours < DISK_FULL_HOURS:
+                    self.pending[(device_id, "disk_filling")] = (
+                        f"DISK {level:.0f}% and rising {slope:.2f}%/h, full in ~{hours:.0f}h")
+            elif k == "mem" and slope > MEM_CREEP:
+                self.pending[(device_id, "mem_creep")] = f"MEM {level:.0f}% and climbing {slope:.1f}%/h"
+
+    def _fit(self, i: int, k: str, dt: float, tau: float, y: float):
+        """Decay the sums, move their origin to the new sample, add it; return (slope %/h, fitted level)."""
+        s = self.sums[k]
+        decay = math.exp(-dt / tau)
+        w, t, sy = s["w"][i] * decay, s["t"][i] * decay, s["y"][i] * decay
+        tt, ty = s["tt"][i] * decay, s["ty"][i] * decay
+        # shift origin forward by dt: t -> t - dt
+        tt, ty, t = tt - 2 * dt * t + dt * dt * w, ty - dt * sy, t - dt * w
+        w += 1   # the new point sits at t = 0, so it adds nothing to t, tt or ty
+        sy += y
+        s["w"][i], s["t"][i], s["y"][i], s["tt"][i], s["ty"][i] = w, t, sy, tt, ty
+        spread = tt * w - t * t
+        if w < 5 or spread < (MIN_SPAN_HOURS * w) ** 2:
+            return None, None
+        slope = (w * ty - t * sy) / spread
+        return slope, (sy - slope * t) / w   # intercept at t = 0, i.e. now
+
+    async def emit(self) -> None:
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        items = list(pending.items())
+        if self.redis is not None:
+            pipe = self.redis.pipeline(transaction=False)
+            for (device_id, kind), _ in items:
+                pipe.set(f"anomaly:{kind}:{device_id}", 1, nx=True, ex=COOLDOWN)
+            items = [it for it, first in zip(items, await pipe.execute()) if first]
+        else:
+            now = time.monotonic()
+            items = [it for it in items if self.quiet_until.get(it[0], 0) <= now]
+            self.quiet_until.update((key, now + COOLDOWN) for key, _ in items)
+        for (device_id, kind), text in items:
+            self.emitted += 1
+            self.notify(f"📈 {self.hostnames[self.slots[device_id]]} {kind.replace('_', ' ')}", text)
+
+    def forget(self, device_id: int) -> None:
+        """Deleted device: reset its slot (slots are not reused)."""
+        i = self.slots.get(device_id)
+        if i is not None:
+            self.n[i] = 0
+            for sums in self.sums.values():
+                for a in sums.values():
+                    a[i] = 0.0
+
+    def stats(self) -> dict:
+        return {"devices": len(self.slots), "emitted": self.emitted}
+
+    async def run(self, interval: float = EMIT_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.emit()
+            except Exception as e:
+                print(f"anomaly emit error: {e}")
@@ -1,8 +1,9 @@
 import os, secrets
 from fastapi import Header, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from .models import Device
-from .schemas import DeviceResp
+from .cache import AgentRef, token_cache
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -15,21 +16,24 @@ if not ADMIN_TOKEN:
 def gen_token() -> str:
     return secrets.token_urlsafe(32)
 
-def require_agent(db: Session, authorization: str | None) -> Device:
+def bearer_token(authorization: str | None) -> str:
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(401, "Unauthorized")
-    tok = authorization.removeprefix("Bearer ").strip()
-    dev = db.query(Device).filter(Device.token == tok).first()
+    return authorization.removeprefix("Bearer ").strip()
+
+async def require_agent_async(db: AsyncSession, authorization: str | None) -> AgentRef:
+    tok = bearer_token(authorization)
+    ref = token_cache.get(tok)
+    if ref:
+        return ref
+    dev = (await db.execute(select(Device.id, Device.hostname).where(Device.token == tok))).first()
     if not dev:
         raise HTTPException(401, "Invalid token")
-    return dev
+    ref = AgentRef(dev.id, dev.hostname)
+    token_cache.put(tok, ref)
+    return ref
 
 def require_admin(authorization: str | None):
     if authorization != f"Bearer {ADMIN_TOKEN}":
         raise HTTPException(401, "Admin token invalid")
 
-
-def get_agent_by_hostname(db : Session, hostname : str) -> DeviceResp | None:
-
-    return db.query(Device).filter(Device.hostname == hostname).first()
-
@@ -0,0 +1,107 @@
+import os, json, time, asyncio, threading
+from collections import OrderedDict
+from typing import NamedTuple
+from .telemetry import redis_publish, timer
+
+# --- token -> device cache in front of require_agent_async's DB lookup ---
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "50000"))
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "300"))  # bounds staleness if an invalidation is missed
+INVALIDATE_CHANNEL = "token_invalidate"
+
+
+class AgentRef(NamedTuple):
+    id: int
+    hostname: str
+
+
+class TokenCache:
+    """Bounded LRU of token -> AgentRef with a per-entry TTL."""
+
+    def __init__(self, max_size: int = TOKEN_CACHE_SIZE, ttl: float = TOKEN_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, AgentRef]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def get(self, token: str) -> AgentRef | None:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(token)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._data[token]
+                self.misses += 1
+                return None
+            self._data.move_to_end(token)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, token: str, ref: AgentRef) -> None:
+        with self._lock:
+            self._data[token] = (time.monotonic() + self.ttl, ref)
+            self._data.move_to_end(token)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, token: str) -> None:
+        with self._lock:
+            if self._data.pop(token, None) is not None:
+                self.invalidations += 1
+
+    def invalidate_device(self, device_id: int) -> None:
+        # rare (delete / re-register), so a scan is cheaper than keeping a reverse index
+        with self._lock:
+            stale = [t for t, (_, ref) in self._data.items() if ref.id == device_id]
+            for t in stale:
+                del self._data[t]
+            self.invalidations += len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self._data), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else None,
+                "evictions": self.evictions, "invalidations": self.invalidations}
+
+
+token_cache = TokenCache()
+
+
+def publish_invalidation(redis, device_id: int) -> None:
+    """Drop the device locally and tell every other worker to do the same."""
+    token_cache.invalidate_device(device_id)
+    try:
+        with timer(redis_publish, "invalidate"):
+            redis.publish(INVALIDATE_CHANNEL, json.dumps({"device_id": device_id}))
+    except Exception as e:
+        print(f"token invalidation publish failed: {e}")
+
+
+async def listen_invalidations(aredis, cache: TokenCache = token_cache, on_device=None):
+    """Apply invalidations from every worker (this one included). `on_device(device_id)`, if given,
+    runs on the loop for each one, for other per-worker state of the device."""
+    while True:
+        pubsub = aredis.pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATE_CHANNEL)
+            # anything may have changed while we were not subscribed
+            cache.clear()
+            async for msg in pubsub.listen():
+                if msg.get("type") != "message":
+                    continue
+                device_id = int(json.loads(msg["data"])["device_id"])
+                cache.invalidate_device(device_id)
+                if on_device:
+                    on_device(device_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"token invalidation listener error: {e}")
+            await asyncio.sleep(2)
+        finally:
+            await pubsub.reset()
@@ -0,0 +1,51 @@
+import os, zlib
+from starlette.responses import PlainTextResponse
+
+# --- gzip request bodies ---
+# Agents upload spooled metric batches with Content-Encoding: gzip. This
+# inflates them before FastAPI parses the JSON, capped at MAX_BODY bytes on
+# both sides so a small compressed body can't expand into a huge one.
+MAX_BODY = int(float(os.getenv("MAX_REQUEST_BODY_MB", "16")) * 1024 * 1024)
+
+
+class GzipRequestMiddleware:
+    def __init__(self, app, max_body: int = MAX_BODY):
+        self.app = app
+        self.max_body = max_body
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or dict(scope["headers"]).get(b"content-encoding", b"").lower() != b"gzip":
+            return await self.app(scope, receive, send)
+
+        inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks, size, raw = [], 0, 0
+        try:
+            while True:
+                msg = await receive()
+                data = msg.get("body", b"")
+                raw += len(data)
+                out = inflate.decompress(data, self.max_body - size + 1)
+                size += len(out)
+                if raw > self.max_body or size > self.max_body or inflate.unconsumed_tail:
+                    return await PlainTextResponse("Request body too large", 413)(scope, receive, send)
+                chunks.append(out)
+                if not msg.get("more_body"):
+                    break
+            chunks.append(inflate.flush())
+        except zlib.error:
+            return await PlainTextResponse("Invalid gzip body", 400)(scope, receive, send)
+
+        body = b"".join(chunks)
+        headers = [(k, v) for k, v in scope["headers"] if k not in (b"content-encoding", b"content-length")]
+        # in place: outer middleware reads what the router later sets on this scope
+        scope["headers"] = headers + [(b"content-length", str(len(body)).encode())]
+        sent = False
+
+        async def replay():
+            nonlocal sent
+            if sent:
+                return await receive()
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        await self.app(scope, replay, send)
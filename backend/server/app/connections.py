@@ -0,0 +1,159 @@
+import os, json, time, asyncio
+from fastapi import WebSocket, WebSocketDisconnect, HTTPException
+from .db import AsyncSessionLocal
+from .auth import require_agent_async
+from .cache import AgentRef
+
+# --- agent WebSocket connections (this worker) ---
+# The upgrade is refused (403) unless the Authorization header carries the
+# token of the device in the path; the token cache answers that without a DB
+# query. Every connection gets a bounded outbound queue drained by its own
+# writer task, so a push never waits on a slow socket. An agent that lets its
+# queue fill up (WS_QUEUE_MAX) or a write time out is disconnected; its
+# unacked commands are redelivered when it reconnects. Drain-on-connect is the
+# exception: it may have more than WS_QUEUE_MAX commands for the device, so it
+# waits for room (put) instead. Dead peers are found by uvicorn's protocol
+# pings (--ws-ping-interval/--ws-ping-timeout), which every agent version
+# answers; only 0.2+ agents send a text heartbeat, so WS_IDLE_TIMEOUT (close a
+# socket that sent no message for that long) is off unless set, for fleets
+# with no older agents. Each exit path ends in release(), so no socket stays
+# registered.
+# Messages are small JSON, so per-message deflate is off on both ends (uvicorn
+# --ws-per-message-deflate false, agent compression=None): its zlib state was
+# most of a connection's memory and kept RSS creeping up as agents reconnected.
+QUEUE_MAX = int(os.getenv("WS_QUEUE_MAX", "256"))
+IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "0"))     # 0: off; 0.2+ agents heartbeat every 30 s
+SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+CLOSE_TIMEOUT = 2.0
+
+CLOSE_POLICY = 1008      # bad token
+CLOSE_TRY_AGAIN = 1013   # too slow to keep up
+CLOSE_REPLACED = 4000    # the device connected again
+
+
+class Connection:
+    __slots__ = ("device_id", "ws", "queue", "writer", "since", "closing")
+
+    def __init__(self, device_id: int, ws: WebSocket):
+        self.device_id = device_id
+        self.ws = ws
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_MAX)
+        self.writer: asyncio.Task | None = None
+        self.since = time.time()
+        self.closing = False
+
+
+class ConnectionManager:
+    def __init__(self, session_factory=AsyncSessionLocal):
+        self.session_factory = session_factory
+        self.conns: dict[int, Connection] = {}
+        self.accepted = self.rejected = self.replaced = self.idle_closed = self.slow_closed = self.sent = 0
+        self._closing: set[asyncio.Task] = set()  # the loop holds tasks only weakly
+
+    async def authenticate(self, ws: WebSocket, device_id: int) -> AgentRef | None:
+        """Check the upgrade's bearer token; refuses the handshake and returns None if it is not this device's."""
+        try:
+            async with self.session_factory() as db:  # only checks out a DB connection on a cache miss
+                ref = await require_agent_async(db, ws.headers.get("authorization"))
+        except HTTPException:
+            ref = None
+        if ref is None or ref.id != device_id:
+            self.rejected += 1
+            await ws.close(code=CLOSE_POLICY)
+            return None
+        return ref
+
+    def open(self, device_id: int, ws: WebSocket) -> Connection:
+        conn = Connection(device_id, ws)
+        old = self.conns.get(device_id)
+        if old is not None:
+            self.replaced += 1
+            self._close_soon(old, CLOSE_REPLACED)
+        self.conns[device_id] = conn
+        conn.writer = asyncio.create_task(self._write(conn))
+        self.accepted += 1
+        return conn
+
+    def send(self, device_id: int, message: dict) -> bool:
+        """Queue a message for the device's socket; False if it is not connected here or cannot keep up."""
+        conn = self.conns.get(device_id)
+        if conn is None or conn.closing:
+            return False
+        try:
+            conn.queue.put_nowait(json.dumps(message))
+        except asyncio.QueueFull:
+            self.slow_closed += 1
+            print(f"ws device {device_id}: {QUEUE_MAX} messages queued, disconnecting")
+            self._close_soon(conn, CLOSE_TRY_AGAIN)
+            return False
+        return True
+
+    async def put(self, device_id: int, message: dict) -> bool:
+        """Like send(), but waits up to SEND_TIMEOUT for room in the queue; a writer that frees no slot
+        in that time is stuck, and the socket is closed as with send()."""
+        conn = self.conns.get(device_id)
+        if conn is None or conn.closing:
+            return False
+        try:
+            async with asyncio.timeout(SEND_TIMEOUT):
+                await conn.queue.put(json.dumps(message))
+        except TimeoutError:
+            if not conn.closing:
+                self.slow_closed += 1
+                print(f"ws device {device_id}: queue stuck at {QUEUE_MAX} messages, disconnecting")
+                self._close_soon(conn, CLOSE_TRY_AGAIN)
+            return False
+        return not conn.closing
+
+    async def receive(self, conn: Connection) -> str:
+        try:
+            async with asyncio.timeout(IDLE_TIMEOUT or None):  # unlike wait_for, no extra task per message
+                return await conn.ws.receive_text()
+        except TimeoutError:
+            self.idle_closed += 1
+            conn.closing = True
+            await self._close(conn, 1001)
+            raise WebSocketDisconnect(code=1001, reason="idle")
+
+    async def _write(self, conn: Connection):
+        while True:
+            text = await conn.queue.get()
+            try:
+                await asyncio.wait_for(conn.ws.send_text(text), SEND_TIMEOUT)
+            except Exception as e:
+                print(f"ws send to device {conn.device_id} failed: {e!r}")
+                self.slow_closed += isinstance(e, asyncio.TimeoutError)
+                self._close_soon(conn, CLOSE_TRY_AGAIN)
+                return
+            self.sent += 1
+
+    def _close_soon(self, conn: Connection, code: int) -> None:
+        """Start closing from a sync context; the reader then sees the disconnect and calls release()."""
+        if not conn.closing:
+            conn.closing = True
+            task = asyncio.create_task(self._close(conn, code))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+
+    async def _close(self, conn: Connection, code: int) -> None:
+        try:
+            await asyncio.wait_for(conn.ws.close(code=code), CLOSE_TIMEOUT)
+        except Exception:
+            pass  # already gone; the reader's receive fails or times out on its own
+
+    async def release(self, conn: Connection) -> bool:
+        """The reader is done with the connection. True if it was still the device's current one."""
+        if conn.writer:
+            conn.writer.cancel()
+        current = self.conns.get(conn.device_id) is conn
+        if current:
+            del self.conns[conn.device_id]
+        if not conn.closing:
+            conn.closing = True
+            await self._close(conn, 1000)
+        return current
+
+    def stats(self) -> dict:
+        return {"connections": len(self.conns), "queued": sum(c.queue.qsize() for c in self.conns.values()),
+                "accepted": self.accepted, "rejected": self.rejected, "replaced": self.replaced,
+                "idle_closed": self.idle_closed, "slow_closed": self.slow_closed, "sent": self.sent}
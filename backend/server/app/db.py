@@ -1,7 +1,10 @@
-import os
-from sqlalchemy import create_engine
+import os, time
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from dotenv import load_dotenv
+from .telemetry import db_checkout
 load_dotenv()
 
 # Read env vars
@@ -18,13 +21,49 @@ DB_URL = os.getenv(
 )
 
 
-engine = create_engine(DB_URL, pool_pre_ping=True)
+# Pool sizing (per engine, per worker process)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+
+pool_args = dict(pool_pre_ping=True, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                 pool_timeout=DB_POOL_TIMEOUT,
+                 connect_args={"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"})
+
+
+def timed_pool(base, label: str):
+    """The engine's pool class, timing each checkout (waiting for a free connection or opening one)."""
+    class TimedPool(base):
+        def _do_get(self):
+            t0 = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                db_checkout.observe(time.perf_counter() - t0, label)
+    return TimedPool
+
+
+engine = create_engine(DB_URL, poolclass=timed_pool(QueuePool, "sync"), **pool_args)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 Base = declarative_base()
 
+# psycopg 3 drives both engines; the async one serves the hot agent endpoints
+async_engine = create_async_engine(DB_URL, poolclass=timed_pool(AsyncAdaptedQueuePool, "async"), **pool_args)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+def upgrade_schema(statements: list[str]):
+    with engine.begin() as conn:
+        for stmt in statements:
+            conn.execute(text(stmt))
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
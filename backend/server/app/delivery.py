@@ -0,0 +1,131 @@
+import os, time, asyncio
+from datetime import datetime
+from sqlalchemy import select, update, tuple_
+from .db import AsyncSessionLocal
+from .models import Command
+
+# --- command delivery ---
+# queued -> sent (pushed to the socket) -> ack (agent confirmed receipt) ->
+# done | error (agent's status POST). Pushed commands wait here for the ack
+# and are pushed again with exponential backoff when it doesn't come. When
+# an agent connects, everything still queued or sent-but-unacked for it is
+# drained in creation order. Agents drop duplicate cmd_ids, so a redelivery
+# only costs another ack. Acks are written in one UPDATE per tick of run(),
+# so a broadcast's acks coming back do not take a commit each.
+ACK_TIMEOUT = float(os.getenv("COMMAND_ACK_TIMEOUT", "30"))
+MAX_ATTEMPTS = int(os.getenv("COMMAND_MAX_ATTEMPTS", "5"))
+PUSH_CONCURRENCY = int(os.getenv("COMMAND_PUSH_CONCURRENCY", "200"))  # parallel socket writes per batch
+PENDING = ("queued", "sent")
+
+
+def command_message(cmd) -> dict:
+    return {"cmd_id": cmd.id, "kind": cmd.kind, "payload": cmd.payload}
+
+
+class CommandDelivery:
+    def __init__(self, fanout, session_factory=AsyncSessionLocal, events=None):
+        self.fanout = fanout
+        self.events = events  # FleetEvents, for the live dashboard stream
+        self.session_factory = session_factory
+        self.inflight: dict[int, tuple[int, dict, int, float]] = {}  # cmd_id -> (device_id, msg, attempts, due)
+        self.acked: list[tuple[int, int]] = []  # (cmd_id, device_id) not yet written
+        self.redelivered = 0
+        self._sem = asyncio.Semaphore(PUSH_CONCURRENCY)
+
+    async def _mark_sent(self, cmd_ids: list[int]) -> None:
+        async with self.session_factory() as db:
+            await db.execute(update(Command).where(Command.id.in_(cmd_ids), Command.status.in_(PENDING))
+                             .values(status="sent", sent_at=datetime.utcnow(), attempts=Command.attempts + 1))
+            await db.commit()
+
+    async def _send(self, device_id: int, message: dict, attempts: int, wait: bool = False) -> bool:
+        if not await self.fanout.send_local(device_id, message, wait):
+            return False
+        self.inflight[message["cmd_id"]] = (device_id, message, attempts,
+                                            time.monotonic() + ACK_TIMEOUT * 2 ** (attempts - 1))
+        if self.events:
+            self.events.command(device_id, message["cmd_id"], "sent")
+        return True
+
+    async def push(self, device_id: int, message: dict) -> bool:
+        """Push one command to a locally connected agent and start waiting for its ack."""
+        if not await self._send(device_id, message, 1):
+            return False
+        await self._mark_sent([message["cmd_id"]])
+        return True
+
+    async def push_many(self, items: list[tuple[int, dict]]) -> int:
+        """Broadcast path: bounded-parallel socket writes, then one UPDATE for the whole batch."""
+        async def send(device_id: int, message: dict) -> int | None:
+            async with self._sem:
+                return message["cmd_id"] if await self._send(device_id, message, 1) else None
+        sent = [c for c in await asyncio.gather(*(send(d, m) for d, m in items)) if c is not None]
+        if sent:
+            await self._mark_sent(sent)
+        return len(sent)
+
+    async def drain(self, device_id: int) -> int:
+        """Push everything pending for a device that just connected. There may be more than the socket's
+        queue holds (broadcasts while it was offline), so this waits for room as the writer sends; run it
+        alongside the socket's reader, which has to keep taking the acks."""
+        async with self.session_factory() as db:
+            cmds = (await db.execute(
+                select(Command.id, Command.kind, Command.payload)
+                .where(Command.device_id == device_id, Command.status.in_(PENDING))
+                .order_by(Command.created, Command.id))).all()
+        sent = []
+        try:
+            for cmd in cmds:
+                if not await self._send(device_id, command_message(cmd), 1, wait=True):
+                    break  # socket went away; the rest waits for the next connect
+                sent.append(cmd.id)
+        finally:  # also when the socket closes mid-drain and the drain is cancelled
+            if sent:
+                await self._mark_sent(sent)
+        return len(sent)
+
+    async def ack(self, device_id: int, cmd_id: int) -> None:
+        self.inflight.pop(cmd_id, None)
+        self.acked.append((cmd_id, device_id))
+        if self.events:
+            self.events.command(device_id, cmd_id, "ack")
+
+    async def flush_acks(self) -> int:
+        acked, self.acked = self.acked, []
+        if not acked:
+            return 0
+        try:
+            async with self.session_factory() as db:
+                await db.execute(update(Command)
+                                 .where(tuple_(Command.id, Command.device_id).in_(acked), Command.status.in_(PENDING))
+                                 .values(status="ack"))
+                await db.commit()
+        except Exception as e:
+            print(f"ack flush error: {e}")
+            self.acked[:0] = acked  # try again next tick
+            return 0
+        return len(acked)
+
+    def forget(self, device_id: int) -> None:
+        """Socket closed: stop retrying; unacked commands are drained on reconnect."""
+        for cmd_id in [c for c, v in self.inflight.items() if v[0] == device_id]:
+            del self.inflight[cmd_id]
+
+    async def run(self, interval: float = 1.0):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush_acks()
+            now = time.monotonic()
+            for cmd_id, (device_id, message, attempts, due) in list(self.inflight.items()):
+                if due > now:
+                    continue
+                del self.inflight[cmd_id]
+                if attempts >= MAX_ATTEMPTS:
+                    print(f"command {cmd_id} unacked after {attempts} attempts; left for next connect")
+                    continue
+                try:
+                    if await self._send(device_id, message, attempts + 1):
+                        self.redelivered += 1
+                        await self._mark_sent([cmd_id])
+                except Exception as e:
+                    print(f"command redelivery error: {e}")
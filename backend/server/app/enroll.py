@@ -0,0 +1,66 @@
+from datetime import datetime
+from sqlalchemy import update, case, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from .models import Device
+from .auth import gen_token
+
+# --- enrollment ---
+# A device is identified by (hostname, fingerprint). The agent derives the
+# fingerprint from the machine id and MAC address. Registering is one
+# INSERT ... ON CONFLICT (hostname, fingerprint) DO UPDATE ... RETURNING, so a
+# lab of freshly imaged PCs booting at once costs one round trip each, and
+# concurrent or repeated registrations of the same machine all come back with
+# the same id and token. Without a fingerprint only a new hostname can
+# register (uq_devices_host_nofp settles concurrent first registrations); an
+# existing one gets None (409), since nothing in the request proves it is
+# that device. An agent holding a token re-identifies with it instead (see
+# reidentify). Deployed 0.1 agents whose token file lacks the device id
+# re-register with neither and must be upgraded.
+LEGACY_DUPLICATE = "legacy-duplicate:"  # fingerprint placeholder set by SCHEMA_UPGRADES
+
+
+async def register(db: AsyncSession, req) -> tuple[int, str] | None:
+    now = datetime.utcnow()
+    if req.fingerprint:
+        stmt = pg_insert(Device).values(
+            hostname=req.hostname, fingerprint=req.fingerprint, os=req.os, arch=req.arch,
+            agent_version=req.agent_version, token=gen_token(), last_seen=now, online=False)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Device.hostname, Device.fingerprint],
+            set_={"os": stmt.excluded.os, "arch": stmt.excluded.arch, "agent_version": stmt.excluded.agent_version})
+    else:
+        stmt = pg_insert(Device).values(
+            hostname=req.hostname, os=req.os, arch=req.arch, agent_version=req.agent_version,
+            token=gen_token(), last_seen=now, online=False,
+        ).on_conflict_do_nothing(index_elements=[Device.hostname], index_where=Device.fingerprint.is_(None))
+    row = (await db.execute(stmt.returning(Device.id, Device.token))).first()
+    await db.commit()
+    return tuple(row) if row else None
+
+
+async def reidentify(db: AsyncSession, token: str, req) -> tuple[int, str] | None:
+    """An agent that already holds a token asks for its id; records its fingerprint if the row has none yet."""
+    values = {"agent_version": req.agent_version, "os": req.os, "arch": req.arch}
+    stmt = update(Device).where(Device.token == token).returning(Device.id, Device.token)
+    try:
+        known = case((Device.fingerprint.startswith(LEGACY_DUPLICATE), None), else_=Device.fingerprint)
+        row = (await db.execute(stmt.values(**values, fingerprint=func.coalesce(known, req.fingerprint)))).first()
+    except IntegrityError:  # a pre-enrolled row already has this fingerprint; leave ours as it is
+        await db.rollback()
+        row = (await db.execute(stmt.values(**values))).first()
+    await db.commit()
+    return tuple(row) if row else None
+
+
+async def pre_enroll(db: AsyncSession, items) -> list[dict]:
+    """Create devices ahead of their first boot; returns the ones that did not exist yet."""
+    now = datetime.utcnow()
+    rows = (await db.execute(pg_insert(Device).values([
+        dict(hostname=i.hostname, fingerprint=i.fingerprint, os=i.os, arch=i.arch, token=gen_token(),
+             last_seen=now, online=False) for i in items
+    ]).on_conflict_do_nothing(index_elements=[Device.hostname, Device.fingerprint])
+      .returning(Device.id, Device.hostname, Device.fingerprint))).all()
+    await db.commit()
+    return [{"id": r.id, "hostname": r.hostname, "fingerprint": r.fingerprint} for r in rows]
@@ -0,0 +1,126 @@
+import os, json, time, asyncio
+from .telemetry import redis_publish, timer
+
+# --- live fleet events (GET /events) ---
+# Ingest paths report presence changes, the newest metric sample and command
+# status transitions here. Reporting never does I/O: updates are merged into
+# one pending entry per device, so however often a device reports, it
+# appears at most once per INTERVAL. Every INTERVAL each worker publishes its
+# pending entries to the fleet:events channel (in chunks of PUBLISH_CHUNK
+# devices), which means a dashboard sees updates from all workers. Nothing
+# is serialized while no worker has a dashboard subscribed.
+#
+# A worker subscribes to the channel only while it has local dashboards and
+# hands each message, as received, to every dashboard's bounded queue. A
+# dashboard whose queue is full loses what was queued and gets a "resync"
+# event instead (it should re-read GET /devices); nobody upstream waits.
+CHANNEL = "fleet:events"
+INTERVAL = float(os.getenv("EVENTS_INTERVAL", "2"))
+QUEUE_MAX = int(os.getenv("EVENTS_QUEUE_MAX", "64"))   # messages per dashboard
+PUBLISH_CHUNK = 1000
+KEEPALIVE = 15
+RESYNC = object()
+
+
+class FleetEvents:
+    def __init__(self, aredis, interval: float = INTERVAL):
+        self.aredis = aredis
+        self.interval = interval
+        self.pending: dict[int, dict] = {}
+        self.queues: set[asyncio.Queue] = set()
+        self._listener: asyncio.Task | None = None
+        self.published = self.dropped = self.resyncs = 0
+
+    # --- producers: called from request handlers and background tasks ---
+    def device(self, device_id: int, **fields) -> None:
+        self.pending.setdefault(device_id, {}).update(fields)
+
+    def metric(self, device_id: int, m) -> None:
+        self.device(device_id, metrics={"cpu": m.cpu, "mem": m.mem, "disk": m.disk, "battery_pct": m.battery_pct,
+                                        "ts": (m.ts.isoformat() if m.ts else None)})
+
+    def command(self, device_id: int, cmd_id: int, status: str) -> None:
+        self.pending.setdefault(device_id, {}).setdefault("commands", {})[str(cmd_id)] = status
+
+    async def publish(self) -> int:
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        if not (await self.aredis.pubsub_numsub(CHANNEL))[0][1]:
+            return 0  # no dashboard anywhere
+        items = list(pending.items())
+        pipe = self.aredis.pipeline(transaction=False)
+        for i in range(0, len(items), PUBLISH_CHUNK):
+            pipe.publish(CHANNEL, json.dumps({"ts": time.time(), "devices": dict(items[i:i + PUBLISH_CHUNK])}))
+        with timer(redis_publish, "events"):
+            await pipe.execute()
+        self.published += len(items)
+        return len(items)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.publish()
+            except Exception as e:
+                print(f"fleet events publish error: {e}")
+
+    # --- dashboards on this worker ---
+    def _deliver(self, data: str) -> None:
+        for q in self.queues:
+            try:
+                q.put_nowait(data)
+            except asyncio.QueueFull:
+                # a dashboard this far behind is better off re-reading the fleet
+                self.resyncs += 1
+                while not q.empty():
+                    self.dropped += q.get_nowait() is not RESYNC
+                q.put_nowait(RESYNC)
+                q.put_nowait(data)
+
+    async def _listen(self):
+        while True:
+            pubsub = self.aredis.pubsub()
+            try:
+                await pubsub.subscribe(CHANNEL)
+                async for msg in pubsub.listen():
+                    if msg.get("type") == "message":
+                        self._deliver(msg["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"fleet events listener error: {e}")
+                for q in self.queues:  # we may have missed messages while reconnecting
+                    if q.empty():
+                        q.put_nowait(RESYNC)
+                await asyncio.sleep(2)
+            finally:
+                await pubsub.reset()
+
+    async def stream(self):
+        """Server-sent events for one dashboard: "update" batches, "resync" after a gap, keepalive comments."""
+        q: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_MAX)
+        self.queues.add(q)
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    data = await asyncio.wait_for(q.get(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if data is RESYNC:
+                    yield "event: resync\ndata: {}\n\n"
+                else:
+                    yield f"event: update\ndata: {data}\n\n"
+        finally:
+            self.queues.discard(q)
+            if not self.queues and self._listener is not None:
+                self._listener.cancel()
+                self._listener = None
+
+    def stats(self) -> dict:
+        return {"dashboards": len(self.queues), "pending_devices": len(self.pending), "published": self.published,
+                "dropped": self.dropped, "resyncs": self.resyncs}
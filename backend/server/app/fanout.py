@@ -0,0 +1,120 @@
+import os, json, uuid, socket, asyncio
+from .telemetry import redis_publish, timer
+
+# --- cross-worker command delivery ---
+# Every API worker has a node id and its own Redis channel. When an agent's
+# WebSocket lands on a worker, ws:owner:<device_id> is set to that node (with a
+# TTL the worker keeps refreshing). Publishing a command looks up the owner and
+# sends it to that node's channel; the node's subscriber task writes it to the
+# local socket. A device with no owner is offline and its command stays queued.
+NODE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+OWNER_TTL = int(os.getenv("WS_OWNER_TTL", "60"))
+PUBLISH_CHUNK = 500  # commands per pub/sub message for bulk fan-out
+
+# delete the owner key only if it still points at us (the agent may have reconnected elsewhere)
+_RELEASE = "if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) else return 0 end"
+# extend our keys, but never take a key over from the node that now owns it
+_REFRESH = """
+for _, k in ipairs(KEYS) do
+  local v = redis.call('GET', k)
+  if (not v) or v == ARGV[1] then redis.call('SET', k, ARGV[1], 'EX', ARGV[2]) end
+end
+return 1
+"""
+
+
+def owner_key(device_id: int) -> str:
+    return f"ws:owner:{device_id}"
+
+
+def node_channel(node: str) -> str:
+    return f"commands:node:{node}"
+
+
+class CommandFanout:
+    def __init__(self, aredis, connections, node_id: str = NODE_ID):
+        self.aredis = aredis
+        self.connections = connections   # ConnectionManager holding this worker's sockets
+        self.node_id = node_id
+        # replaced by the delivery engine to track acks
+        self.on_command = self.send_local
+        self.on_batch = self._send_each
+        self.delivered = 0
+        self._tasks: set[asyncio.Task] = set()  # the loop holds tasks only weakly
+
+    # --- publishing (any worker) ---
+    async def publish_many(self, items: list[tuple[int, dict]]) -> int:
+        """Bulk variant: one MGET for the owners, then one message per node (per chunk)."""
+        by_node: dict[str, list] = {}
+        for i in range(0, len(items), PUBLISH_CHUNK):
+            chunk = items[i:i + PUBLISH_CHUNK]
+            owners = await self.aredis.mget([owner_key(d) for d, _ in chunk])
+            for (device_id, message), node in zip(chunk, owners):
+                if node:
+                    by_node.setdefault(node, []).append({"device_id": device_id, "message": message})
+        pipe = self.aredis.pipeline(transaction=False)
+        for node, batch in by_node.items():
+            for i in range(0, len(batch), PUBLISH_CHUNK):
+                pipe.publish(node_channel(node), json.dumps({"batch": batch[i:i + PUBLISH_CHUNK]}))
+        with timer(redis_publish, "node"):
+            await pipe.execute()
+        return sum(len(b) for b in by_node.values())
+
+    # --- socket ownership (this worker) ---
+    async def register(self, device_id: int) -> None:
+        await self.aredis.set(owner_key(device_id), self.node_id, ex=OWNER_TTL)
+
+    async def unregister(self, device_id: int) -> None:
+        await self.aredis.eval(_RELEASE, 1, owner_key(device_id), self.node_id)
+
+    async def send_local(self, device_id: int, message: dict, wait: bool = False) -> bool:
+        """Hand the message to the device's connection queue; the connection's writer sends it.
+        wait: block for room in a full queue instead of dropping the socket as a slow consumer."""
+        ok = await self.connections.put(device_id, message) if wait else self.connections.send(device_id, message)
+        if not ok:
+            return False
+        self.delivered += 1
+        return True
+
+    async def _send_each(self, items: list[tuple[int, dict]]) -> None:
+        for device_id, message in items:
+            await self.send_local(device_id, message)
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    # --- background tasks ---
+    async def listen(self):
+        while True:
+            pubsub = self.aredis.pubsub()
+            try:
+                await pubsub.subscribe(node_channel(self.node_id))
+                async for msg in pubsub.listen():
+                    if msg.get("type") != "message":
+                        continue
+                    data = json.loads(msg["data"])
+                    # don't let one slow socket hold up the rest of the channel
+                    if "batch" in data:
+                        self._spawn(self.on_batch([(int(b["device_id"]), b["message"]) for b in data["batch"]]))
+                    else:
+                        self._spawn(self.on_command(int(data["device_id"]), data["message"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"command fan-out listener error: {e}")
+                await asyncio.sleep(2)
+            finally:
+                await pubsub.reset()
+
+    async def refresh_owners(self):
+        while True:
+            await asyncio.sleep(OWNER_TTL / 3)
+            if not self.connections.conns:
+                continue
+            try:
+                keys = [owner_key(d) for d in list(self.connections.conns)]
+                await self.aredis.eval(_REFRESH, len(keys), *keys, self.node_id, OWNER_TTL)
+            except Exception as e:
+                print(f"ws owner refresh error: {e}")
@@ -0,0 +1,140 @@
+import os, re, json, time, fcntl, asyncio, hashlib
+
+# --- file store ---
+# Content-addressed blobs on the local filesystem: blobs/<sha[:2]>/<sha>.
+# An upload is keyed by (device, sha256). The client asks where to start
+# (begin), then appends chunks at that offset (write). The partial file on disk
+# is the only state, so an interrupted upload resumes from whatever arrived,
+# from any worker. When the last byte lands the content is re-hashed and
+# moved into place. A blob that already exists is never uploaded again.
+STORE_DIR = os.getenv("FILE_STORE_DIR", "./filestore")
+MAX_FILE = int(float(os.getenv("MAX_UPLOAD_MB", "2048")) * 1024 * 1024)
+MAX_CHUNK = 16 * 1024 * 1024     # per PUT
+CHUNK_SIZE = 1024 * 1024         # what clients are told to send
+PARTIAL_TTL = 7 * 86400
+SWEEP_INTERVAL = 3600
+
+_SHA = re.compile(r"[0-9a-f]{64}")
+_UPLOAD_ID = re.compile(r"(\d+)-([0-9a-f]{64})")
+
+
+class UploadError(Exception):
+    def __init__(self, status: int, detail, offset: int | None = None):
+        super().__init__(detail)
+        self.status, self.detail, self.offset = status, detail, offset
+
+
+def valid_sha(sha: str) -> bool:
+    return bool(_SHA.fullmatch(sha))
+
+
+def parse_upload_id(upload_id: str) -> tuple[int, str]:
+    m = _UPLOAD_ID.fullmatch(upload_id)
+    if not m:
+        raise UploadError(404, "Unknown upload")
+    return int(m.group(1)), m.group(2)
+
+
+def sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_json(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+class FileStore:
+    def __init__(self, root: str = STORE_DIR):
+        self.root = root
+        os.makedirs(os.path.join(root, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(root, "partial"), exist_ok=True)
+
+    def blob_path(self, sha: str) -> str:
+        return os.path.join(self.root, "blobs", sha[:2], sha)
+
+    def _partial(self, upload_id: str) -> str:
+        return os.path.join(self.root, "partial", upload_id)
+
+    def exists(self, sha: str) -> bool:
+        return os.path.exists(self.blob_path(sha))
+
+    def begin(self, device_id: int, sha: str, size: int, meta: dict) -> dict:
+        """Where to start sending; `meta` is kept with the partial and handed back by write() when done.
+        Touches the disk; call it off the event loop."""
+        if not valid_sha(sha):
+            raise UploadError(400, "sha256 must be 64 lowercase hex chars")
+        if size < 0 or size > MAX_FILE:
+            raise UploadError(413, f"Files are limited to {MAX_FILE} bytes")
+        if self.exists(sha):
+            return {"status": "exists"}
+        upload_id = f"{device_id}-{sha}"
+        path = self._partial(upload_id)
+        if not os.path.exists(path + ".json"):
+            with open(path + ".json", "w") as f:
+                json.dump({**meta, "size": size}, f)
+        elif read_json(path + ".json")["size"] != size:
+            raise UploadError(409, "Size differs from the upload in progress")
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        return {"status": "partial", "upload_id": upload_id, "offset": offset, "chunk_size": CHUNK_SIZE}
+
+    async def write(self, upload_id: str, offset: int, stream) -> dict:
+        """Append a streamed chunk at `offset`; finishes the upload when it reaches the declared size."""
+        _, sha = parse_upload_id(upload_id)
+        path = self._partial(upload_id)
+        try:
+            meta = await asyncio.to_thread(read_json, path + ".json")
+        except FileNotFoundError:
+            raise UploadError(404, "Unknown upload; start it again")
+        size = meta["size"]
+        written = 0
+        with open(path, "ab") as f:
+            try:  # one writer per upload, across workers too
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadError(409, "Upload busy")
+            current = os.fstat(f.fileno()).st_size
+            if offset != current:
+                raise UploadError(409, "Offset mismatch", offset=current)
+            async for chunk in stream:
+                written += len(chunk)
+                if written > MAX_CHUNK or current + written > size:
+                    f.truncate(current)  # drop the partial chunk; the client resends from `current`
+                    raise UploadError(413, "Chunk exceeds the declared size or the chunk limit", offset=current)
+                await asyncio.to_thread(f.write, chunk)
+        offset = current + written
+        if offset < size:
+            return {"status": "partial", "offset": offset}
+        actual = await asyncio.to_thread(sha256_file, path)
+        if actual != sha:
+            os.remove(path); os.remove(path + ".json")
+            raise UploadError(422, "Content does not match sha256; upload discarded", offset=0)
+        os.makedirs(os.path.dirname(self.blob_path(sha)), exist_ok=True)
+        os.replace(path, self.blob_path(sha))
+        os.remove(path + ".json")
+        return {"status": "done", "offset": offset, "meta": meta}
+
+    def sweep(self, max_age: float = PARTIAL_TTL) -> int:
+        cutoff, removed = time.time() - max_age, 0
+        part = os.path.join(self.root, "partial")
+        for name in os.listdir(part):
+            p = os.path.join(part, name)
+            try:
+                if os.path.getmtime(p) < cutoff:
+                    os.remove(p)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+    async def run_sweeper(self, interval: float = SWEEP_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                print(f"file store sweep error: {e}")
@@ -0,0 +1,92 @@
+import os, time
+from sqlalchemy import select, bindparam, any_, all_, Integer
+from sqlalchemy.dialects.postgresql import ARRAY
+from .models import Device
+from .presence import from_epoch
+
+# --- device listing ---
+# GET /devices pages through the fleet by id (keyset: "after" is the last id
+# of the previous page), filters in SQL, and selects only the columns asked
+# for. Every change to the set of devices or their metadata (enroll, re-
+# register, delete) bumps fleet:version in Redis. The ETag is that counter
+# plus the current ETAG_WINDOW slot: presence moves continuously and is not
+# counted, so a 304 may show online/last_seen up to ETAG_WINDOW seconds old
+# (presence reaches Postgres on a 30 s cycle anyway). A poll whose
+# If-None-Match still matches costs one Redis GET and no query.
+VERSION_KEY = "fleet:version"
+ETAG_WINDOW = float(os.getenv("FLEET_ETAG_WINDOW", "30"))
+PAGE_DEFAULT = 500
+PAGE_MAX = 5000
+
+COLUMNS = {"id": Device.id, "hostname": Device.hostname, "os": Device.os, "arch": Device.arch,
+           "agent_version": Device.agent_version, "online": Device.online, "last_seen": Device.last_seen}
+DEFAULT_FIELDS = ("id", "hostname", "os", "arch", "online", "last_seen")
+
+
+async def changed(aredis) -> None:
+    """Call after devices were added, removed or re-registered."""
+    try:
+        await aredis.incr(VERSION_KEY)
+    except Exception as e:
+        print(f"fleet version bump failed: {e}")
+
+
+async def etag(aredis) -> str | None:
+    try:
+        version = await aredis.get(VERSION_KEY) or "0"
+    except Exception:
+        return None  # no Redis, no validator: every poll is served in full
+    return f'W/"{version}.{int(time.time() // ETAG_WINDOW)}"'
+
+
+def like_prefix(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def parse_fields(fields: str | None) -> list[str]:
+    """Columns to return; id is always included (it is the cursor). ValueError on unknown names."""
+    if not fields:
+        return list(DEFAULT_FIELDS)
+    names = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = set(names) - COLUMNS.keys()
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(sorted(unknown))}; choose from {', '.join(COLUMNS)}")
+    return ["id"] + [n for n in dict.fromkeys(names) if n != "id"]
+
+
+def presence_filter(live, online: bool):
+    """Devices in (or not in) `live` as one array parameter: the same statement for any fleet size,
+    instead of one bound parameter per online device."""
+    ids = bindparam("live_ids", list(live), type_=ARRAY(Integer))
+    return Device.id == any_(ids) if online else Device.id != all_(ids)
+
+
+async def page(db, presence, fields: list[str], after: int = 0, limit: int = PAGE_DEFAULT,
+               online: bool | None = None, os_: str | None = None, arch: str | None = None,
+               hostname: str | None = None) -> dict:
+    where = [Device.id > after]
+    if os_:
+        where.append(Device.os.ilike(like_prefix(os_), escape="\\"))
+    if arch:
+        where.append(Device.arch == arch)
+    if hostname:
+        where.append(Device.hostname.ilike(like_prefix(hostname), escape="\\"))
+    if online is not None:  # live presence, not the written-back column
+        live = await presence.online_ids()
+        where.append(presence_filter(live, online))
+    rows = (await db.execute(select(*(COLUMNS[f] for f in fields)).where(*where)
+                             .order_by(Device.id).limit(limit))).all()
+
+    need_presence = "online" in fields or "last_seen" in fields
+    seen = await presence.lookup([r.id for r in rows]) if need_presence else {}
+    items = []
+    for r in rows:
+        item = r._asdict()
+        s = seen.get(r.id)
+        if "online" in item:
+            item["online"] = presence.is_online(s) if s is not None else bool(r.online)
+        if "last_seen" in item:
+            ts = from_epoch(s) if s is not None else r.last_seen
+            item["last_seen"] = ts.isoformat() if ts else None
+        items.append(item)
+    return {"items": items, "next": rows[-1].id if len(rows) == limit else None}
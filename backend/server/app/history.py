@@ -0,0 +1,105 @@
+import os, json, math
+from datetime import datetime
+from sqlalchemy import select, func, case, tuple_
+from .models import Metric, MetricRollup
+from .presence import to_epoch, from_epoch
+from .retention import RAW_RETENTION_DAYS, ROLLUP_RETENTION_DAYS
+
+# --- metrics read path ---
+# series() answers range queries from the cheapest source that still covers the
+# window (raw rows or one of the rollup levels), bins the points to `step`
+# seconds server-side and returns columnar arrays. raw_page() is the
+# keyset-paginated raw export.
+MAX_POINTS = int(os.getenv("METRICS_QUERY_MAX_POINTS", "2000"))
+BUCKET_SECONDS = {"raw": 0, "1m": 60, "1h": 3600, "1d": 86400}
+FIELDS = {"cpu": "cpu", "mem": "mem", "disk": "disk", "battery": "battery_pct"}  # output name -> raw column
+AGGS = ("avg", "min", "max", "p95")
+
+
+def pick_resolution(start: datetime, end: datetime, step: int | None, now: datetime) -> tuple[str, int]:
+    """Coarsest resolution whose bucket fits in the step, moved up while its data has been pruned."""
+    want = max(step or 0, (end - start).total_seconds() / MAX_POINTS)
+    res = "raw"
+    for r in ("1m", "1h", "1d"):
+        if BUCKET_SECONDS[r] <= want:
+            res = r
+    age_days = (now - start).total_seconds() / 86400
+    kept = {"raw": RAW_RETENTION_DAYS, **ROLLUP_RETENTION_DAYS}
+    order = ["raw", "1m", "1h", "1d"]
+    while res != "1d" and kept[res] and age_days > kept[res]:
+        res = order[order.index(res) + 1]
+    return res, max(1, math.ceil(want), BUCKET_SECONDS[res])
+
+
+def _raw_columns(aggs: list[str]) -> list:
+    cols = []
+    for name, col in FIELDS.items():
+        c = getattr(Metric, col)
+        for a in aggs:
+            expr = {"avg": func.avg(c), "min": func.min(c), "max": func.max(c),
+                    "p95": func.percentile_cont(0.95).within_group(c)}[a]
+            cols.append(expr.label(name if a == "avg" else f"{name}_{a}"))
+    return cols
+
+
+def _rollup_columns(aggs: list[str]) -> list:
+    R = MetricRollup
+    cols = []
+    for name in FIELDS:
+        avg_col = getattr(R, f"{name}_avg")
+        for a in aggs:
+            if a == "avg":  # weighted by sample count, ignoring buckets without a value
+                expr = func.sum(avg_col * R.n) / func.nullif(func.sum(case((avg_col.isnot(None), R.n))), 0)
+            elif a == "p95":  # upper bound of the merged buckets' p95s
+                expr = func.max(getattr(R, f"{name}_p95"))
+            else:
+                expr = getattr(func, a)(getattr(R, f"{name}_{a}"))
+            cols.append(expr.label(name if a == "avg" else f"{name}_{a}"))
+    return cols
+
+
+async def series(db, device_id: int, start: datetime, end: datetime, step: int | None, aggs: list[str],
+                 now: datetime | None = None) -> dict:
+    res, step = pick_resolution(start, end, step, now or datetime.utcnow())
+    if res == "raw":
+        src, cols, where = Metric, _raw_columns(aggs), [Metric.device_id == device_id]
+    else:
+        src, cols = MetricRollup, _rollup_columns(aggs)
+        where = [MetricRollup.resolution == res, MetricRollup.device_id == device_id]
+    bucket = (func.floor(func.extract("epoch", src.ts) / step) * step).label("bucket")
+    q = (select(bucket, *cols).where(*where, src.ts >= start, src.ts < end)
+         .group_by(bucket).order_by(bucket))
+    rows = (await db.execute(q)).all()
+    out = {"device_id": device_id, "resolution": res, "step": step,
+           "from": start.isoformat(), "to": end.isoformat(),
+           "ts": [int(r.bucket) for r in rows]}
+    for c in cols:
+        out[c.name] = [None if v is None else round(v, 2) for v in (r._mapping[c.name] for r in rows)]
+    return out
+
+
+def encode_cursor(ts: datetime, row_id: int) -> str:
+    return f"{round(to_epoch(ts) * 1_000_000)}:{row_id}"
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    us, row_id = cursor.split(":", 1)
+    return from_epoch(int(us) / 1_000_000), int(row_id)
+
+
+async def raw_page(db, device_id: int, start: datetime, end: datetime, cursor: str | None, limit: int) -> dict:
+    q = (select(Metric.id, Metric.ts, Metric.cpu, Metric.mem, Metric.disk, Metric.uptime_sec,
+                Metric.battery_pct, Metric.details)
+         .where(Metric.device_id == device_id, Metric.ts >= start, Metric.ts < end))
+    if cursor:
+        after_ts, after_id = decode_cursor(cursor)
+        q = q.where(tuple_(Metric.ts, Metric.id) > tuple_(after_ts, after_id))
+    rows = (await db.execute(q.order_by(Metric.ts, Metric.id).limit(limit + 1))).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return {"device_id": device_id,
+            "ts": [to_epoch(r.ts) for r in rows],
+            "cpu": [r.cpu for r in rows], "mem": [r.mem for r in rows], "disk": [r.disk for r in rows],
+            "uptime_sec": [r.uptime_sec for r in rows], "battery": [r.battery_pct for r in rows],
+            "details": [json.loads(r.details) if r.details else None for r in rows],
+            "next": encode_cursor(rows[-1].ts, rows[-1].id) if more else None}
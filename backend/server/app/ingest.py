@@ -0,0 +1,154 @@
+import os, json, time, asyncio
+from datetime import datetime, timezone
+from sqlalchemy import select, insert, update, values, column, bindparam, any_, Integer, DateTime
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.exc import IntegrityError
+from .db import AsyncSessionLocal
+from .models import Device, Metric
+from .rollups import update_rollups
+from .telemetry import ingest_samples, ingest_rows, ingest_flush, timer
+
+# --- buffered metrics ingestion ---
+# Samples from /metrics and /metrics/batch are queued here and written with one
+# multi-row INSERT per flush instead of one commit per sample. A flush happens
+# when FLUSH_ROWS samples are pending or every FLUSH_INTERVAL seconds.
+FLUSH_ROWS = int(os.getenv("METRICS_FLUSH_ROWS", "1000"))
+FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "1.0"))
+MAX_PENDING = int(os.getenv("METRICS_MAX_PENDING", "50000"))  # cap while the DB is unreachable
+
+
+def utc_naive(ts: datetime) -> datetime:
+    """Columns are naive UTC (datetime.utcnow), so normalise aware timestamps."""
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def metric_row(device_id: int, m, received: datetime) -> dict:
+    # a sample can't be newer than its arrival; clamping keeps skewed agent
+    # clocks out of future partitions
+    ts = min(utc_naive(m.ts), received) if m.ts else received
+    return dict(device_id=device_id, ts=ts,
+                cpu=m.cpu, mem=m.mem, disk=m.disk, uptime_sec=m.uptime_sec,
+                battery_pct=m.battery_pct, details=json.dumps(m.details or {}))
+
+
+class MetricBuffer:
+    def __init__(self, max_rows: int = FLUSH_ROWS, session_factory=AsyncSessionLocal, presence=None):
+        self.max_rows = max_rows
+        self.session_factory = session_factory
+        self.presence = presence  # PresenceStore; without one, devices are updated in Postgres
+        self._rows: list[dict] = []
+        self._seen: dict[int, float] = {}  # device_id -> epoch we last heard from it
+        self._wake = asyncio.Event()
+        self.flushed_rows = 0
+
+    # add() runs on the event loop and never does I/O: a full buffer only wakes
+    # the flusher task
+    def add(self, device_id: int, samples) -> None:
+        now = datetime.utcnow()
+        before = len(self._rows)
+        self._rows.extend(metric_row(device_id, m, now) for m in samples)
+        ingest_samples.inc(n=len(self._rows) - before)
+        self._seen[device_id] = time.time()
+        if len(self._rows) >= self.max_rows:
+            self._wake.set()
+
+    def pending(self) -> int:
+        return len(self._rows)
+
+    def forget(self, device_id: int) -> None:
+        """Deleted device: its buffered samples would fail the devices foreign key."""
+        self._rows = [r for r in self._rows if r["device_id"] != device_id]
+        self._seen.pop(device_id, None)
+
+    async def wait(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wake.clear()
+
+    async def flush(self) -> int:
+        rows, seen = self._rows, self._seen
+        self._rows, self._seen = [], {}
+        # presence goes to Redis; if that fails the UPDATE in write() covers it
+        if self.presence and seen:
+            try:
+                await self.presence.touch_many(seen)
+                seen = {}
+            except Exception as e:
+                print(f"presence update failed: {e}")
+        if not rows:
+            return 0
+        async with self.session_factory() as db:
+            try:
+                with timer(ingest_flush):
+                    await self.write(db, rows, seen)
+                    await db.commit()
+            except IntegrityError as e:
+                # a device deleted while its samples were buffered (here or on another
+                # worker); requeueing them would fail every flush after this one
+                await db.rollback()
+                rows, seen = await self._without_deleted(rows, seen, e)
+                self._requeue(rows, seen)
+                return 0
+            except Exception as e:
+                await db.rollback()
+                print(f"metrics flush failed ({len(rows)} rows): {e}")
+                self._requeue(rows, seen)
+                return 0
+        self.flushed_rows += len(rows)
+        ingest_rows.inc(n=len(rows))
+        # separate transaction: a failed rollup must not cost the raw rows, and
+        # the next flush touching the same buckets recomputes them anyway
+        async with self.session_factory() as db:
+            try:
+                await update_rollups(db, rows)
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                print(f"rollup update failed: {e}")
+        return len(rows)
+
+    async def write(self, db, rows: list[dict], seen: dict[int, float]) -> None:
+        # executemany through insertmanyvalues -> multi-row INSERT ... VALUES batches
+        await db.execute(insert(Metric), rows)
+        if not seen:
+            return
+        # one UPDATE ... FROM (VALUES ...) for every device seen in this flush
+        v = values(column("id", Integer), column("ts", DateTime), name="seen").data(
+            [(i, datetime.utcfromtimestamp(t)) for i, t in seen.items()])
+        await db.execute(update(Device).where(Device.id == v.c.id).values(last_seen=v.c.ts, online=True)
+                         .execution_options(synchronize_session=False))
+
+    async def _without_deleted(self, rows: list[dict], seen: dict[int, float], error) -> tuple[list[dict], dict]:
+        ids = {r["device_id"] for r in rows} | seen.keys()
+        try:
+            async with self.session_factory() as db:
+                known = set((await db.execute(select(Device.id).where(
+                    Device.id == any_(bindparam("ids", list(ids), type_=ARRAY(Integer)))))).scalars())
+        except Exception as e:
+            print(f"metrics flush failed ({len(rows)} rows): {error}; device check failed: {e}")
+            return rows, seen
+        gone = ids - known
+        if not gone:
+            print(f"metrics flush failed ({len(rows)} rows): {error}")
+            return rows, seen
+        kept = [r for r in rows if r["device_id"] in known]
+        print(f"metrics flush: dropped {len(rows) - len(kept)} rows of deleted devices {sorted(gone)}")
+        return kept, {d: t for d, t in seen.items() if d in known}
+
+    def _requeue(self, rows: list[dict], seen: dict[int, float]) -> None:
+        self._rows = (rows + self._rows)[-MAX_PENDING:]
+        for dev_id, ts in seen.items():
+            self._seen[dev_id] = max(ts, self._seen.get(dev_id, ts))
+
+
+async def run_flusher(buffer: MetricBuffer, interval: float = FLUSH_INTERVAL):
+    while True:
+        await buffer.wait(interval)
+        try:
+            await buffer.flush()
+        except Exception as e:
+            print(f"metrics flusher error: {e}")
@@ -1,27 +1,127 @@
 import uvicorn
 import json, os, asyncio
-from datetime import datetime
-from typing import Dict, Set
-from fastapi import FastAPI, Depends, WebSocket, WebSocketDisconnect, Header, HTTPException
+from anyio import from_thread
+from datetime import datetime, timedelta
+from typing import Set, List
+from fastapi import FastAPI, Depends, WebSocket, WebSocketDisconnect, Header, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy import select, update, insert, literal, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from redis import Redis
+from redis.asyncio import Redis as AsyncRedis, BlockingConnectionPool
 
-from .db import Base, engine, get_db
-from .models import Device, Metric, Command
-from .schemas import RegisterReq, RegisterResp, MetricIn, CommandCreate, CommandOut, CommandUpdate, DeviceResp
-from .auth import gen_token, require_agent, require_admin, get_agent_by_hostname
-from .utils import maybe_alert
+from .db import Base, engine, async_engine, get_db, get_async_db, upgrade_schema, DB_POOL_SIZE, DB_MAX_OVERFLOW
+from .models import Device, Metric, Command, CommandJob, MetricRollup, Image, StoredFile, SCHEMA_UPGRADES
+from .schemas import RegisterReq, RegisterResp, EnrollItem, MetricIn, CommandCreate, CommandOut, CommandInfo, CommandUpdate, BroadcastCreate, JobOut, ImageIn, UploadStart
+from .auth import bearer_token, require_agent_async, require_admin
+from .ingest import MetricBuffer, run_flusher, utc_naive
+from .cache import token_cache, publish_invalidation, listen_invalidations
+from .presence import PresenceStore, run_presence
+from .retention import maintain, run_maintenance
+from . import history, enroll, fleet
+from .fanout import CommandFanout
+from .events import FleetEvents
+from .connections import ConnectionManager
+from .delivery import CommandDelivery, command_message
+from .compression import GzipRequestMiddleware
+from . import wire
+from .alerts import dispatcher as alert_dispatcher
+from .alerting import AlertEngine
+from .anomaly import AnomalyDetector
+from .filestore import FileStore, UploadError, parse_upload_id, valid_sha
+from .output import OutputBuffer, RangeNotSatisfiable, parse_range, migrate_legacy
+from . import output
+from . import telemetry
+from .telemetry import Gauge, Counter, TelemetryMiddleware
+
+MAX_BATCH = int(os.getenv("METRICS_MAX_BATCH", "1000"))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
 
 Base.metadata.create_all(bind=engine)
+upgrade_schema(SCHEMA_UPGRADES)
+migrate_legacy(engine)  # commands.result -> command_output chunks, once
 
 app = FastAPI(title="Mini RMM")
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_headers=["*"], allow_methods=["*"])
+app.add_middleware(GzipRequestMiddleware)  # agents gzip their spooled metric batches
+app.add_middleware(TelemetryMiddleware)    # outermost, so latency includes inflating those batches
 
 redis = Redis(host=os.getenv("REDIS_HOST","redis"), port=6379, decode_responses=True)
+# async handlers + pub/sub; bounded so thousands of agents reconnecting at once wait for a
+# connection instead of each opening its own
+aredis = AsyncRedis(connection_pool=BlockingConnectionPool(
+    host=os.getenv("REDIS_HOST","redis"), port=6379, decode_responses=True, max_connections=REDIS_MAX_CONNECTIONS, timeout=10))
+
+# --- live dashboard stream: coalesced presence/metrics/command updates via Redis ---
+events = FleetEvents(aredis)
+
+# --- agent sockets on this worker: device_id -> connection with its own outbound queue ---
+connections = ConnectionManager()
+fanout = CommandFanout(aredis, connections)
+delivery = CommandDelivery(fanout, events=events)
+fanout.on_command = delivery.push
+fanout.on_batch = delivery.push_many
+
+# --- presence lives in Redis and is written back to Postgres in batches ---
+presence = PresenceStore(aredis, events=events)
+
+# --- threshold alerts, evaluated in the background from each device's latest sample ---
+alert_engine = AlertEngine(aredis)
+anomaly = AnomalyDetector(aredis)  # rolling per-device stats; spikes, disk filling, memory creep
+
+# --- uploaded files, content-addressed on local disk ---
+file_store = FileStore()
+
+# --- command output, compressed in chunks outside the commands table ---
+output_buffer = OutputBuffer()
+
+# --- buffered metrics writer, flushed on size (in add) or on a timer ---
+metric_buffer = MetricBuffer(presence=presence)
 
-# --- in-memory WS registry: device_id -> websocket ---
-agent_ws: Dict[int, WebSocket] = {}
+# --- Prometheus gauges over the components above, read at scrape time ---
+Gauge("ws_connections", "Agent sockets open on this worker", fn=lambda: len(connections.conns))
+Gauge("ws_queued_messages", "Messages waiting in agent socket send queues",
+      fn=lambda: sum(c.queue.qsize() for c in connections.conns.values()))
+Counter("ws_accepted_total", "Agent sockets accepted", fn=lambda: connections.accepted)
+Counter("ws_closed_total", "Agent sockets closed by the server", ("reason",),
+        fn=lambda: {("idle",): connections.idle_closed, ("slow",): connections.slow_closed,
+                    ("replaced",): connections.replaced})
+Gauge("commands_awaiting_ack", "Commands pushed to agents and not acked yet", fn=lambda: len(delivery.inflight))
+Gauge("ingest_pending_samples", "Metric samples waiting for the next flush", fn=metric_buffer.pending)
+Gauge("output_pending_bytes", "Command output waiting for the next flush", fn=lambda: output_buffer.stats()["pending_bytes"])
+Gauge("events_dashboards", "Dashboards streaming GET /events from this worker", fn=lambda: len(events.queues))
+Gauge("alert_queue_depth", "Alerts waiting for webhook delivery", fn=lambda: alert_dispatcher.queue.qsize())
+Gauge("db_pool_checked_out", "Pooled connections in use", ("engine",),
+      fn=lambda: {("sync",): engine.pool.checkedout(), ("async",): async_engine.pool.checkedout()})
+Gauge("db_pool_capacity", "Pool size plus overflow, per engine", fn=lambda: DB_POOL_SIZE + DB_MAX_OVERFLOW)
+
+@app.on_event("startup")
+async def start_background():
+    await maintain()  # today's metrics partition has to exist before the first flush
+    app.state.tasks = [asyncio.create_task(run_flusher(metric_buffer)),
+                       asyncio.create_task(listen_invalidations(aredis, on_device=device_deleted)),
+                       asyncio.create_task(run_presence(presence)),
+                       asyncio.create_task(run_maintenance()),
+                       asyncio.create_task(fanout.listen()),
+                       asyncio.create_task(fanout.refresh_owners()),
+                       asyncio.create_task(delivery.run()),
+                       asyncio.create_task(output_buffer.run()),
+                       asyncio.create_task(events.run()),
+                       asyncio.create_task(telemetry.watch_loop_lag()),
+                       asyncio.create_task(alert_engine.run()),
+                       asyncio.create_task(alert_dispatcher.run()),
+                       asyncio.create_task(anomaly.run()),
+                       asyncio.create_task(file_store.run_sweeper())]
+
+@app.on_event("shutdown")
+async def stop_background():
+    for t in app.state.tasks:
+        t.cancel()
+    await metric_buffer.flush()
 
 @app.get("/admin/login")
 def admin_login(authorization: str | None= Header(None)):
@@ -29,77 +129,376 @@ def admin_login(authorization: str | None= Header(None)):
     require_admin(authorization)
     return{"status" : "ok", "message" : "Admin token valid"}
 
-@app.post("/register", response_model =RegisterResp)
-def  register(req: RegisterReq, db: Session = Depends(get_db)):
-    existing_device = get_agent_by_hostname(db, req.hostname)
-    if existing_device:
-        print(f"Device found : {str(existing_device)}")
-        return DeviceResp.from_orm(existing_device)
+@app.post("/register", response_model=RegisterResp)
+async def register(req: RegisterReq, authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
+    """Idempotent: the same (hostname, fingerprint), or an agent presenting its token, always gets the same device."""
+    if authorization:
+        row = await enroll.reidentify(db, bearer_token(authorization), req)
+        if not row:
+            raise HTTPException(401, "Invalid token")
     else:
-        token = gen_token()
-        new_device = Device(hostname=req.hostname, os=req.os, arch=req.arch,
-                            agent_version= req.agent_version, token=token,
-                            last_seen=datetime.utcnow(), online=False)
-        db.add(new_device); db.commit(); db.refresh(new_device)
-        return RegisterResp.model_validate(new_device)
+        row = await enroll.register(db, req)
+        if not row:
+            raise HTTPException(409, "Hostname already enrolled; register with a fingerprint or the device token "
+                                     "(agents before 0.2 must be upgraded)")
+    await fleet.changed(aredis)
+    return {"id": row[0], "device_id": row[0], "token": row[1]}
+
+@app.post("/admin/enroll")
+async def bulk_enroll(items: List[EnrollItem], authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
+    """Pre-enroll devices by (hostname, fingerprint); their agents pick up these rows when they first register."""
+    require_admin(authorization)
+    if len(items) > MAX_BATCH:
+        raise HTTPException(413, f"At most {MAX_BATCH} devices per request")
+    created = await enroll.pre_enroll(db, items) if items else []
+    if created:
+        await fleet.changed(aredis)
+    return {"created": created, "existing": len(items) - len(created)}
 
 
 @app.post("/metrics")
-def metrics(m: MetricIn, authorization: str | None = Header(None), db: Session = Depends(get_db)):
-    dev = require_agent(db, authorization)
-    dev.last_seen = datetime.utcnow(); dev.online = True
-    row = Metric(device_id=dev.id, cpu=m.cpu, mem=m.mem, disk=m.disk,
-                 uptime_sec=m.uptime_sec, battery_pct=m.battery_pct,
-                 details=json.dumps(m.details or {}))
-    db.add(row); db.commit()
-    maybe_alert(dev, row)
+async def metrics(m: MetricIn, authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
+    dev = await require_agent_async(db, authorization)
+    metric_buffer.add(dev.id, [m])
+    events.metric(dev.id, m)
+    alert_engine.observe(dev.id, dev.hostname, m)
+    anomaly.observe(dev.id, dev.hostname, [m])
     return {"ok": True}
 
+@app.post("/metrics/batch")
+async def metrics_batch(request: Request, authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
+    """A JSON list of MetricIn, or the compact msgpack layout from wire.py (Content-Type: application/x-msgpack)."""
+    dev = await require_agent_async(db, authorization)
+    ctype = request.headers.get("content-type", "")
+    if ctype and not ctype.startswith(("application/json", wire.CONTENT_TYPE)):
+        raise HTTPException(415, "Send application/json or application/x-msgpack")
+    body = await request.body()
+    try:
+        if ctype.startswith(wire.CONTENT_TYPE):
+            samples = wire.decode_batch(body)
+        else:
+            samples = wire.metric_list.validate_json(body)
+    except ValidationError as e:
+        raise HTTPException(422, e.errors(include_url=False, include_context=False))
+    except Exception as e:
+        raise HTTPException(400, f"Malformed metrics batch: {e}")
+    if len(samples) > MAX_BATCH:
+        raise HTTPException(413, f"At most {MAX_BATCH} samples per batch")
+    if samples:
+        metric_buffer.add(dev.id, samples)
+        events.metric(dev.id, samples[-1])
+        alert_engine.observe(dev.id, dev.hostname, samples[-1])  # newest sample; agents send in time order
+        anomaly.observe(dev.id, dev.hostname, samples)
+    return {"ok": True, "accepted": len(samples)}
+
+@app.post("/images/batch")
+async def images_batch(records: List[ImageIn], authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
+    dev = await require_agent_async(db, authorization)
+    if len(records) > MAX_BATCH:
+        raise HTTPException(413, f"At most {MAX_BATCH} images per batch")
+    if not records:
+        return {"ok": True, "accepted": 0}
+    now = datetime.utcnow()
+    res = await db.execute(pg_insert(Image).values(
+        [dict(device_id=dev.id, filename=r.filename, size=r.size, created=utc_naive(r.created), received=now)
+         for r in records]).on_conflict_do_nothing(constraint="uq_images_device_file").returning(Image.id))
+    accepted = len(res.all())
+    await db.commit()
+    return {"ok": True, "accepted": accepted}
+
+async def record_file(db: AsyncSession, device_id: int, sha256: str, meta: dict):
+    await db.execute(pg_insert(StoredFile).values(
+        device_id=device_id, sha256=sha256, size=meta["size"], path=meta["path"], kind=meta["kind"],
+        command_id=meta.get("command_id"), received=datetime.utcnow()
+    ).on_conflict_do_nothing(constraint="uq_files_device_sha_path"))
+    await db.commit()
+
+def upload_error(e: UploadError) -> JSONResponse:
+    return JSONResponse({"detail": e.detail, "offset": e.offset}, status_code=e.status)
+
+@app.post("/uploads")
+async def start_upload(body: UploadStart, authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
+    """Start or resume an upload. "exists" means the content is already stored and nothing needs sending."""
+    dev = await require_agent_async(db, authorization)
+    try:
+        res = await asyncio.to_thread(file_store.begin, dev.id, body.sha256, body.size,
+                                      body.model_dump(include={"path", "kind", "command_id"}))
+    except UploadError as e:
+        return upload_error(e)
+    if res["status"] == "exists":
+        await record_file(db, dev.id, body.sha256, body.model_dump())
+    return res
+
+@app.put("/uploads/{upload_id}")
+async def upload_chunk(upload_id: str, request: Request, upload_offset: int = Header(...),
+                       authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
+    """Raw bytes appended at Upload-Offset, written to disk as they arrive. 409 carries the offset to resume from."""
+    dev = await require_agent_async(db, authorization)
+    try:
+        device_id, sha256 = parse_upload_id(upload_id)
+        if device_id != dev.id:
+            raise UploadError(404, "Unknown upload")
+        res = await file_store.write(upload_id, upload_offset, request.stream())
+    except UploadError as e:
+        return upload_error(e)
+    if res["status"] == "done":
+        await record_file(db, dev.id, sha256, res.pop("meta"))
+    return res
+
+@app.get("/devices/{device_id}/files")
+async def list_files(device_id: int, limit: int = Query(100, ge=1, le=1000),
+                     authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
+    require_admin(authorization)
+    rows = (await db.execute(select(StoredFile).where(StoredFile.device_id == device_id)
+                             .order_by(StoredFile.id.desc()).limit(limit))).scalars().all()
+    return [{"id": f.id, "sha256": f.sha256, "size": f.size, "path": f.path, "kind": f.kind,
+             "command_id": f.command_id, "received": f.received} for f in rows]
+
+@app.get("/files/{sha256}")
+def download_file(sha256: str, authorization: str | None = Header(None)):
+    require_admin(authorization)
+    if not valid_sha(sha256) or not file_store.exists(sha256):
+        raise HTTPException(404, "File not found")
+    return FileResponse(file_store.blob_path(sha256), media_type="application/octet-stream")
+
 @app.post("/heartbeat")
-def heartbeat(authorization: str | None = Header(None), db: Session = Depends(get_db)):
-    dev = require_agent(db, authorization)
-    dev.last_seen = datetime.utcnow(); dev.online = True
-    db.commit()
+async def heartbeat(authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
+    dev = await require_agent_async(db, authorization)
+    await presence.touch(dev.id)
     return {"ok": True}
 
 @app.post("/devices/{device_id}/commands", response_model=CommandOut)
-def create_command(device_id: int, body: CommandCreate, authorization: str | None = Header(None), db: Session = Depends(get_db)):
+async def create_command(device_id: int, body: CommandCreate, authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
     require_admin(authorization)
     cmd = Command(device_id=device_id, kind=body.kind, payload=body.payload or "")
-    db.add(cmd); db.commit(); db.refresh(cmd)
-    # notify via Redis (dashboards) and try WS push to agent
-    redis.publish("commands", json.dumps({"device_id": device_id, "cmd_id": cmd.id}))
-    ws = agent_ws.get(device_id)
-    if ws:
-        try: asyncio.create_task(ws.send_text(json.dumps({"cmd_id": cmd.id, "kind": cmd.kind, "payload": cmd.payload})))
-        except Exception: pass
+    db.add(cmd); await db.commit()
+    # on the loop, like every other writer of events.pending
+    events.command(device_id, cmd.id, "queued")
+    # notify via Redis (dashboards) and push to whichever worker holds the agent's socket
+    await aredis.publish("commands", json.dumps({"device_id": device_id, "cmd_id": cmd.id}))
+    # no owner means the agent is offline; the command is drained when it connects
+    await fanout.publish_many([(device_id, command_message(cmd))])
     return CommandOut(id=cmd.id, kind=cmd.kind, payload=cmd.payload or None)
 
+@app.post("/commands/broadcast", response_model=JobOut)
+async def broadcast_command(body: BroadcastCreate, authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
+    require_admin(authorization)
+    sel = body.selector
+    if sel.device_ids is None and sel.os is None and sel.arch is None and sel.online is None:
+        raise HTTPException(400, "Selector needs at least one criterion")
+    where = []
+    if sel.device_ids is not None:
+        where.append(Device.id.in_(sel.device_ids))
+    if sel.os:
+        where.append(Device.os.ilike(fleet.like_prefix(sel.os), escape="\\"))
+    if sel.arch:
+        where.append(Device.arch == sel.arch)
+    if sel.online is not None:
+        live = await presence.online_ids()
+        where.append(fleet.presence_filter(live, sel.online))
+    job = CommandJob(kind=body.kind, payload=body.payload or "", selector=sel.model_dump_json(exclude_none=True))
+    db.add(job)
+    await db.flush()
+    # one INSERT ... SELECT for the whole fleet instead of a row (and a round trip) per device
+    rows = (await db.execute(
+        insert(Command).from_select(
+            ["device_id", "kind", "payload", "status", "job_id", "created", "attempts"],
+            select(Device.id, literal(body.kind), literal(body.payload or ""), literal("queued"),
+                   literal(job.id), literal(datetime.utcnow()), literal(0)).where(*where))
+        .returning(Command.id, Command.device_id))).all()
+    job.total = len(rows)
+    await db.commit()
+    for r in rows:
+        events.command(r.device_id, r.id, "queued")
+    await aredis.publish("commands", json.dumps({"job_id": job.id, "count": job.total}))
+    # offline devices keep their commands queued and get them on connect
+    await fanout.publish_many([(r.device_id, {"cmd_id": r.id, "kind": body.kind, "payload": body.payload or ""})
+                               for r in rows])
+    return JobOut(id=job.id, kind=job.kind, total=job.total, counts={"queued": job.total})
+
+@app.get("/commands/jobs/{job_id}", response_model=JobOut)
+async def command_job(job_id: int, authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
+    require_admin(authorization)
+    job = await db.get(CommandJob, job_id)
+    if not job:
+        raise HTTPException(404, "Job not found")
+    counts = (await db.execute(select(Command.status, func.count()).where(Command.job_id == job_id)
+                               .group_by(Command.status))).all()
+    return JobOut(id=job.id, kind=job.kind, total=job.total, counts={s: n for s, n in counts})
+
 @app.post("/commands/{cmd_id}/status")
-def command_status(cmd_id: int, body: CommandUpdate, authorization: str | None = Header(None), db: Session = Depends(get_db)):
-    dev = require_agent(db, authorization)
-    cmd = db.query(Command).filter(Command.id==cmd_id, Command.device_id==dev.id).first()
-    if not cmd: raise HTTPException(404, "Command not found")
-    cmd.status = body.status; cmd.result = body.result
-    db.commit()
+async def command_status(cmd_id: int, body: CommandUpdate, authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
+    dev = await require_agent_async(db, authorization)
+    if body.result and body.output_offset is None:
+        # no offset (agents before 0.2.1): this command's output streamed to this worker goes
+        # first, flushed before we lock the row
+        await output_buffer.flush(keys=[(dev.id, cmd_id)])
+    res = await db.execute(update(Command).where(Command.id==cmd_id, Command.device_id==dev.id)
+                           .values(**body.model_dump(exclude_none=True, exclude={"result", "output_offset"})))
+    if not res.rowcount: raise HTTPException(404, "Command not found")
+    if body.result:
+        await output.append(db, dev.id, cmd_id, body.result.encode("utf-8"), body.output_offset)
+    await db.commit()
+    events.command(dev.id, cmd_id, body.status)
     return {"ok": True}
 
+@app.get("/commands/{cmd_id}", response_model=CommandInfo)
+async def command_info(cmd_id: int, authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
+    require_admin(authorization)
+    cmd = await db.get(Command, cmd_id)
+    if not cmd:
+        raise HTTPException(404, "Command not found")
+    return CommandInfo(id=cmd.id, device_id=cmd.device_id, kind=cmd.kind, status=cmd.status, created=cmd.created,
+                       exit_code=cmd.exit_code, output_size=cmd.output_size or 0, output_preview=cmd.output_preview)
+
+@app.get("/commands/{cmd_id}/output")
+async def command_output(cmd_id: int, range_: str | None = Header(None, alias="Range"),
+                         authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
+    """Stream the output, or the byte range asked for (Range: bytes=-65536 for the last 64 KiB)."""
+    require_admin(authorization)
+    total = (await db.execute(select(Command.output_size).where(Command.id == cmd_id))).scalar_one_or_none()
+    if total is None:
+        raise HTTPException(404, "Command not found")
+    headers = {"Accept-Ranges": "bytes"}
+    try:
+        span = parse_range(range_, total)
+    except RangeNotSatisfiable:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{total}"})
+    first, last = span or (0, total - 1)
+    headers["Content-Length"] = str(last - first + 1)
+    if span:
+        headers["Content-Range"] = f"bytes {first}-{last}/{total}"
+    return StreamingResponse(output.read(cmd_id, first, last), status_code=206 if span else 200,
+                             media_type="text/plain; charset=utf-8", headers=headers)
+
 @app.get("/devices")
-def list_devices(authorization: str | None = Header(None), db: Session = Depends(get_db)):
+async def list_devices(request: Request, after: int = 0, limit: int = Query(fleet.PAGE_DEFAULT, ge=1, le=fleet.PAGE_MAX),
+                       online: bool | None = None, os_: str | None = Query(None, alias="os"), arch: str | None = None,
+                       hostname: str | None = None, fields: str | None = None,
+                       authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
+    """One page of devices by id; pass the returned "next" as ?after= for the following page."""
+    require_admin(authorization)
+    try:
+        cols = fleet.parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    tag = await fleet.etag(aredis)
+    if tag and tag in (t.strip() for t in request.headers.get("if-none-match", "").split(",")):
+        return Response(status_code=304, headers={"ETag": tag})
+    body = await fleet.page(db, presence, cols, after, limit, online, os_, arch, hostname)
+    return JSONResponse(body, headers={"ETag": tag} if tag else None)
+
+def time_window(from_: datetime | None, to: datetime | None, default: timedelta) -> tuple[datetime, datetime]:
+    end = utc_naive(to) if to else datetime.utcnow()
+    start = utc_naive(from_) if from_ else end - default
+    if start >= end:
+        raise HTTPException(400, "'from' must be before 'to'")
+    return start, end
+
+@app.get("/devices/{device_id}/metrics")
+async def device_metrics(device_id: int, from_: datetime | None = Query(None, alias="from"), to: datetime | None = None,
+                         step: int | None = Query(None, ge=1), agg: str = "avg",
+                         authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
+    require_admin(authorization)
+    start, end = time_window(from_, to, timedelta(hours=1))
+    aggs = agg.split(",")
+    if not set(aggs) <= set(history.AGGS):
+        raise HTTPException(400, f"agg must be a comma-separated subset of {','.join(history.AGGS)}")
+    # plain JSONResponse: the columnar arrays don't need jsonable_encoder's per-value walk
+    return JSONResponse(await history.series(db, device_id, start, end, step, aggs))
+
+@app.get("/devices/{device_id}/metrics/raw")
+async def device_metrics_raw(device_id: int, from_: datetime | None = Query(None, alias="from"), to: datetime | None = None,
+                             cursor: str | None = None, limit: int = Query(1000, ge=1, le=10000),
+                             authorization: str | None = Header(None), db: AsyncSession = Depends(get_async_db)):
+    require_admin(authorization)
+    start, end = time_window(from_, to, timedelta(days=1))
+    try:
+        return JSONResponse(await history.raw_page(db, device_id, start, end, cursor, limit))
+    except ValueError:
+        raise HTTPException(400, "Invalid cursor")
+
+def device_deleted(device_id: int) -> None:
+    """Drop what this worker keeps about a deleted device. On the loop; runs once per worker via the invalidation listener."""
+    metric_buffer.forget(device_id)
+    anomaly.forget(device_id)
+
+@app.delete("/devices/{device_id}")
+def delete_device(device_id: int, authorization: str | None = Header(None), db: Session = Depends(get_db)):
+    require_admin(authorization)
+    if not db.get(Device, device_id):
+        raise HTTPException(404, "Device not found")
+    db.query(Metric).filter(Metric.device_id == device_id).delete(synchronize_session=False)
+    db.query(MetricRollup).filter(MetricRollup.device_id == device_id).delete(synchronize_session=False)
+    db.query(Command).filter(Command.device_id == device_id).delete(synchronize_session=False)
+    db.query(Image).filter(Image.device_id == device_id).delete(synchronize_session=False)
+    db.query(StoredFile).filter(StoredFile.device_id == device_id).delete(synchronize_session=False)  # blobs may be shared, kept
+    db.query(Device).filter(Device.id == device_id).delete(synchronize_session=False)
+    db.commit()
+    from_thread.run_sync(device_deleted, device_id)  # worker state belongs to the event loop
+    publish_invalidation(redis, device_id)  # ... and every other worker's listener does the same
+    from_thread.run(fleet.changed, aredis)
+    return {"ok": True}
+
+@app.get("/admin/stats")
+def admin_stats(authorization: str | None = Header(None)):
     require_admin(authorization)
-    q = db.query(Device).all()
-    return [{"id":d.id,"hostname":d.hostname,"os":d.os,"arch":d.arch,"online":d.online,"last_seen":d.last_seen.isoformat()} for d in q]
+    return {"token_cache": token_cache.stats(),
+            "ws": {"node": fanout.node_id, **connections.stats(), "delivered": fanout.delivered,
+                   "awaiting_ack": len(delivery.inflight), "redelivered": delivery.redelivered},
+            "alerts": {"fired": alert_engine.fired, "resolved": alert_engine.resolved, **alert_dispatcher.stats()},
+            "anomaly": anomaly.stats(),
+            "output": output_buffer.stats(),
+            "events": events.stats()}
+
+@app.get("/metrics")
+async def prometheus_metrics(request: Request, authorization: str | None = Header(None)):
+    """Prometheus scrape target for this worker (POST /metrics is agent ingest; only the method differs)."""
+    require_admin(authorization)
+    if "application/openmetrics-text" in request.headers.get("accept", ""):
+        return Response(telemetry.render(openmetrics=True), media_type=telemetry.OPENMETRICS_TYPE)
+    return Response(telemetry.render(), media_type=telemetry.TEXT_TYPE)
+
+@app.get("/events")
+async def fleet_events(authorization: str | None = Header(None)):
+    """Server-sent events: an "update" every few seconds with what changed per device, "resync" when some were lost.
+
+    Read GET /devices once for the starting state, then apply updates on top of it."""
+    require_admin(authorization)
+    return StreamingResponse(events.stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.websocket("/ws/agent/{device_id}")
 async def ws_agent(websocket: WebSocket, device_id: int):
+    if not await connections.authenticate(websocket, device_id):
+        return
     await websocket.accept()
-    agent_ws[device_id] = websocket
+    conn = connections.open(device_id, websocket)
+    events.device(device_id, connected=True)
+    drainer = None
     try:
+        await fanout.register(device_id)
+        drainer = asyncio.create_task(delivery.drain(device_id))  # waits on the queue; acks arrive below meanwhile
         while True:
-            msg = await websocket.receive_text()  # agents may send logs/status
-            # (Optional: forward to Redis or store)
+            msg = await connections.receive(conn)  # "hello"/"ping" heartbeats, acks, streamed output
+            if not msg.startswith("{"):
+                continue
+            data = json.loads(msg)
+            if data.get("type") == "ack":
+                await delivery.ack(device_id, int(data["cmd_id"]))
+            elif data.get("type") == "output":
+                offset = data.get("offset")  # agents before 0.2.1 send none
+                output_buffer.add(device_id, int(data["cmd_id"]), data.get("data") or "",
+                                  max(int(offset), 0) if offset is not None else None)
     except WebSocketDisconnect:
-        agent_ws.pop(device_id, None)
-
-
-    
\ No newline at end of file
+        pass
+    except Exception as e:
+        print(f"ws device {device_id} error: {e!r}")
+    finally:
+        if drainer is not None:
+            drainer.cancel()
+            await asyncio.gather(drainer, return_exceptions=True)  # lets it record what it already queued
+        if await connections.release(conn):  # not already replaced by a reconnect
+            delivery.forget(device_id)
+            events.device(device_id, connected=False)
+            await fanout.unregister(device_id)
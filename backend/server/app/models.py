@@ -1,12 +1,16 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Text
+from sqlalchemy import text, Column, Integer, BigInteger, String, Float, Boolean, DateTime, ForeignKey, Text, Index, UniqueConstraint, LargeBinary
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .db import Base
 
 class Device(Base):
     __tablename__ = "devices"
+    # enrollment keys: re-registering the same machine finds its row (see enroll.py)
+    __table_args__ = (UniqueConstraint("hostname", "fingerprint", name="uq_devices_host_fp"),
+                      Index("uq_devices_host_nofp", "hostname", unique=True, postgresql_where=text("fingerprint IS NULL")))
     id = Column(Integer, primary_key=True)
     hostname = Column(String, index=True)
+    fingerprint = Column(String, nullable=True)   # hash of machine id + MAC, computed by the agent
     os = Column(String)
     arch = Column(String)
     agent_version = Column(String)
@@ -18,9 +22,12 @@ class Device(Base):
 
 class Metric(Base):
     __tablename__ = "metrics"
-    id = Column(Integer, primary_key=True)
+    # range-partitioned by day on ts (see retention.py); the partition key has to be part of the PK
+    __table_args__ = (Index("ix_metrics_device_ts", "device_id", "ts"),
+                      {"postgresql_partition_by": "RANGE (ts)"})
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
     device_id = Column(Integer, ForeignKey("devices.id"))
-    ts = Column(DateTime, default=datetime.utcnow, index=True)
+    ts = Column(DateTime, primary_key=True, default=datetime.utcnow, index=True)
     cpu = Column(Float)
     mem = Column(Float)
     disk = Column(Float)
@@ -32,10 +39,98 @@ class Metric(Base):
 
 class Command(Base):
     __tablename__ = "commands"
+    # drain-on-connect looks up a device's queued/sent commands
+    __table_args__ = (Index("ix_commands_device_status", "device_id", "status"),
+                      Index("ix_commands_job_status", "job_id", "status"))
     id = Column(Integer, primary_key=True)
     device_id = Column(Integer, ForeignKey("devices.id"), index=True)
     created = Column(DateTime, default=datetime.utcnow)
     kind = Column(String)       # 'shell' | 'restart' | 'shutdown' | 'script'
     payload = Column(Text)      # JSON or script text
     status = Column(String, default="queued")  # queued|sent|ack|done|error
-    result = Column(Text, nullable=True)
+    exit_code = Column(Integer, nullable=True)
+    output_size = Column(BigInteger, default=0, server_default="0")  # bytes in command_output so far
+    output_preview = Column(String, nullable=True)                   # first few hundred characters
+    sent_at = Column(DateTime, nullable=True)  # last push to the agent
+    attempts = Column(Integer, default=0, server_default="0")
+    job_id = Column(Integer, ForeignKey("command_jobs.id"), nullable=True)  # set for broadcasts
+
+class CommandOutput(Base):
+    """A zlib-compressed piece of a command's stdout/stderr, at byte offset `start` of the whole (see output.py)."""
+    __tablename__ = "command_output"
+    command_id = Column(Integer, ForeignKey("commands.id", ondelete="CASCADE"), primary_key=True)
+    start = Column(BigInteger, primary_key=True)
+    size = Column(Integer)          # uncompressed length
+    data = Column(LargeBinary)
+
+class CommandJob(Base):
+    """One broadcast: the same command created for every device a selector matched."""
+    __tablename__ = "command_jobs"
+    id = Column(Integer, primary_key=True)
+    created = Column(DateTime, default=datetime.utcnow)
+    kind = Column(String)
+    payload = Column(Text)
+    selector = Column(Text)     # JSON of the DeviceSelector used
+    total = Column(Integer, default=0)
+
+
+class Image(Base):
+    """A photo the agent picked up from a watched folder."""
+    __tablename__ = "images"
+    # the agent retries batches, so a repeat of the same file is ignored
+    __table_args__ = (UniqueConstraint("device_id", "filename", "created", name="uq_images_device_file"),)
+    id = Column(BigInteger, primary_key=True)
+    device_id = Column(Integer, ForeignKey("devices.id"), index=True)
+    filename = Column(String)
+    size = Column(BigInteger)
+    created = Column(DateTime)          # file ctime on the device
+    received = Column(DateTime, default=datetime.utcnow)
+
+
+class StoredFile(Base):
+    """A file a device uploaded; the content lives in the file store under its sha256."""
+    __tablename__ = "files"
+    __table_args__ = (UniqueConstraint("device_id", "sha256", "path", name="uq_files_device_sha_path"),)
+    id = Column(BigInteger, primary_key=True)
+    device_id = Column(Integer, ForeignKey("devices.id"), index=True)
+    sha256 = Column(String(64), index=True)   # shared by every copy of the same content
+    size = Column(BigInteger)
+    path = Column(Text)                       # where it was on the device
+    kind = Column(String)                     # image | file
+    command_id = Column(Integer, nullable=True)  # set for uploads an admin asked for
+    received = Column(DateTime, default=datetime.utcnow)
+
+
+class MetricRollup(Base):
+    """min/avg/max/p95 per device per 1m, 1h or 1d bucket (see rollups.py)."""
+    __tablename__ = "metric_rollups"
+    resolution = Column(String(2), primary_key=True)  # '1m' | '1h' | '1d'
+    device_id = Column(Integer, ForeignKey("devices.id"), primary_key=True)
+    ts = Column(DateTime, primary_key=True)           # bucket start
+    n = Column(Integer)
+    cpu_min = Column(Float); cpu_avg = Column(Float); cpu_max = Column(Float); cpu_p95 = Column(Float)
+    mem_min = Column(Float); mem_avg = Column(Float); mem_max = Column(Float); mem_p95 = Column(Float)
+    disk_min = Column(Float); disk_avg = Column(Float); disk_max = Column(Float); disk_p95 = Column(Float)
+    battery_min = Column(Float); battery_avg = Column(Float); battery_max = Column(Float); battery_p95 = Column(Float)
+
+
+# Idempotent DDL for databases created before a model change (create_all only
+# creates missing tables, it never alters existing ones).
+SCHEMA_UPGRADES = [
+    "CREATE INDEX IF NOT EXISTS ix_metrics_device_ts ON metrics (device_id, ts)",
+    "ALTER TABLE commands ADD COLUMN IF NOT EXISTS sent_at TIMESTAMP WITHOUT TIME ZONE",
+    "ALTER TABLE commands ADD COLUMN IF NOT EXISTS attempts INTEGER DEFAULT 0",
+    "CREATE INDEX IF NOT EXISTS ix_commands_device_status ON commands (device_id, status)",
+    "ALTER TABLE commands ADD COLUMN IF NOT EXISTS job_id INTEGER REFERENCES command_jobs(id)",
+    "CREATE INDEX IF NOT EXISTS ix_commands_job_status ON commands (job_id, status)",
+    "ALTER TABLE commands ADD COLUMN IF NOT EXISTS exit_code INTEGER",
+    "ALTER TABLE devices ADD COLUMN IF NOT EXISTS fingerprint VARCHAR",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_devices_host_fp ON devices (hostname, fingerprint)",
+    # hostnames registered more than once before enrollment was idempotent: all but the newest row
+    # are marked so the index below can exist (they keep working by token)
+    "UPDATE devices d SET fingerprint = 'legacy-duplicate:' || d.id WHERE d.fingerprint IS NULL AND EXISTS "
+    "(SELECT 1 FROM devices n WHERE n.hostname = d.hostname AND n.fingerprint IS NULL AND n.id > d.id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_devices_host_nofp ON devices (hostname) WHERE fingerprint IS NULL",
+    "ALTER TABLE commands ADD COLUMN IF NOT EXISTS output_size BIGINT DEFAULT 0",
+    "ALTER TABLE commands ADD COLUMN IF NOT EXISTS output_preview VARCHAR",
+]
@@ -0,0 +1,225 @@
+import os, zlib, asyncio
+from sqlalchemy import select, update, insert, func, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import ProgrammingError
+from .db import AsyncSessionLocal
+from .models import Command, CommandOutput
+
+# --- command output ---
+# A command's stdout/stderr is kept out of its commands row. It is stored as
+# zlib-compressed chunks in command_output, each keyed by its byte offset in
+# the uncompressed output; commands only carries output_size and a short
+# preview, so queries over commands never drag output along. The agent
+# streams output in 4 KiB socket messages; they are coalesced per command and
+# written when CHUNK_SIZE bytes are pending or every FLUSH_INTERVAL, so a
+# chatty command costs a row per 64 KiB rather than one per message. read()
+# yields any byte range one chunk at a time, so serving a large output never
+# holds more than a chunk in memory.
+#
+# Agents from 0.2.1 tag each piece with its byte offset in the output, and
+# the status POST's result with the offset it continues from. Chunks are
+# stored at those offsets, so a piece still buffered on another worker lands
+# in place when that worker flushes, not after the result. Older agents send
+# no offsets and are appended at the current end.
+CHUNK_SIZE = 64 * 1024
+FLUSH_INTERVAL = float(os.getenv("OUTPUT_FLUSH_INTERVAL", "1.0"))
+MAX_PENDING = int(float(os.getenv("OUTPUT_MAX_PENDING_MB", "64")) * 1024 * 1024)  # cap while the DB is unreachable
+PREVIEW_CHARS = 256
+PREVIEW_BYTES = PREVIEW_CHARS * 4  # enough UTF-8 for PREVIEW_CHARS characters
+READ_PAGE = 16   # chunks per query when reading
+
+
+def chunk_rows(cmd_id: int, start: int, data: bytes) -> list[dict]:
+    return [dict(command_id=cmd_id, start=start + i, size=len(data[i:i + CHUNK_SIZE]),
+                 data=zlib.compress(data[i:i + CHUNK_SIZE], 6)) for i in range(0, len(data), CHUNK_SIZE)]
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str | None, total: int) -> tuple[int, int] | None:
+    """(first, last) for a single "bytes=" range of `total` bytes; None means send it all."""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None  # no range, another unit or several ranges: a plain 200 is a valid answer
+    a, _, b = header[6:].strip().partition("-")
+    try:
+        if a:
+            first, last = int(a), min(int(b), total - 1) if b else total - 1
+        else:  # "-n": the last n bytes, for tailing
+            first, last = max(total - int(b), 0), total - 1
+    except ValueError:
+        return None  # malformed ranges are ignored
+    if first < 0 or first > last:
+        raise RangeNotSatisfiable()
+    return first, last
+
+
+async def append(db, device_id: int, cmd_id: int, data: bytes, offset: int | None = None) -> bool:
+    """Write output at the agent's `offset` (None: at the current end) inside the caller's transaction.
+
+    False if it is not this device's command."""
+    if not data:
+        return True
+    mine = (Command.id == cmd_id, Command.device_id == device_id)
+    if offset is None:
+        # the row lock taken here orders concurrent appends, so each gets its own offset
+        end = (await db.execute(update(Command).where(*mine).values(output_size=Command.output_size + len(data))
+                                .returning(Command.output_size))).scalar()
+        if end is None:
+            return False
+        offset = end - len(data)
+    elif (await db.execute(update(Command).where(*mine)
+                           .values(output_size=func.greatest(Command.output_size, offset + len(data)))
+                           .returning(Command.id))).scalar() is None:
+        return False
+    # a piece the agent thought it failed to send may be here already; the longer one wins
+    stmt = pg_insert(CommandOutput)
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[CommandOutput.command_id, CommandOutput.start],
+        set_={"size": stmt.excluded.size, "data": stmt.excluded.data},
+        where=stmt.excluded.size > CommandOutput.size), chunk_rows(cmd_id, offset, data))
+    if offset < PREVIEW_BYTES:
+        await _refresh_preview(db, cmd_id)
+    return True
+
+
+async def _refresh_preview(db, cmd_id: int) -> None:
+    """The first PREVIEW_CHARS characters, from however many leading chunks have arrived so far."""
+    rows = (await db.execute(select(CommandOutput.start, CommandOutput.data)
+                             .where(CommandOutput.command_id == cmd_id, CommandOutput.start < PREVIEW_BYTES)
+                             .order_by(CommandOutput.start))).all()
+    head = b""
+    for r in rows:
+        if r.start != len(head):
+            break  # a piece before this one has not arrived yet
+        head += zlib.decompress(r.data)
+    await db.execute(update(Command).where(Command.id == cmd_id).values(
+        output_preview=head[:PREVIEW_BYTES].decode("utf-8", errors="ignore")[:PREVIEW_CHARS]))
+
+
+class OutputBuffer:
+    def __init__(self, session_factory=AsyncSessionLocal):
+        self.session_factory = session_factory
+        # (device_id, cmd_id) -> [[offset or None, [bytes, ...], size], ...]; contiguous pieces are merged
+        self._pending: dict[tuple[int, int], list[list]] = {}
+        self._bytes = 0
+        self._wake = asyncio.Event()
+        self.bytes_written = self.dropped = 0
+
+    # add() runs in the socket's receive loop and never does I/O
+    def add(self, device_id: int, cmd_id: int, chunk: str, offset: int | None = None) -> None:
+        data = chunk.encode("utf-8")
+        if self._bytes + len(data) > MAX_PENDING:
+            self.dropped += len(data)
+            return
+        pieces = self._pending.setdefault((device_id, cmd_id), [])
+        last = pieces[-1] if pieces else None
+        if last and (offset is None if last[0] is None else offset == last[0] + last[2]):
+            last[1].append(data)
+            last[2] += len(data)
+        else:
+            pieces.append([offset, [data], len(data)])
+        self._bytes += len(data)
+        if self._bytes >= CHUNK_SIZE:
+            self._wake.set()
+
+    async def flush(self, keys: list[tuple[int, int]] | None = None) -> int:
+        """Write what is pending, or only what is pending for `keys` ((device_id, cmd_id) pairs)."""
+        if keys is None:
+            pending, self._pending = self._pending, {}
+        else:
+            pending = {k: self._pending.pop(k) for k in keys if k in self._pending}
+        size = sum(p[2] for pieces in pending.values() for p in pieces)
+        self._bytes -= size
+        if not pending:
+            return 0
+        async with self.session_factory() as db:
+            try:
+                for (device_id, cmd_id), pieces in pending.items():
+                    for offset, parts, _ in pieces:
+                        await append(db, device_id, cmd_id, b"".join(parts), offset)
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                print(f"output flush failed ({len(pending)} commands): {e}")
+                for key, pieces in pending.items():  # in front of anything that arrived meanwhile
+                    self._pending[key] = pieces + self._pending.get(key, [])
+                self._bytes += size
+                return 0
+        written = size
+        self.bytes_written += written
+        return written
+
+    async def run(self, interval: float = FLUSH_INTERVAL):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"output flusher error: {e}")
+
+    def stats(self) -> dict:
+        return {"pending_bytes": self._bytes, "bytes_written": self.bytes_written, "dropped_bytes": self.dropped}
+
+
+async def read(cmd_id: int, first: int, last: int, session_factory=AsyncSessionLocal):
+    """Yield bytes first..last (inclusive) of a command's output, a chunk at a time.
+
+    Each page of chunks is fetched with a short-lived session, so a slow client
+    does not keep a pool connection checked out for the whole download."""
+    pos = first
+    while pos <= last:
+        async with session_factory() as db:
+            rows = (await db.execute(
+                select(CommandOutput.start, CommandOutput.size, CommandOutput.data)
+                .where(CommandOutput.command_id == cmd_id,
+                       CommandOutput.start > pos - CHUNK_SIZE,  # no chunk is longer, so the index range stays small
+                       CommandOutput.start + CommandOutput.size > pos,
+                       CommandOutput.start <= last)
+                .order_by(CommandOutput.start).limit(READ_PAGE))).all()
+        if not rows:
+            return
+        for r in rows:
+            if r.start + r.size <= pos:
+                continue  # inside a longer chunk already sent (chunks may overlap; the longer one was kept)
+            raw = zlib.decompress(r.data)
+            pos = max(pos, r.start)  # a hole only if a worker died holding output
+            yield raw[pos - r.start:last + 1 - r.start]
+            pos = r.start + len(raw)
+
+
+def migrate_legacy(engine) -> int:
+    """Move output stored in commands.result (before command_output existed) into chunks, then drop the column."""
+    moved = 0
+    try:
+        while True:
+            with engine.begin() as conn:
+                if not conn.execute(text("SELECT 1 FROM information_schema.columns "
+                                         "WHERE table_name = 'commands' AND column_name = 'result'")).first():
+                    return moved
+                # SKIP LOCKED: every worker runs this at startup
+                rows = conn.execute(text("SELECT id, result FROM commands WHERE result IS NOT NULL "
+                                         "ORDER BY id LIMIT 500 FOR UPDATE SKIP LOCKED")).all()
+                if not rows:
+                    # rows another worker had locked are done once we hold the table; drop only if nothing is left
+                    conn.execute(text("LOCK TABLE commands IN ACCESS EXCLUSIVE MODE"))
+                    if conn.execute(text("SELECT 1 FROM commands WHERE result IS NOT NULL LIMIT 1")).first():
+                        continue
+                    conn.execute(text("ALTER TABLE commands DROP COLUMN result"))
+                    return moved
+                for cmd_id, result in rows:
+                    data = result.encode("utf-8")
+                    if data:
+                        conn.execute(insert(CommandOutput), chunk_rows(cmd_id, 0, data))
+                    conn.execute(update(Command.__table__).where(Command.id == cmd_id).values(
+                        output_size=len(data), output_preview=result[:PREVIEW_CHARS]))
+                conn.execute(text("UPDATE commands SET result = NULL WHERE id = ANY(:ids)"),
+                             {"ids": [r[0] for r in rows]})
+                moved += len(rows)
+    except ProgrammingError:
+        return moved  # another worker dropped the column under us
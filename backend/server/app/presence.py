@@ -0,0 +1,117 @@
+import os, time, uuid, asyncio
+from datetime import datetime, timezone
+from sqlalchemy import update, values, column, Integer, DateTime
+from redis.exceptions import ResponseError
+from .db import AsyncSessionLocal
+from .models import Device
+
+# --- device presence ---
+# Heartbeats and metric flushes only touch Redis: a sorted set of
+# device_id -> last-seen epoch plus a "dirty" set of devices touched since the
+# last write-back. A background task copies last_seen to Postgres in one
+# UPDATE and flips devices that went quiet back to offline.
+PRESENCE_KEY = "presence:last_seen"
+DIRTY_KEY = "presence:dirty"
+OFFLINE_AFTER = float(os.getenv("PRESENCE_OFFLINE_AFTER", "90"))
+WRITEBACK_INTERVAL = float(os.getenv("PRESENCE_WRITEBACK_INTERVAL", "30"))
+
+
+def to_epoch(ts: datetime) -> float:
+    return ts.replace(tzinfo=timezone.utc).timestamp()
+
+
+def from_epoch(score: float) -> datetime:
+    return datetime.fromtimestamp(score, timezone.utc).replace(tzinfo=None)
+
+
+class PresenceStore:
+    """Presence on top of an async (redis.asyncio) client."""
+
+    def __init__(self, redis, session_factory=AsyncSessionLocal, offline_after: float = OFFLINE_AFTER, events=None):
+        self.redis = redis
+        self.events = events  # FleetEvents: told about online/offline flips
+        self.session_factory = session_factory
+        self.offline_after = offline_after
+
+    async def touch(self, device_id: int, ts: float | None = None) -> None:
+        await self.touch_many({device_id: ts or time.time()})
+
+    async def touch_many(self, seen: dict[int, float]) -> None:
+        if not seen:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(PRESENCE_KEY, {str(k): v for k, v in seen.items()})
+        pipe.sadd(DIRTY_KEY, *seen.keys())
+        await pipe.execute()
+
+    async def lookup(self, device_ids: list[int]) -> dict[int, float]:
+        """device_id -> last-seen epoch for devices present in Redis."""
+        if not device_ids:
+            return {}
+        scores = await self.redis.zmscore(PRESENCE_KEY, [str(i) for i in device_ids])
+        return {i: s for i, s in zip(device_ids, scores) if s is not None}
+
+    async def online_ids(self) -> list[int]:
+        cutoff = time.time() - self.offline_after
+        return [int(i) for i in await self.redis.zrangebyscore(PRESENCE_KEY, cutoff, "+inf")]
+
+    def is_online(self, score: float | None, now: float | None = None) -> bool:
+        return score is not None and score >= (now or time.time()) - self.offline_after
+
+    async def write_back(self) -> int:
+        # RENAME claims the dirty set atomically, so with several workers only
+        # one of them writes a given batch
+        claimed = f"{DIRTY_KEY}:{uuid.uuid4().hex}"
+        if not await self.redis.exists(DIRTY_KEY):
+            return 0
+        try:
+            await self.redis.rename(DIRTY_KEY, claimed)
+        except ResponseError:  # no such key: nothing touched since last time
+            return 0
+        try:
+            ids = list(await self.redis.smembers(claimed))
+            scores = await self.redis.zmscore(PRESENCE_KEY, ids) if ids else []
+            rows = [(int(i), from_epoch(s)) for i, s in zip(ids, scores) if s is not None]
+            if rows:
+                async with self.session_factory() as db:
+                    v = values(column("id", Integer), column("ts", DateTime), name="seen").data(rows)
+                    back = (await db.execute(update(Device).where(Device.id == v.c.id, Device.online.isnot(True))
+                                             .values(online=True).returning(Device.id)
+                                             .execution_options(synchronize_session=False))).scalars().all()
+                    await db.execute(update(Device).where(Device.id == v.c.id).values(last_seen=v.c.ts, online=True)
+                                     .execution_options(synchronize_session=False))
+                    await db.commit()
+                if self.events:
+                    for device_id in back:
+                        self.events.device(device_id, online=True)
+        except Exception:
+            await self.redis.sunionstore(DIRTY_KEY, [DIRTY_KEY, claimed])  # retry on the next pass
+            raise
+        finally:
+            await self.redis.delete(claimed)
+        return len(rows)
+
+    async def sweep(self) -> int:
+        cutoff = time.time() - self.offline_after
+        await self.redis.zremrangebyscore(PRESENCE_KEY, "-inf", cutoff)
+        async with self.session_factory() as db:
+            gone = (await db.execute(update(Device)
+                                     .where(Device.online.is_(True), Device.last_seen < from_epoch(cutoff))
+                                     .values(online=False).returning(Device.id)
+                                     .execution_options(synchronize_session=False))).scalars().all()
+            await db.commit()
+        if self.events:
+            for device_id in gone:
+                self.events.device(device_id, online=False)
+        return len(gone)
+
+
+async def run_presence(presence: PresenceStore, interval: float = WRITEBACK_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # write back first so the sweep sees fresh last_seen values
+            await presence.write_back()
+            await presence.sweep()
+        except Exception as e:
+            print(f"presence write-back error: {e}")
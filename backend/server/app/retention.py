@@ -0,0 +1,111 @@
+import os, re, asyncio
+from datetime import datetime, date, timedelta
+from sqlalchemy import text
+from .db import async_engine
+
+# --- metrics partitions and retention ---
+# metrics is range-partitioned by day (metrics_pYYYYMMDD) with a DEFAULT
+# partition for samples outside the pre-created range. Old raw data is dropped
+# a whole partition at a time; rollups are pruned with plain DELETEs per
+# resolution. A database whose metrics table predates partitioning falls back
+# to batched DELETEs.
+RAW_RETENTION_DAYS = int(os.getenv("METRICS_RAW_RETENTION_DAYS", "14"))
+ROLLUP_RETENTION_DAYS = {  # 0 keeps forever
+    "1m": int(os.getenv("METRICS_1M_RETENTION_DAYS", "30")),
+    "1h": int(os.getenv("METRICS_1H_RETENTION_DAYS", "400")),
+    "1d": int(os.getenv("METRICS_1D_RETENTION_DAYS", "0")),
+}
+PARTITION_AHEAD_DAYS = int(os.getenv("METRICS_PARTITION_AHEAD_DAYS", "3"))
+MAINTENANCE_INTERVAL = float(os.getenv("METRICS_MAINTENANCE_INTERVAL", "3600"))
+DELETE_BATCH = 10000
+
+_PARTITION = re.compile(r"metrics_p(\d{8})")
+
+
+def partition_name(day: date) -> str:
+    return f"metrics_p{day:%Y%m%d}"
+
+
+async def is_partitioned(conn) -> bool:
+    return (await conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+        "WHERE c.relname = 'metrics')"))).scalar()
+
+
+async def list_partitions(conn) -> list[str]:
+    res = await conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'metrics'"))
+    return [r[0] for r in res]
+
+
+async def ensure_partitions(engine=async_engine, today: date | None = None) -> None:
+    today = today or datetime.utcnow().date()
+    async with engine.connect() as conn:
+        if not await is_partitioned(conn):
+            return
+        existing = set(await list_partitions(conn))
+    stmts = ["CREATE TABLE IF NOT EXISTS metrics_default PARTITION OF metrics DEFAULT"]
+    for i in range(PARTITION_AHEAD_DAYS + 1):
+        day = today + timedelta(days=i)
+        if partition_name(day) not in existing:
+            stmts.append(f"CREATE TABLE IF NOT EXISTS {partition_name(day)} PARTITION OF metrics "
+                         f"FOR VALUES FROM ('{day}') TO ('{day + timedelta(days=1)}')")
+    for stmt in stmts:
+        # one transaction each: a day whose rows already sit in metrics_default
+        # cannot get its own partition and should not block the others
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(text(stmt))
+        except Exception as e:
+            print(f"partition maintenance: {stmt!r} failed: {e}")
+
+
+async def prune(engine=async_engine, now: datetime | None = None) -> None:
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(days=RAW_RETENTION_DAYS)
+    async with engine.connect() as conn:
+        partitioned = await is_partitioned(conn)
+    if partitioned:
+        async with engine.begin() as conn:
+            for name in await list_partitions(conn):
+                m = _PARTITION.fullmatch(name)
+                # a day partition covers [day, day + 1)
+                if m and datetime.strptime(m.group(1), "%Y%m%d") + timedelta(days=1) <= cutoff:
+                    await conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+            await conn.execute(text("DELETE FROM metrics_default WHERE ts < :cutoff"), {"cutoff": cutoff})
+    else:
+        while True:
+            async with engine.begin() as conn:
+                res = await conn.execute(text(
+                    "DELETE FROM metrics WHERE id IN (SELECT id FROM metrics WHERE ts < :cutoff LIMIT :n)"),
+                    {"cutoff": cutoff, "n": DELETE_BATCH})
+            if res.rowcount < DELETE_BATCH:
+                break
+    async with engine.begin() as conn:
+        for res, days in ROLLUP_RETENTION_DAYS.items():
+            if days:
+                await conn.execute(text("DELETE FROM metric_rollups WHERE resolution = :r AND ts < :cutoff"),
+                                   {"r": res, "cutoff": now - timedelta(days=days)})
+
+
+async def maintain(engine=async_engine) -> None:
+    # only one worker at a time does DDL; the others skip this round
+    async with engine.connect() as conn:
+        if not (await conn.execute(text("SELECT pg_try_advisory_lock(hashtext('metrics_maintenance'))"))).scalar():
+            return
+        try:
+            await ensure_partitions(engine)
+            await prune(engine)
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(hashtext('metrics_maintenance'))"))
+            await conn.commit()
+
+
+async def run_maintenance(interval: float = MAINTENANCE_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await maintain()
+        except Exception as e:
+            print(f"metrics maintenance error: {e}")
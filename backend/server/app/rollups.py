@@ -0,0 +1,72 @@
+from datetime import datetime
+from sqlalchemy import text
+
+# --- incremental rollups ---
+# After every ingest flush the buckets touched by the flushed rows are
+# recomputed: 1m buckets from raw metrics, 1h from 1m and 1d from 1h. Each
+# level only reads the handful of rows under the touched buckets, so the cost
+# follows the flush size and not the table size, and late samples are folded
+# into old buckets the same way as fresh ones.
+#
+# min/avg/max are exact at every level. p95 is exact for 1m; coarser levels
+# take the p95 of the finer buckets' p95s, which is an approximation.
+
+RESOLUTIONS = ("1m", "1h", "1d")
+UNITS = {"1m": "minute", "1h": "hour", "1d": "day"}
+PARENT = {"1h": "1m", "1d": "1h"}        # resolution -> the one it is built from
+FIELDS = {"cpu": "cpu", "mem": "mem", "disk": "disk", "battery": "battery_pct"}  # rollup prefix -> raw column
+
+TRUNC = {
+    "1m": lambda t: t.replace(second=0, microsecond=0),
+    "1h": lambda t: t.replace(minute=0, second=0, microsecond=0),
+    "1d": lambda t: t.replace(hour=0, minute=0, second=0, microsecond=0),
+}
+
+_COLS = ["n"] + [f"{p}_{s}" for p in FIELDS for s in ("min", "avg", "max", "p95")]
+_KEYS = ("(SELECT unnest(CAST(:ids AS integer[])) AS device_id, "
+         "unnest(CAST(:buckets AS timestamp[])) AS ts) k")
+_UPSERT = ("ON CONFLICT (resolution, device_id, ts) DO UPDATE SET "
+           + ", ".join(f"{c} = EXCLUDED.{c}" for c in _COLS))
+
+
+def _from_raw() -> str:
+    aggs = ", ".join(f"min(m.{c}), avg(m.{c}), max(m.{c}), percentile_cont(0.95) WITHIN GROUP (ORDER BY m.{c})"
+                     for c in FIELDS.values())
+    return (f"INSERT INTO metric_rollups (resolution, device_id, ts, {', '.join(_COLS)}) "
+            f"SELECT '1m', m.device_id, date_trunc('minute', m.ts) AS bucket, count(*), {aggs} "
+            f"FROM metrics m JOIN {_KEYS} "
+            f"ON m.device_id = k.device_id AND m.ts >= k.ts AND m.ts < k.ts + interval '1 minute' "
+            f"GROUP BY m.device_id, bucket ORDER BY m.device_id, bucket "  # fixed lock order across workers
+            f"{_UPSERT}")
+
+
+def _from_rollup(res: str) -> str:
+    unit, child = UNITS[res], PARENT[res]
+    aggs = ", ".join(f"min(r.{p}_min), "
+                     f"sum(r.{p}_avg * r.n) / nullif(sum(CASE WHEN r.{p}_avg IS NOT NULL THEN r.n END), 0), "
+                     f"max(r.{p}_max), percentile_cont(0.95) WITHIN GROUP (ORDER BY r.{p}_p95)"
+                     for p in FIELDS)
+    return (f"INSERT INTO metric_rollups (resolution, device_id, ts, {', '.join(_COLS)}) "
+            f"SELECT '{res}', r.device_id, date_trunc('{unit}', r.ts) AS bucket, sum(r.n), {aggs} "
+            f"FROM metric_rollups r JOIN {_KEYS} "
+            f"ON r.resolution = '{child}' AND r.device_id = k.device_id "
+            f"AND r.ts >= k.ts AND r.ts < k.ts + interval '1 {unit}' "
+            f"GROUP BY r.device_id, bucket ORDER BY r.device_id, bucket "
+            f"{_UPSERT}")
+
+
+STATEMENTS = {"1m": text(_from_raw()), "1h": text(_from_rollup("1h")), "1d": text(_from_rollup("1d"))}
+
+
+def touched_buckets(rows: list[dict], res: str) -> tuple[list[int], list[datetime]]:
+    trunc = TRUNC[res]
+    keys = sorted({(r["device_id"], trunc(r["ts"])) for r in rows})
+    return [k[0] for k in keys], [k[1] for k in keys]
+
+
+async def update_rollups(db, rows: list[dict]) -> None:
+    """Recompute every bucket the given metric rows fall into (finest level first)."""
+    for res in RESOLUTIONS:
+        ids, buckets = touched_buckets(rows, res)
+        if ids:
+            await db.execute(STATEMENTS[res], {"ids": ids, "buckets": buckets})
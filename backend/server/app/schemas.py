@@ -1,18 +1,24 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Optional, Any, Dict, List
+from datetime import datetime
 
 class RegisterReq(BaseModel):
     hostname: str
     os: str
     arch: str
     agent_version: str
+    fingerprint: Optional[str] = Field(None, min_length=16, max_length=128)
 
 class RegisterResp(BaseModel):
     id: int
+    device_id: int   # same as id; what agents before 0.2 read
     token: str
 
-    class Config:
-        from_attributes = True
+class EnrollItem(BaseModel):
+    hostname: str
+    fingerprint: str = Field(min_length=16, max_length=128)
+    os: Optional[str] = None
+    arch: Optional[str] = None
    
 class MetricIn(BaseModel):
     cpu: float
@@ -21,6 +27,19 @@ class MetricIn(BaseModel):
     uptime_sec: float
     battery_pct: Optional[float] = None
     details: Optional[Dict[str, Any]] = None
+    ts: Optional[datetime] = None  # sample time; server receive time when omitted
+
+class ImageIn(BaseModel):
+    filename: str
+    size: int
+    created: datetime   # epoch seconds or ISO
+
+class UploadStart(BaseModel):
+    sha256: str
+    size: int
+    path: str
+    kind: str = "file"   # image | file
+    command_id: Optional[int] = None
 
 class CommandCreate(BaseModel):
     kind: str
@@ -31,15 +50,35 @@ class CommandOut(BaseModel):
     kind: str
     payload: Optional[str] = None
 
-class CommandUpdate(BaseModel):
+class CommandInfo(BaseModel):
+    id: int
+    device_id: int
+    kind: str
     status: str
-    result: Optional[str] = None
+    created: datetime
+    exit_code: Optional[int] = None
+    output_size: int                        # bytes; GET /commands/{id}/output has the rest
+    output_preview: Optional[str] = None
 
+class DeviceSelector(BaseModel):
+    device_ids: Optional[List[int]] = None
+    os: Optional[str] = None        # prefix, case-insensitive ("windows" matches "Windows 10")
+    arch: Optional[str] = None
+    online: Optional[bool] = None   # from live presence, not the written-back column
 
-# This is to avoid register again and agian for same device in db
-class DeviceResp(BaseModel):
-    id : int
-    token : str
+class BroadcastCreate(BaseModel):
+    kind: str
+    payload: Optional[str] = None
+    selector: DeviceSelector
+
+class JobOut(BaseModel):
+    id: int
+    kind: str
+    total: int
+    counts: Dict[str, int]
 
-    class Config:
-        from_attributes = True
\ No newline at end of file
+class CommandUpdate(BaseModel):
+    status: str
+    result: Optional[str] = None     # appended to the output; omitted when it was streamed over the socket
+    output_offset: Optional[int] = Field(None, ge=0)  # where result goes in the output (agents 0.2.1+); None: at the end
+    exit_code: Optional[int] = None
@@ -0,0 +1,214 @@
+import os, time, asyncio, resource
+from bisect import bisect_left
+
+# --- Prometheus exposition (GET /metrics) ---
+# Counters, gauges and histograms kept in plain dicts keyed by label values
+# and rendered on scrape, in the Prometheus text format or OpenMetrics when
+# the scraper asks for it. Recording is a dict lookup and a bisect on the
+# event loop, with no locks: every update happens on the loop thread, except
+# pool checkouts from the sync engine's threadpool, where a lost increment
+# under a race costs a sample, not correctness. Values are per worker
+# process. Gauges that mirror state kept elsewhere (socket count, queue
+# depths, pool usage) take a function, which is read only at scrape time.
+PREFIX = "clientdesk_"
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+FAST_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1)
+LAG_BUCKETS = (.1, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+
+OPENMETRICS_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+TEXT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry: list = []
+
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), fn=None):
+        self.name = PREFIX + name
+        self.doc = doc
+        self.label_names = labels
+        self.fn = fn  # () -> value, or {label values: value}, read at scrape time
+        self.values: dict[tuple, float] = {}
+        _registry.append(self)
+
+    def _samples(self):
+        if self.fn is None:
+            return self.values.items()
+        v = self.fn()
+        return v.items() if isinstance(v, dict) else [((), v)]
+
+    def render(self, openmetrics: bool) -> list[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        for key, v in self._samples():
+            lines.append(f"{self.name}{_labels(self.label_names, key)} {_num(v)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, n: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + n
+
+    def render(self, openmetrics: bool) -> list[str]:
+        # OpenMetrics names the family without _total; the text format names it with
+        name = self.name[:-6] if openmetrics else self.name
+        lines = [f"# HELP {name} {self.doc}", f"# TYPE {name} counter"]
+        for key, v in self._samples():
+            lines.append(f"{self.name}{_labels(self.label_names, key)} {_num(v)}")
+        return lines
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, v: float, *labels) -> None:
+        self.values[labels] = v
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+        self.series: dict[tuple, list] = {}  # label values -> [count per bucket..., +Inf count, sum]
+
+    def observe(self, v: float, *labels) -> None:
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [0] * (len(self.buckets) + 2)
+        s[bisect_left(self.buckets, v)] += 1
+        s[-1] += v
+
+    def render(self, openmetrics: bool) -> list[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for key, s in list(self.series.items()):
+            total = 0
+            for bound, n in zip(self.buckets + (float("inf"),), s):
+                total += n
+                le = 'le="%s"' % _num(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_num(s[-1])}")
+        return lines
+
+
+class timer:
+    """with timer(histogram, *labels): observes the block's wall time."""
+    __slots__ = ("hist", "labels", "t0")
+
+    def __init__(self, hist: Histogram, *labels):
+        self.hist, self.labels = hist, labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.t0, *self.labels)
+
+
+def render(openmetrics: bool = False) -> str:
+    lines = []
+    for m in _registry:
+        try:
+            lines += m.render(openmetrics)
+        except Exception as e:  # one broken gauge function must not cost the scrape
+            print(f"metric {m.name} failed: {e}")
+    if openmetrics:
+        lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+# --- what the API records ---
+http_duration = Histogram("http_request_duration_seconds",
+                          "Time from request start to response headers, by route template",
+                          ("method", "route", "status"))
+ingest_samples = Counter("ingest_samples_total", "Metric samples accepted by /metrics and /metrics/batch")
+ingest_rows = Counter("ingest_rows_written_total", "Metric rows committed to Postgres")
+ingest_flush = Histogram("ingest_flush_seconds", "Metric buffer flush: insert, presence and commit")
+db_checkout = Histogram("db_pool_checkout_seconds",
+                        "Time to get a pooled connection, including waiting for one and connecting",
+                        ("engine",), buckets=FAST_BUCKETS)
+redis_publish = Histogram("redis_publish_seconds", "Redis PUBLISH round trip (pipelines count once)",
+                          ("channel",), buckets=FAST_BUCKETS)
+alert_lag = Histogram("alert_delivery_lag_seconds", "Time from an alert being queued to its webhook post succeeding",
+                      buckets=LAG_BUCKETS)
+loop_lag = Histogram("event_loop_lag_seconds", "How late the event loop wakes a sleeping task",
+                     buckets=FAST_BUCKETS)
+
+
+def _rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:  # not Linux: peak instead of current
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _cpu() -> float:
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+
+Counter("process_cpu_seconds_total", "User and system CPU time of this worker", fn=_cpu)
+Gauge("process_resident_memory_bytes", "Resident set size of this worker", fn=_rss)
+
+
+async def watch_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    """Sleep `interval` over and over and record how much later than asked the loop woke us."""
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(time.perf_counter() - t0 - interval, 0.0))
+
+
+class TelemetryMiddleware:
+    """Per-route latency to the response headers; streamed bodies (SSE, output downloads) are not waited for."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        t0 = time.perf_counter()
+        done = False
+
+        def record(status):
+            nonlocal done
+            done = True
+            route = scope.get("route")  # set by the router on this same scope once it matched
+            http_duration.observe(time.perf_counter() - t0, scope["method"],
+                                  route.path if route is not None else "<unmatched>", status)
+
+        async def timed_send(msg):
+            if msg["type"] == "http.response.start":
+                record(msg["status"])
+            await send(msg)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        except BaseException:
+            if not done:
+                record(500)
+            raise
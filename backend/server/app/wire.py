@@ -0,0 +1,32 @@
+import msgpack
+from typing import List
+from pydantic import TypeAdapter
+from .schemas import MetricIn
+
+# --- compact metrics batches ---
+# Decoder for the agents' application/x-msgpack batch format (see
+# agent/wire.py for the layout): positional samples, delta-coded epoch-ms
+# timestamps, and details sent only as the keys that changed since the
+# previous sample of the same batch. Decodes into the same MetricIn models as
+# the JSON path.
+CONTENT_TYPE = "application/x-msgpack"
+VERSION = 1
+
+metric_list = TypeAdapter(List[MetricIn])
+
+
+def decode_batch(body: bytes) -> List[MetricIn]:
+    doc = msgpack.unpackb(body, raw=False)
+    if not isinstance(doc, dict) or doc.get("v") != VERSION:
+        raise ValueError("unsupported metrics batch version")
+    out, ts, details = [], 0, {}
+    for row in doc["s"]:
+        dts, cpu, mem, disk, uptime, battery, changed = row[:7]
+        ts += dts
+        if changed or len(row) > 7:
+            details = {**details, **(changed or {})}
+            for k in (row[7] if len(row) > 7 else ()):
+                details.pop(k, None)
+        out.append({"ts": ts / 1000, "cpu": cpu, "mem": mem, "disk": disk, "uptime_sec": uptime,
+                    "battery_pct": battery, "details": details or None})
+    return metric_list.validate_python(out)
@@ -0,0 +1,125 @@
+import sys
+import os
+import json
+import time
+import asyncio
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from redis.asyncio import Redis as AsyncRedis
+from app.schemas import MetricIn
+from app import alerts, alerting
+from app.alerts import AlertDispatcher
+from app.alerting import AlertEngine
+
+# Local stand-in for the Slack webhook plus two checks against it:
+#   dispatcher - a burst of alerts is batched, paced to the rate limit and
+#                retried through a 500 and a 429 without losing any
+#   engine     - two engines (two API workers) sharing Redis see the same
+#                samples; each transition is notified exactly once and the
+#                hysteresis band and cooldown hold back repeats
+# `python alert_webhook.py serve` just runs the stand-in and prints what it gets.
+
+class Webhook(BaseHTTPRequestHandler):
+    script: list[int] = []      # status codes to answer with before returning 200
+    received: list[tuple[float, str]] = []
+    echo = False
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        status = Webhook.script.pop(0) if Webhook.script else 200
+        if status == 200:
+            Webhook.received.append((time.monotonic(), json.loads(body)["text"]))
+            if Webhook.echo:
+                print(json.loads(body)["text"], flush=True)
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+def start_webhook(port: int) -> str:
+    srv = ThreadingHTTPServer(("127.0.0.1", port), Webhook)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{srv.server_address[1]}"
+
+
+def check(name: str, ok: bool, detail: str = ""):
+    print(f"{'PASS' if ok else 'FAIL'}  {name}  {detail}")
+
+
+async def dispatcher_check(url: str, n: int):
+    Webhook.received.clear()
+    Webhook.script[:] = [500, 429]
+    d = AlertDispatcher(webhook=url)
+    task = asyncio.create_task(d.run())
+    for i in range(n):
+        d.send(f"device-{i} threshold", f"CPU {90 + i % 10}%")
+    deadline = time.monotonic() + 30
+    while d.sent + d.failed < n and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    task.cancel()
+    lines = sum(text.count("threshold") for _, text in Webhook.received)
+    gaps = [b - a for (a, _), (b, _) in zip(Webhook.received, Webhook.received[1:])]
+    check("all alerts delivered", lines == n and d.failed == 0, f"{lines}/{n} in {len(Webhook.received)} posts")
+    check("batched", len(Webhook.received) <= -(-n // alerts.BATCH_MAX) + 1)
+    check("rate limited", all(g >= 1 / alerts.RATE_PER_SEC - 0.05 for g in gaps),
+          f"min gap {min(gaps, default=0):.2f}s")
+
+
+async def engine_check(redis_host: str):
+    aredis = AsyncRedis(host=redis_host, port=6379, decode_responses=True)
+    device_id = 900_000 + os.getpid()
+    await aredis.delete(*(k(r.name, device_id) for r in alerting.DEFAULT_RULES
+                          for k in (alerting.firing_key, alerting.cooldown_key)))
+    notes = []
+    workers = [AlertEngine(aredis, notify=lambda t, x: notes.append((t, x))) for _ in range(2)]
+    alerting.COOLDOWN = 3
+
+    def sample(cpu):
+        return MetricIn(cpu=cpu, mem=10, disk=10, uptime_sec=1)
+
+    async def feed(cpu):
+        for w in workers:  # both workers get a sample for the device in the same round
+            w.observe(device_id, "bench-host", sample(cpu))
+        await asyncio.gather(*(w.evaluate() for w in workers))
+
+    await feed(96); await feed(97)
+    check("fires once across workers", len(notes) == 1 and "threshold" in notes[0][0], str(notes))
+    await feed(90)
+    check("no resolve inside hysteresis band", len(notes) == 1)
+    await feed(80)
+    check("resolves once", len(notes) == 2 and "recovered" in notes[1][0], str(notes[1:]))
+    await feed(96)
+    check("held back by cooldown", len(notes) == 2)
+    await asyncio.sleep(alerting.COOLDOWN + 0.5)
+    await feed(96)
+    check("fires again after cooldown", len(notes) == 3)
+    await aredis.aclose()
+
+
+async def main(args):
+    url = start_webhook(args.port)
+    await dispatcher_check(url, args.alerts)
+    await engine_check(args.redis)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("mode", nargs="?", default="check", choices=["check", "serve"])
+    ap.add_argument("--port", type=int, default=0)
+    ap.add_argument("--alerts", type=int, default=50)
+    ap.add_argument("--redis", default=os.getenv("REDIS_HOST", "localhost"))
+    args = ap.parse_args()
+    if args.mode == "serve":
+        Webhook.echo = True
+        print(f"webhook stand-in on {start_webhook(args.port or 9009)}; set SLACK_WEBHOOK_URL to it")
+        threading.Event().wait()
+    else:
+        asyncio.run(main(args))
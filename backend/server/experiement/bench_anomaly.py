@@ -0,0 +1,69 @@
+import sys
+import os
+import time
+import asyncio
+import random
+import argparse
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from app.schemas import MetricIn
+from app.anomaly import AnomalyDetector
+
+# Throughput and memory of the anomaly detector at fleet size, plus a sanity
+# check that it catches the three patterns it is for. Runs in-process, no
+# database or Redis needed.
+
+def scenario_check():
+    found = []
+    det = AnomalyDetector(notify=lambda title, text: found.append((title, text)))
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    for i in range(8 * 240):  # 8 hours of 15 s samples
+        ts = start + timedelta(seconds=15 * i)
+        h = i / 240
+        normal = MetricIn(cpu=random.gauss(20, 3), mem=random.gauss(40, 1), disk=50.0, uptime_sec=i, ts=ts)
+        filling = MetricIn(cpu=20, mem=40, disk=60 + 2.0 * h + random.gauss(0, 0.1), uptime_sec=i, ts=ts)
+        leaking = MetricIn(cpu=20, mem=30 + 6 * h + random.gauss(0, 0.5), disk=50.0, uptime_sec=i, ts=ts)
+        spiky = MetricIn(cpu=99.0 if i == 1000 else random.gauss(15, 2), mem=40, disk=50.0, uptime_sec=i, ts=ts)
+        for device_id, m in enumerate((normal, filling, leaking, spiky)):
+            det.observe(device_id, ["normal", "filling", "leaking", "spiky"][device_id], [m])
+    asyncio.run(det.emit())
+    kinds = {title for title, _ in found}
+    for title, text in found:
+        print(f"  {title}: {text}")
+    for want in ("filling disk filling", "leaking mem creep", "spiky cpu spike"):
+        print(f"{'PASS' if any(want in k for k in kinds) else 'FAIL'}  {want}")
+    print(f"{'PASS' if not any('normal' in k for k in kinds) else 'FAIL'}  nothing on the normal device")
+
+
+def throughput(devices: int, rounds: int):
+    det = AnomalyDetector(notify=lambda *a: None)
+    t0 = time.time()
+    elapsed = 0.0
+    for r in range(rounds):
+        ts = datetime.fromtimestamp(t0 + 15 * r, timezone.utc)
+        samples = [MetricIn(cpu=random.uniform(0, 100), mem=random.uniform(20, 80), disk=random.uniform(10, 90),
+                            uptime_sec=1, ts=ts) for _ in range(100)]
+        start = time.perf_counter()
+        for d in range(devices):
+            det.observe(d, "dev", [samples[d % 100]])
+        elapsed += time.perf_counter() - start
+    print(f"{devices} devices x {rounds} samples: {elapsed / (devices * rounds) * 1e6:.1f} us/sample")
+
+    tracemalloc.start()  # state size only; tracing slows everything down
+    det = AnomalyDetector(notify=lambda *a: None)
+    for d in range(devices):
+        det.observe(d, f"dev-{d}", [samples[d % 100]])
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"state {current / devices:.0f} B/device (hostname and slot map included), {current / 1e6:.1f} MB total")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--devices", type=int, default=50000)
+    ap.add_argument("--rounds", type=int, default=4)
+    args = ap.parse_args()
+    scenario_check()
+    throughput(args.devices, args.rounds)
@@ -0,0 +1,78 @@
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import httpx
+import websockets
+
+from load_agents import percentile
+
+# Command delivery latency across API workers: registers --agents devices,
+# holds one WebSocket per device, then creates commands through the admin
+# API and measures POST-to-socket time. Start the server with several workers
+# (uvicorn app.main:app --workers N) so most commands are published on one
+# worker and delivered by another.
+
+async def hold_socket(ws_url: str, device_id: int, token: str, sent: dict[str, float], lat: list[float], ready: asyncio.Event,
+                      stop: asyncio.Event):
+    async with websockets.connect(f"{ws_url}/ws/agent/{device_id}",
+                                  extra_headers={"Authorization": f"Bearer {token}"}) as ws:
+        ready.set()
+        while not stop.is_set():
+            try:
+                msg = json.loads(await asyncio.wait_for(ws.recv(), 1))
+            except asyncio.TimeoutError:
+                continue
+            nonce = (msg.get("payload") or "").removeprefix("echo ")
+            if nonce in sent:
+                lat.append(time.perf_counter() - sent.pop(nonce))
+
+async def run(args):
+    admin = {"Authorization": f"Bearer {args.admin_token}"}
+    async with httpx.AsyncClient(base_url=args.api, timeout=30,
+                                 limits=httpx.Limits(max_connections=args.concurrency)) as client:
+        ids, tokens = [], []
+        for i in range(args.agents):
+            r = await client.post("/register", json={"hostname": f"bench-fanout-{i}", "os": "bench",
+                                                     "arch": "x86_64", "agent_version": "bench",
+                                                     "fingerprint": f"bench-fanout-{i:016d}"})
+            ids.append(r.json()["id"])
+            tokens.append(r.json()["token"])
+        sent: dict[str, float] = {}
+        lat: list[float] = []
+        stop = asyncio.Event()
+        readies = [asyncio.Event() for _ in ids]
+        holders = [asyncio.create_task(hold_socket(args.ws, d, t, sent, lat, e, stop))
+                   for d, t, e in zip(ids, tokens, readies)]
+        await asyncio.gather(*(e.wait() for e in readies))
+        await asyncio.sleep(0.5)  # let owner keys land
+
+        sem = asyncio.Semaphore(args.concurrency)
+        async def post(device_id: int):
+            async with sem:
+                nonce = uuid.uuid4().hex
+                sent[nonce] = time.perf_counter()
+                await client.post(f"/devices/{device_id}/commands", headers=admin,
+                                  json={"kind": "shell", "payload": f"echo {nonce}"})
+        start = time.perf_counter()
+        await asyncio.gather(*(post(ids[i % len(ids)]) for i in range(args.commands)))
+        deadline = time.perf_counter() + 10
+        while sent and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await asyncio.gather(*holders, return_exceptions=True)
+    print(f"{args.commands} commands to {args.agents} sockets in {elapsed:.2f}s, lost {len(sent)}")
+    print(f"delivery latency p50 {percentile(lat, 50) * 1000:.1f} ms  p99 {percentile(lat, 99) * 1000:.1f} ms"
+          f"  max {max(lat, default=0) * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--api", default="http://localhost:8000")
+    ap.add_argument("--ws", default="ws://localhost:8000")
+    ap.add_argument("--admin-token", default="supersecretadmin")
+    ap.add_argument("--agents", type=int, default=200)
+    ap.add_argument("--commands", type=int, default=2000)
+    ap.add_argument("--concurrency", type=int, default=50)
+    asyncio.run(run(ap.parse_args()))
@@ -0,0 +1,86 @@
+import sys
+import os
+import time
+import asyncio
+import argparse
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from app.db import SessionLocal, Base, engine
+from app.models import Device, Metric
+from app.schemas import MetricIn
+from app.ingest import MetricBuffer
+from app.auth import gen_token
+
+# Compares the old per-request write path (one INSERT + device UPDATE + commit
+# per sample) against MetricBuffer's bulk flush. Runs against DATABASE_URL and
+# removes the rows it wrote afterwards.
+
+def make_devices(db, n: int) -> list[int]:
+    devs = [Device(hostname=f"bench-ingest-{i}", os="bench", arch="x86_64", agent_version="bench",
+                   token=gen_token(), last_seen=datetime.utcnow(), online=False) for i in range(n)]
+    db.add_all(devs); db.commit()
+    return [d.id for d in devs]
+
+def sample(i: int) -> MetricIn:
+    return MetricIn(cpu=i % 100, mem=50.0, disk=70.0, uptime_sec=1000.0 + i, battery_pct=None,
+                    details={"load_avg": [0.1, 0.2, 0.3], "disks": {"/": 70.0}})
+
+def per_request(device_ids: list[int], rows: int) -> float:
+    db = SessionLocal()
+    try:
+        start = time.perf_counter()
+        for i in range(rows):
+            dev = db.get(Device, device_ids[i % len(device_ids)])
+            dev.last_seen = datetime.utcnow(); dev.online = True
+            m = sample(i)
+            db.add(Metric(device_id=dev.id, cpu=m.cpu, mem=m.mem, disk=m.disk, uptime_sec=m.uptime_sec,
+                          battery_pct=m.battery_pct, details="{}"))
+            db.commit()
+        return rows / (time.perf_counter() - start)
+    finally:
+        db.close()
+
+async def batched(device_ids: list[int], rows: int, batch: int, flush_rows: int) -> float:
+    buf = MetricBuffer(max_rows=flush_rows)
+    start = time.perf_counter()
+    for i in range(0, rows, batch):
+        buf.add(device_ids[(i // batch) % len(device_ids)], [sample(j) for j in range(i, min(i + batch, rows))])
+        if buf.pending() >= flush_rows:
+            await buf.flush()
+    await buf.flush()
+    return rows / (time.perf_counter() - start)
+
+def cleanup(device_ids: list[int]):
+    db = SessionLocal()
+    try:
+        db.query(Metric).filter(Metric.device_id.in_(device_ids)).delete(synchronize_session=False)
+        db.query(Device).filter(Device.id.in_(device_ids)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=5000)
+    ap.add_argument("--devices", type=int, default=50)
+    ap.add_argument("--batch", type=int, default=4, help="samples per /metrics/batch call")
+    ap.add_argument("--flush-rows", type=int, default=1000)
+    args = ap.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        ids = make_devices(db, args.devices)
+    finally:
+        db.close()
+    try:
+        slow = per_request(ids, args.rows)
+        fast = asyncio.run(batched(ids, args.rows, args.batch, args.flush_rows))
+        print(f"per-request commit : {slow:10.0f} rows/s")
+        print(f"buffered bulk flush: {fast:10.0f} rows/s  ({fast / slow:.1f}x)")
+    finally:
+        cleanup(ids)
+
+if __name__ == "__main__":
+    main()
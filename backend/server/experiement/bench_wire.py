@@ -0,0 +1,62 @@
+import sys
+import os
+import gzip
+import json
+import time
+import random
+import argparse
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "agent"))
+
+import wire as agent_wire
+from app import wire
+
+# Bytes per sample and server decode cost for a metrics batch in the JSON and
+# compact msgpack formats, raw and gzipped as the agent uploads them. Samples
+# look like the collector's: cpu/mem every 15 s, load average drifting, the
+# disk map only changing on its 5 min interval.
+
+def samples(n: int, mounts: int) -> list[dict]:
+    out, t = [], 1_760_000_000.0
+    disks = {("/" if i == 0 else f"/mnt/data{i}"): round(random.uniform(10, 90), 1) for i in range(mounts)}
+    load = [0.5, 0.4, 0.3]
+    for i in range(n):
+        t += 15
+        if i % 20 == 0:
+            disks = {k: round(v + random.uniform(0, 0.3), 1) for k, v in disks.items()}
+        if i % 2 == 0:
+            load = [round(max(0.0, x + random.uniform(-0.2, 0.2)), 2) for x in load]
+        out.append({"cpu": round(random.uniform(0, 100), 1), "mem": round(random.uniform(30, 60), 1),
+                    "disk": disks["/"], "uptime_sec": 86400.0 + i * 15, "battery_pct": None,
+                    "details": {"load_avg": load, "disks": disks},
+                    "ts": time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(t))})
+    return out
+
+
+def timed(fn, reps: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(reps):
+        fn()
+    return (time.perf_counter() - t0) / reps
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--batch", type=int, default=500, help="samples per upload (the agent sends 500)")
+    ap.add_argument("--mounts", type=int, default=4)
+    args = ap.parse_args()
+
+    batch = samples(args.batch, args.mounts)
+    as_json = json.dumps(batch, separators=(",", ":")).encode()
+    as_pack = agent_wire.encode_batch(batch)
+    assert [m.model_dump() for m in wire.decode_batch(as_pack)] == \
+           [m.model_dump() for m in wire.metric_list.validate_json(as_json)]
+
+    reps = max(1, 10_000 // args.batch)
+    print(f"{args.batch} samples/batch, {args.mounts} mounts")
+    for name, body, decode in (("json", as_json, lambda: wire.metric_list.validate_json(as_json)),
+                               ("msgpack", as_pack, lambda: wire.decode_batch(as_pack))):
+        gz = gzip.compress(body, compresslevel=6)
+        per_10k = timed(decode, reps) * 10_000 / args.batch
+        print(f"{name:8s} {len(body) / args.batch:7.1f} B/sample  gzip {len(gz) / args.batch:6.1f} B/sample  "
+              f"decode {per_10k * 1000:7.1f} ms/10k samples")
@@ -0,0 +1,416 @@
+import os
+import sys
+import json
+import gzip
+import time
+import random
+import asyncio
+import argparse
+import resource
+import subprocess
+import threading
+from datetime import datetime, timezone
+import httpx
+import websockets
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "agent"))
+
+import wire as agent_wire
+
+# Simulated agent fleet: --agents lightweight agents in one process, doing
+# what agent/agent.py does on the wire. They enroll by fingerprint, upload
+# metric batches (gzipped msgpack, like Transport) every --interval, and hold
+# a WebSocket with "hello"/"ping" heartbeats. Commands they receive are
+# acked, their output is streamed back and their status is POSTed. Reconnects
+# wait 2-8 s, as the agent does. Scenarios:
+#
+#   ingest     every agent uploads for --duration s. Reports requests, samples/s
+#              and batch latency, plus rows the server committed (from its
+#              GET /metrics).
+#   fanout     all agents connected, then --rounds broadcasts to the whole
+#              fleet. Reports per-agent latency from the POST to the command
+#              arriving, and to its status being accepted.
+#   reconnect  all agents connected, then every socket drops at once, as when
+#              a load balancer or the network blips. Reports time until each
+#              agent is back (with the agent's jitter) and handshake
+#              latency.
+#   all        the three above, in order.
+#
+# The result of each scenario is one JSON object on stdout. With --out it is
+# also appended to that file as a JSON line, so runs can be compared over
+# time. Latencies are in ms, as n/p50/p90/p99/max.
+#
+# Point --api/--ws at a running server (local Postgres and Redis). Or use
+# --standalone, which needs DATABASE_URL in the environment for Postgres.
+# It starts uvicorn for app.main on the --api port, with an in-process
+# fakeredis (pip install fakeredis) on 127.0.0.1:6379 in place of Redis.
+# On one small box the simulator competes with the server for CPU, so
+# compare numbers from the same setup only. Tokens are kept in --tokens-file
+# and reused on the next run. They are working agent credentials, so the
+# default is in the user's cache directory (owner-only), not in the tree.
+SAMPLE_EVERY = 15          # seconds between samples inside a batch (collector default)
+JITTER = (2, 8)            # agent reconnect delay after a dropped socket
+WS_HEARTBEAT = 30
+TOKENS_FILE = os.path.join(os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                           "clientdesk", "fleet_sim_tokens.json")
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"n": 0}
+    v = sorted(values)
+    pick = lambda p: v[min(len(v) - 1, int(round(p / 100 * (len(v) - 1))))]
+    return {"n": len(v), "p50": round(pick(50) * 1000, 2), "p90": round(pick(90) * 1000, 2),
+            "p99": round(pick(99) * 1000, 2), "max": round(v[-1] * 1000, 2)}
+
+
+class Recorder:
+    def __init__(self):
+        self.lat: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+
+    def add(self, name: str, secs: float) -> None:
+        self.lat.setdefault(name, []).append(secs)
+
+    def error(self, name: str) -> None:
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, *names) -> dict:
+        return {"latency_ms": {n: percentiles(self.lat.get(n, [])) for n in names},
+                "errors": {n: c for n, c in self.errors.items()}}
+
+
+class SimAgent:
+    def __init__(self, device_id: int, token: str, rec: Recorder, args):
+        self.device_id, self.token, self.rec, self.args = device_id, token, rec, args
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.uptime = random.uniform(3600, 864000)
+        self.connected = asyncio.Event()
+        self.drop = asyncio.Event()
+        self.dropped_at: float | None = None
+        self.samples = 0
+        self.commands = 0
+
+    def batch(self, n: int) -> list[dict]:
+        now = time.time()
+        out = []
+        for i in range(n):
+            t = now - (n - 1 - i) * SAMPLE_EVERY
+            out.append({"cpu": round(random.uniform(0, 100), 1), "mem": round(random.uniform(30, 70), 1),
+                        "disk": 61.0, "uptime_sec": self.uptime + t, "battery_pct": None, "ts": t,
+                        "details": {"load_avg": [0.4, 0.3, 0.2], "disks": {"/": 61.0},
+                                    "agent": {"cpu_pct": 0.1, "rss_mb": 48.0, "loop_lag_ms": 0.4}}})
+        return out
+
+    async def upload(self, client: httpx.AsyncClient) -> None:
+        samples = self.batch(self.args.batch)
+        if agent_wire.msgpack:
+            body, ctype = agent_wire.encode_batch(samples), agent_wire.CONTENT_TYPE
+        else:
+            for s in samples:
+                s["ts"] = datetime.fromtimestamp(s["ts"], timezone.utc).isoformat()
+            body, ctype = json.dumps(samples, separators=(",", ":")).encode(), "application/json"
+        t0 = time.perf_counter()
+        try:
+            r = await client.post("/metrics/batch", content=gzip.compress(body, 6), headers={
+                **self.headers, "Content-Type": ctype, "Content-Encoding": "gzip"})
+            r.raise_for_status()
+        except httpx.HTTPError:
+            self.rec.error("metrics_batch")
+            return
+        self.rec.add("metrics_batch", time.perf_counter() - t0)
+        self.samples += len(samples)
+
+    async def heartbeat(self, client: httpx.AsyncClient) -> None:
+        t0 = time.perf_counter()
+        try:
+            (await client.post("/heartbeat", headers=self.headers)).raise_for_status()
+        except httpx.HTTPError:
+            self.rec.error("heartbeat")
+            return
+        self.rec.add("heartbeat", time.perf_counter() - t0)
+
+    async def ingest(self, client: httpx.AsyncClient, stop_at: float) -> None:
+        await self.heartbeat(client)  # what the agent does once at startup
+        await asyncio.sleep(random.uniform(0, self.args.interval))  # then the upload loop starts at a random offset
+        while time.perf_counter() < stop_at:
+            await self.upload(client)
+            await asyncio.sleep(self.args.interval)
+
+    async def command(self, client: httpx.AsyncClient, ws, data: dict) -> None:
+        sent_at = float(data["payload"].rsplit(" ", 1)[-1])  # the broadcast carries its own send time
+        try:
+            await ws.send(json.dumps({"type": "output", "cmd_id": data["cmd_id"], "stream": "stdout",
+                                      "data": f"fleet-sim {self.device_id}\n"}))
+            r = await client.post(f"/commands/{data['cmd_id']}/status", headers=self.headers,
+                                  json={"status": "done", "exit_code": 0})
+            r.raise_for_status()
+        except Exception:
+            self.rec.error("command_done")
+            return
+        self.rec.add("command_done", time.time() - sent_at)
+
+    async def hold(self, client: httpx.AsyncClient, stop: asyncio.Event) -> None:
+        url = f"{self.args.ws}/ws/agent/{self.device_id}"
+        seen: set[int] = set()
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            try:
+                async with websockets.connect(url, extra_headers=self.headers, open_timeout=60, ping_interval=None,
+                                              compression=None) as ws:
+                    self.rec.add("ws_connect", time.perf_counter() - t0)
+                    await ws.send("hello")
+                    if self.dropped_at is not None:
+                        self.rec.add("reconnect", time.time() - self.dropped_at)
+                        self.dropped_at = None
+                    self.connected.set()
+                    while not stop.is_set() and not self.drop.is_set():
+                        recv = asyncio.ensure_future(ws.recv())
+                        dropped = asyncio.ensure_future(self.drop.wait())
+                        done, _ = await asyncio.wait({recv, dropped}, timeout=WS_HEARTBEAT,
+                                                     return_when=asyncio.FIRST_COMPLETED)
+                        dropped.cancel()
+                        if recv not in done:
+                            recv.cancel()
+                            if not done:
+                                await ws.send("ping")
+                            continue
+                        data = json.loads(recv.result())
+                        if "cmd_id" not in data:
+                            continue
+                        await ws.send(json.dumps({"type": "ack", "cmd_id": data["cmd_id"]}))
+                        if data["cmd_id"] in seen:
+                            continue
+                        seen.add(data["cmd_id"])
+                        self.commands += 1
+                        if data.get("payload", "").startswith("echo fleet-sim"):
+                            self.rec.add("deliver", time.time() - float(data["payload"].rsplit(" ", 1)[-1]))
+                            asyncio.create_task(self.command(client, ws, data))
+            except Exception:
+                if not self.drop.is_set():
+                    self.rec.error("ws")
+            self.connected.clear()
+            if stop.is_set():
+                return
+            if self.drop.is_set():
+                self.drop.clear()
+                self.dropped_at = self.dropped_at or time.time()
+            await asyncio.sleep(random.uniform(*JITTER))
+
+
+# ---------------- setup ----------------
+async def enroll(client: httpx.AsyncClient, n: int, path: str, concurrency: int) -> list[tuple[int, str]]:
+    devices = []
+    if os.path.exists(path):
+        with open(path) as f:
+            devices = [tuple(d) for d in json.load(f)]
+    if devices:  # a reset database forgets them; registering again is idempotent
+        r = await client.post("/heartbeat", headers={"Authorization": f"Bearer {devices[0][1]}"})
+        if r.status_code == 401:
+            devices = []
+    sem = asyncio.Semaphore(concurrency)
+
+    async def register(i: int):
+        async with sem:
+            for attempt in range(5):
+                try:
+                    r = await client.post("/register", json={
+                        "hostname": f"fleet-sim-{i}", "os": "simulated", "arch": "x86_64",
+                        "agent_version": "sim", "fingerprint": f"fleet-sim-{i:016d}"})
+                    r.raise_for_status()
+                    return r.json()["id"], r.json()["token"]
+                except httpx.TransportError:
+                    await asyncio.sleep(1 + attempt)
+            raise RuntimeError(f"could not register fleet-sim-{i}")
+
+    if len(devices) < n:
+        t0 = time.perf_counter()
+        devices += await asyncio.gather(*(register(i) for i in range(len(devices), n)))
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump(devices, f)
+        print(f"registered {n} agents in {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+    return devices[:n]
+
+
+async def scrape(client: httpx.AsyncClient, admin: dict) -> dict:
+    """Unlabelled samples from the server's GET /metrics (one worker); {} if it has none."""
+    try:
+        r = await client.get("/metrics", headers=admin)
+    except httpx.HTTPError:
+        return {}
+    if not r.is_success:
+        return {}
+    out = {}
+    for line in r.text.splitlines():
+        if line and not line.startswith("#") and "{" not in line:
+            name, value = line.rsplit(" ", 1)
+            out[name.removeprefix("clientdesk_")] = float(value)
+    return out
+
+
+def server_delta(before: dict, after: dict) -> dict:
+    keys = ("ingest_samples_total", "ingest_rows_written_total", "process_cpu_seconds_total")
+    out = {k: round(after[k] - before[k], 3) for k in keys if k in before and k in after}
+    for k in ("process_resident_memory_bytes", "ws_connections", "event_loop_lag_seconds_sum"):
+        if k in after:
+            out[k] = after[k]
+    return out
+
+
+async def connect_all(agents: list[SimAgent], client: httpx.AsyncClient, stop: asyncio.Event, ramp: float,
+                      timeout: float) -> tuple[list[asyncio.Task], float]:
+    t0 = time.perf_counter()
+    tasks = []
+    for i in range(0, len(agents), 10):  # paced, as a fleet coming online would be
+        tasks += [asyncio.create_task(a.hold(client, stop)) for a in agents[i:i + 10]]
+        await asyncio.sleep(10 / ramp)
+    try:
+        await asyncio.wait_for(asyncio.gather(*(a.connected.wait() for a in agents)), timeout)
+    except asyncio.TimeoutError:
+        pass
+    return tasks, time.perf_counter() - t0
+
+
+# ---------------- scenarios ----------------
+async def ingest(args, client, admin, agents, rec) -> dict:
+    before = await scrape(client, admin)
+    t0 = time.perf_counter()
+    await asyncio.gather(*(a.ingest(client, t0 + args.duration) for a in agents))
+    elapsed = time.perf_counter() - t0
+    await asyncio.sleep(3)  # let the server's buffer flush
+    samples = sum(a.samples for a in agents)
+    return {"elapsed_s": round(elapsed, 2), "requests": len(rec.lat.get("metrics_batch", [])),
+            "samples": samples, "samples_per_s": round(samples / elapsed, 1),
+            **rec.report("heartbeat", "metrics_batch"), "server": server_delta(before, await scrape(client, admin))}
+
+
+async def fanout(args, client, admin, agents, rec) -> dict:
+    before = await scrape(client, admin)
+    stop = asyncio.Event()
+    tasks, ramp_s = await connect_all(agents, client, stop, args.ramp, args.timeout)
+    connected = sum(a.connected.is_set() for a in agents)
+    ids = [a.device_id for a in agents]
+    rounds = []
+    try:
+        for _ in range(args.rounds):
+            got = len(rec.lat.get("deliver", []))
+            t0 = time.time()
+            r = await client.post("/commands/broadcast", headers=admin, timeout=120, json={
+                "kind": "shell", "payload": f"echo fleet-sim {t0}", "selector": {"device_ids": ids}})
+            r.raise_for_status()
+            rec.add("broadcast_post", time.time() - t0)
+            deadline = time.perf_counter() + args.timeout
+            while len(rec.lat.get("deliver", [])) - got < connected and time.perf_counter() < deadline:
+                await asyncio.sleep(0.05)
+            rounds.append({"targets": r.json()["total"], "delivered": len(rec.lat.get("deliver", [])) - got,
+                           "all_delivered_s": round(time.time() - t0, 3)})
+            await asyncio.sleep(args.gap)
+        delivered = sum(r["delivered"] for r in rounds)
+        deadline = time.perf_counter() + args.timeout
+        while (len(rec.lat.get("command_done", [])) + rec.errors.get("command_done", 0) < delivered
+               and time.perf_counter() < deadline):
+            await asyncio.sleep(0.1)
+    finally:
+        stop.set()
+        for a in agents:
+            a.drop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return {"connected": connected, "connect_s": round(ramp_s, 2), "rounds": rounds,
+            **rec.report("broadcast_post", "deliver", "command_done", "ws_connect"),
+            "server": server_delta(before, await scrape(client, admin))}
+
+
+async def reconnect(args, client, admin, agents, rec) -> dict:
+    before = await scrape(client, admin)
+    stop = asyncio.Event()
+    tasks, ramp_s = await connect_all(agents, client, stop, args.ramp, args.timeout)
+    connected = [a for a in agents if a.connected.is_set()]
+    rec.lat.pop("ws_connect", None)  # only the storm's handshakes
+    t0 = time.time()
+    try:
+        for a in connected:
+            a.dropped_at = t0
+            a.drop.set()
+        deadline = time.perf_counter() + args.timeout
+        while len(rec.lat.get("reconnect", [])) < len(connected) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.1)
+        back_s = time.time() - t0
+    finally:
+        stop.set()
+        for a in agents:
+            a.drop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return {"connected": len(connected), "connect_s": round(ramp_s, 2),
+            "reconnected": len(rec.lat.get("reconnect", [])), "all_back_s": round(back_s, 2),
+            **rec.report("reconnect", "ws_connect"), "server": server_delta(before, await scrape(client, admin))}
+
+
+SCENARIOS = {"ingest": ingest, "fanout": fanout, "reconnect": reconnect}
+
+
+def standalone(args) -> subprocess.Popen:
+    from fakeredis import TcpFakeServer  # only needed for --standalone
+    if not os.getenv("DATABASE_URL"):
+        sys.exit("--standalone needs DATABASE_URL pointing at a Postgres database")
+    server = TcpFakeServer(("127.0.0.1", 6379), server_type="redis")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = args.api.rsplit(":", 1)[-1].strip("/")
+    env = dict(os.environ, REDIS_HOST="127.0.0.1", ADMIN_TOKEN=args.admin_token)
+    return subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--port", port, "--log-level", "warning",
+                             "--ws-per-message-deflate", "false"], env=env,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+async def main(args):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))  # a socket per agent
+    admin = {"Authorization": f"Bearer {args.admin_token}"}
+    limits = httpx.Limits(max_connections=args.http_connections, max_keepalive_connections=args.http_connections)
+    async with httpx.AsyncClient(base_url=args.api, limits=limits, timeout=30) as client:
+        for _ in range(60):  # the server may still be starting
+            try:
+                await client.get("/admin/login", headers=admin)
+                break
+            except httpx.TransportError:
+                await asyncio.sleep(1)
+        devices = await enroll(client, args.agents, args.tokens_file, args.concurrency)
+        for name in (SCENARIOS if args.scenario == "all" else [args.scenario]):
+            rec = Recorder()
+            agents = [SimAgent(d, t, rec, args) for d, t in devices]
+            result = {"scenario": name, "at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                      "params": {k: getattr(args, k) for k in ("agents", "interval", "batch", "duration", "rounds",
+                                                               "ramp", "api")},
+                      **await SCENARIOS[name](args, client, admin, agents, rec)}
+            print(json.dumps(result))
+            if args.out:
+                with open(args.out, "a") as f:
+                    f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("scenario", choices=[*SCENARIOS, "all"])
+    ap.add_argument("--agents", type=int, default=1000)
+    ap.add_argument("--api", default="http://localhost:8000")
+    ap.add_argument("--ws", default="ws://localhost:8000")
+    ap.add_argument("--admin-token", default="supersecretadmin")
+    ap.add_argument("--interval", type=float, default=30, help="seconds between an agent's uploads (agent: 30)")
+    ap.add_argument("--batch", type=int, default=2, help="samples per upload (agent: 2 at the default intervals)")
+    ap.add_argument("--duration", type=float, default=60, help="ingest: seconds to run")
+    ap.add_argument("--rounds", type=int, default=5, help="fanout: broadcasts to send")
+    ap.add_argument("--gap", type=float, default=2, help="fanout: seconds between broadcasts")
+    ap.add_argument("--ramp", type=float, default=200, help="new sockets per second while connecting the fleet")
+    ap.add_argument("--timeout", type=float, default=120, help="max wait for the fleet to connect / deliver / come back")
+    ap.add_argument("--concurrency", type=int, default=50, help="parallel registrations")
+    ap.add_argument("--http-connections", type=int, default=200, help="HTTP connections shared by all agents")
+    ap.add_argument("--tokens-file", default=TOKENS_FILE)
+    ap.add_argument("--out", help="append each result as a JSON line")
+    ap.add_argument("--standalone", action="store_true", help="start the API here with an in-process fakeredis")
+    args = ap.parse_args()
+    proc = standalone(args) if args.standalone else None
+    try:
+        asyncio.run(main(args))
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
@@ -0,0 +1,73 @@
+import time
+import random
+import asyncio
+import argparse
+import httpx
+
+# Closed-loop load test for the agent endpoints: N simulated agents each
+# register once, then POST /heartbeat and /metrics back to back (plus an
+# optional think time) for --duration seconds. Reports requests/sec and
+# p50/p99 latency per endpoint.
+#
+# To compare with the sync handlers, run it once against a server built
+# from this tree and once against one built from the commit before the
+# async database layer, with the same --agents/--duration.
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def sample() -> dict:
+    return {"cpu": random.uniform(0, 100), "mem": random.uniform(20, 90), "disk": 71.5,
+            "uptime_sec": time.time() % 86400, "battery_pct": None,
+            "details": {"load_avg": [0.5, 0.4, 0.3], "disks": {"/": 71.5}}}
+
+async def register(client: httpx.AsyncClient, i: int, sem: asyncio.Semaphore) -> str:
+    async with sem:
+        r = await client.post("/register", json={"hostname": f"load-agent-{i}", "os": "loadtest",
+                                                 "arch": "x86_64", "agent_version": "load",
+                                                 "fingerprint": f"load-agent-{i:016d}"})
+        r.raise_for_status()
+        return r.json()["token"]
+
+async def agent(client: httpx.AsyncClient, token: str, stop_at: float, think: float,
+                lat: dict[str, list[float]], errors: dict[str, int]):
+    headers = {"Authorization": f"Bearer {token}"}
+    await asyncio.sleep(random.uniform(0, think or 0.1))  # spread the start
+    while time.perf_counter() < stop_at:
+        for path, body in (("/heartbeat", None), ("/metrics", sample())):
+            t0 = time.perf_counter()
+            try:
+                r = await client.post(path, headers=headers, json=body)
+                r.raise_for_status()
+            except Exception:
+                errors[path] += 1
+                continue
+            lat[path].append(time.perf_counter() - t0)
+        if think:
+            await asyncio.sleep(think * random.uniform(0.5, 1.5))
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.agents, max_keepalive_connections=args.agents)
+    async with httpx.AsyncClient(base_url=args.api, limits=limits, timeout=30) as client:
+        sem = asyncio.Semaphore(50)
+        tokens = await asyncio.gather(*(register(client, i, sem) for i in range(args.agents)))
+        lat = {"/heartbeat": [], "/metrics": []}
+        errors = {"/heartbeat": 0, "/metrics": 0}
+        start = time.perf_counter()
+        await asyncio.gather(*(agent(client, t, start + args.duration, args.think, lat, errors) for t in tokens))
+        elapsed = time.perf_counter() - start
+    print(f"{args.agents} agents, {elapsed:.1f}s")
+    for path, values in lat.items():
+        print(f"{path:12s} {len(values) / elapsed:9.0f} req/s  p50 {percentile(values, 50) * 1000:7.1f} ms"
+              f"  p99 {percentile(values, 99) * 1000:7.1f} ms  errors {errors[path]}")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--api", default="http://localhost:8000")
+    ap.add_argument("--agents", type=int, default=1000)
+    ap.add_argument("--duration", type=float, default=30)
+    ap.add_argument("--think", type=float, default=0.0, help="seconds between request pairs per agent")
+    asyncio.run(run(ap.parse_args()))
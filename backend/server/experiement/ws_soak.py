@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import httpx
+import websockets
+
+# Holds --clients agent WebSockets against a running server for --hold seconds
+# and samples the server every --sample seconds: live connections and queued
+# messages from /admin/stats, plus RSS when --server-pid is given (same host).
+# Each tick --churn of the clients drop and reconnect, and --silent clients
+# never send a heartbeat, so a server started with WS_IDLE_TIMEOUT (off by
+# default; use a short one, e.g. WS_IDLE_TIMEOUT=30, to see it within the run)
+# should close those. Halfway through, a broadcast goes out to every device and
+# clients ack it as the agent does.
+#
+# Registering 10k devices takes a while; tokens are kept in --tokens-file and
+# reused on the next run. Raise the open-files limit first (ulimit -n 20000).
+# Start uvicorn with --ws-per-message-deflate false, as docker-compose does.
+# Run it on a different machine than the server if you can; on one small box
+# the load generator competes with the server for CPU.
+
+def rss_mb(pid: int | None) -> float | None:
+    if not pid:
+        return None
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+async def get_devices(client: httpx.AsyncClient, n: int, path: str, concurrency: int) -> list[tuple[int, str]]:
+    devices = json.load(open(path)) if os.path.exists(path) else []
+    sem = asyncio.Semaphore(concurrency)
+
+    async def register(i: int):
+        async with sem:
+            for attempt in range(5):  # registration is idempotent, so retrying is safe
+                try:
+                    r = await client.post("/register", json={
+                        "hostname": f"ws-soak-{i}", "os": "soak", "arch": "x86_64", "agent_version": "soak",
+                        "fingerprint": f"ws-soak-{i:016d}"})
+                    r.raise_for_status()
+                    return r.json()["id"], r.json()["token"]
+                except httpx.TransportError:
+                    await asyncio.sleep(1 + attempt)
+            raise RuntimeError(f"could not register ws-soak-{i}")
+    if len(devices) < n:
+        t0 = time.perf_counter()
+        devices += await asyncio.gather(*(register(i) for i in range(len(devices), n)))
+        print(f"registered {n} devices in {time.perf_counter() - t0:.0f}s")
+        json.dump(devices, open(path, "w"))
+    return [tuple(d) for d in devices[:n]]
+
+
+class Client:
+    def __init__(self, url: str, device_id: int, token: str, heartbeat: float, silent: bool, ping: float | None):
+        self.url, self.device_id, self.token = url, device_id, token
+        self.heartbeat = heartbeat
+        self.ping = ping
+        self.silent = silent
+        self.reconnect = asyncio.Event()
+        self.connected = False
+        self.commands = 0
+        self.closed_by_server: dict[int, int] = {}
+
+    async def run(self, stop: asyncio.Event):
+        while not stop.is_set():
+            try:
+                async with websockets.connect(f"{self.url}/ws/agent/{self.device_id}", open_timeout=120, ping_interval=self.ping, compression=None,
+                                              extra_headers={"Authorization": f"Bearer {self.token}"}) as ws:
+                    self.connected = True
+                    await ws.send("hello")
+                    while not stop.is_set() and not self.reconnect.is_set():
+                        try:
+                            data = json.loads(await asyncio.wait_for(ws.recv(), self.heartbeat))
+                        except asyncio.TimeoutError:
+                            if not self.silent:
+                                await ws.send("ping")
+                            continue
+                        if "cmd_id" in data:
+                            self.commands += 1
+                            await ws.send(json.dumps({"type": "ack", "cmd_id": data["cmd_id"]}))
+            except websockets.ConnectionClosed as e:
+                code = e.rcvd.code if e.rcvd else 1006
+                self.closed_by_server[code] = self.closed_by_server.get(code, 0) + 1
+            except Exception:
+                pass
+            self.connected = False
+            if self.silent and self.closed_by_server:
+                return  # stays away once the server has dropped it, like a dead machine
+            self.reconnect.clear()
+            await asyncio.sleep(random.uniform(0.1, 1))
+
+
+async def run(args):
+    admin = {"Authorization": f"Bearer {args.admin_token}"}
+    async with httpx.AsyncClient(base_url=args.api, timeout=60,
+                                 limits=httpx.Limits(max_connections=args.concurrency)) as api:
+        devices = await get_devices(api, args.clients, args.tokens_file, args.concurrency)
+        clients = [Client(args.ws, d, t, args.heartbeat, i < args.silent, args.ping or None)
+                   for i, (d, t) in enumerate(devices)]
+        stop = asyncio.Event()
+        t0 = time.perf_counter()
+        tasks = []
+        for i in range(0, len(clients), 10):  # paced: a burst beyond what the server accepts just times out and retries
+            tasks += [asyncio.create_task(c.run(stop)) for c in clients[i:i + 10]]
+            await asyncio.sleep(10 / args.ramp)
+        while (sum(c.connected or (c.silent and bool(c.closed_by_server)) for c in clients) < len(clients)
+               and time.perf_counter() - t0 < 600):
+            await asyncio.sleep(0.5)
+        print(f"{sum(c.connected for c in clients)} clients connected in {time.perf_counter() - t0:.1f}s")
+
+        rows = []
+        try:
+            start = time.perf_counter()
+            broadcast_sent = False
+            print(f"{'t':>5} {'conns':>6} {'local':>6} {'queued':>6} {'rss_mb':>7} {'idle_cl':>7} {'slow_cl':>7}")
+            while time.perf_counter() - start < args.hold:
+                await asyncio.sleep(args.sample)
+                if not broadcast_sent and time.perf_counter() - start >= args.hold / 2:
+                    r = await api.post("/commands/broadcast", headers=admin, json={
+                        "kind": "shell", "payload": "echo soak", "selector": {"device_ids": [c.device_id for c in clients]}})
+                    print(f"broadcast: {r.status_code} {r.json().get('total')}")
+                    broadcast_sent = True
+                for c in random.sample(clients, int(len(clients) * args.churn)):
+                    c.reconnect.set()
+                try:
+                    r = await api.get("/admin/stats", headers=admin, timeout=args.sample)
+                    ws = r.json()["ws"] if r.is_success else {}
+                except httpx.TransportError:  # a saturated server still gets its RSS sampled
+                    ws = {}
+                row = (time.perf_counter() - start, ws.get("connections", "-"), sum(c.connected for c in clients),
+                       ws.get("queued", "-"), rss_mb(args.server_pid), ws.get("idle_closed", "-"), ws.get("slow_closed", "-"))
+                rows.append(row)
+                print(f"{row[0]:5.0f} {row[1]:>6} {row[2]:6d} {row[3]:>6} {row[4] or 0:7.1f} {row[5]:>7} {row[6]:>7}")
+        finally:  # otherwise a failed request leaves the clients reconnecting forever
+            stop.set()
+            for c in clients:
+                c.reconnect.set()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    closes: dict[int, int] = {}
+    for c in clients:
+        for code, n in c.closed_by_server.items():
+            closes[code] = closes.get(code, 0) + n
+    print(f"commands received {sum(c.commands for c in clients)}; server close codes {closes}")
+    rss = [r[4] for r in rows if r[4]]
+    if len(rss) >= 4:
+        settled = rss[len(rss) // 4:]  # after the first quarter of the hold
+        print(f"server RSS {min(settled):.1f}-{max(settled):.1f} MB after warm-up, "
+              f"drift {(settled[-1] - settled[0]) / settled[0] * 100:+.1f}%")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--api", default="http://localhost:8000")
+    ap.add_argument("--ws", default="ws://localhost:8000")
+    ap.add_argument("--admin-token", default="supersecretadmin")
+    ap.add_argument("--clients", type=int, default=10000)
+    ap.add_argument("--hold", type=float, default=300)
+    ap.add_argument("--sample", type=float, default=10)
+    ap.add_argument("--heartbeat", type=float, default=30)
+    ap.add_argument("--ping", type=float, default=20, help="protocol ping interval like the agent's; 0 = off, "
+                    "which saves the load generator a lot of CPU when it shares a small box with the server")
+    ap.add_argument("--churn", type=float, default=0.02, help="fraction of clients reconnecting per sample")
+    ap.add_argument("--silent", type=int, default=100, help="clients that never heartbeat")
+    ap.add_argument("--ramp", type=float, default=100, help="new connections per second while ramping up")
+    ap.add_argument("--concurrency", type=int, default=50, help="parallel registrations")
+    ap.add_argument("--server-pid", type=int)
+    ap.add_argument("--tokens-file", default="ws_soak_tokens.json")
+    asyncio.run(run(ap.parse_args()))